@@ -0,0 +1,103 @@
+"""Кэш доступа перед allowed_users: TTL, короткий негативный кэш, LRU и LISTEN на отзыв."""
+import logging
+import time
+from collections import OrderedDict
+
+import config
+from db import listen
+
+log = logging.getLogger(__name__)
+
+REVOKE_CHANNEL = "access_revoked"
+
+
+class AccessCache:
+    """LRU-кэш ответов is_allowed по ключу (user_id, bot_name)."""
+
+    def __init__(self, ttl: float, negative_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[tuple[int, str], tuple[bool, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int, bot_name: str) -> bool | None:
+        """True/False из кэша или None, если записи нет или она протухла.
+
+        Протухшая запись не удаляется: пока её не вытеснит LRU или не перезапишет put, peek()
+        отдаёт её как последний известный ответ, если БД недоступна.
+        """
+        key = (user_id, bot_name)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        allowed, expires = entry
+        if time.monotonic() >= expires:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return allowed
+
+    def peek(self, user_id: int, bot_name: str) -> bool | None:
+        """Последнее известное значение, даже протухшее (без учёта в статистике)."""
+        entry = self._entries.get((user_id, bot_name))
+        return entry[0] if entry else None
+
+    def put(self, user_id: int, bot_name: str, allowed: bool):
+        key = (user_id, bot_name)
+        ttl = self.ttl if allowed else self.negative_ttl
+        if ttl <= 0:
+            self._entries.pop(key, None)
+            return
+        self._entries[key] = (allowed, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id: int, bot_name: str):
+        if self._entries.pop((user_id, bot_name), None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+access_cache = AccessCache(
+    ttl=config.ACCESS_CACHE_TTL,
+    negative_ttl=config.ACCESS_CACHE_NEGATIVE_TTL,
+    max_size=config.ACCESS_CACHE_MAX_SIZE,
+)
+
+
+async def listen_revocations(cache: AccessCache = access_cache):
+    """Фоновая задача: LISTEN на отзыв доступа, сбрасывает отозванные записи.
+
+    После (пере)подключения кэш очищается целиком — уведомления за время обрыва потеряны.
+    """
+    async def on_notify(payload: str):
+        uid, _, bot_name = payload.partition(":")
+        if uid.isdigit():
+            cache.invalidate(int(uid), bot_name)
+
+    async def on_connect():
+        cache.clear()
+
+    await listen(REVOKE_CHANNEL, on_notify, on_connect)
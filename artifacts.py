@@ -0,0 +1,171 @@
+"""Готовые результаты пользователя: распаковка, позиционирование, BIO, анализ продукта, сегменты ЦА.
+
+Каждый результат, дошедший до пользователя, сохраняется новой версией с ключом
+(пользователь, бот, вид результата). Текст хранится сжатым zlib вместе с хэшем: тот же
+текст ещё раз (например, ответ из кэша генераций) новую версию не создаёт. Каждого вида
+хранится не больше ARTIFACT_KEEP_VERSIONS последних версий. /myresults отдаёт сохранённое
+постранично, без обращения к LLM. Локально (без DATABASE_URL) — SQLite, как у сессий.
+Сохранение — best effort: сбой хранилища не должен мешать сценарию.
+"""
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import config
+import metrics
+from db import db_run
+
+log = logging.getLogger(__name__)
+
+SAVED = metrics.Counter("bot_artifacts_saved_total", "Сохранённые результаты (новые версии)", ("kind",))
+SAVE_ERRORS = metrics.Counter("bot_artifacts_save_errors_total", "Результаты, которые не удалось сохранить",
+                              ("kind",))
+
+
+@dataclass
+class Artifact:
+    kind: str
+    version: int
+    text: str
+    created_at: datetime
+
+
+def _pack(text: str) -> tuple[bytes, str]:
+    data = text.encode()
+    return zlib.compress(data, 6), hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class ArtifactBackend:
+    """Постоянное хранилище версий."""
+
+    async def save(self, user_id: int, kind: str, body: bytes, digest: str, keep: int):
+        raise NotImplementedError
+
+    async def page(self, user_id: int, offset: int, limit: int) -> tuple[list[tuple], int]:
+        """Строки (kind, version, body, created_at) от новых к старым и общее их число."""
+        raise NotImplementedError
+
+
+class PostgresArtifactBackend(ArtifactBackend):
+    def __init__(self, bot_name: str):
+        self.bot_name = bot_name
+
+    async def save(self, user_id: int, kind: str, body: bytes, digest: str, keep: int):
+        # одним запросом: новая версия (если текст изменился) и чистка старых сверх keep
+        await db_run(
+            """WITH last AS (
+                SELECT version, digest FROM bot_artifacts
+                WHERE user_id=%(uid)s AND bot_name=%(bot)s AND kind=%(kind)s
+                ORDER BY version DESC LIMIT 1
+            ), ins AS (
+                INSERT INTO bot_artifacts(user_id, bot_name, kind, version, body, digest)
+                SELECT %(uid)s, %(bot)s, %(kind)s, coalesce((SELECT version FROM last), 0) + 1, %(body)s, %(digest)s
+                WHERE %(digest)s::text IS DISTINCT FROM (SELECT digest FROM last)
+                RETURNING version
+            )
+            DELETE FROM bot_artifacts a USING ins
+            WHERE a.user_id=%(uid)s AND a.bot_name=%(bot)s AND a.kind=%(kind)s AND a.version <= ins.version - %(keep)s""",
+            {"uid": user_id, "bot": self.bot_name, "kind": kind, "body": body, "digest": digest, "keep": keep},
+        )
+
+    async def page(self, user_id: int, offset: int, limit: int) -> tuple[list[tuple], int]:
+        rows = await db_run(
+            "SELECT kind, version, body, created_at, count(*) OVER () AS total FROM bot_artifacts "
+            "WHERE user_id=%s AND bot_name=%s ORDER BY created_at DESC, kind LIMIT %s OFFSET %s",
+            (user_id, self.bot_name, limit, offset), fetch="all",
+        )
+        total = rows[0]["total"] if rows else 0
+        return [(r["kind"], r["version"], bytes(r["body"]), r["created_at"]) for r in rows], total
+
+
+class SQLiteArtifactBackend(ArtifactBackend):
+    """Локальная замена Postgres (разработка, нагрузочный тест). Запросы — в отдельном потоке."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS artifacts (user_id INTEGER NOT NULL, kind TEXT NOT NULL, "
+                    "version INTEGER NOT NULL, body BLOB NOT NULL, digest TEXT NOT NULL, created_at REAL NOT NULL, "
+                    "PRIMARY KEY(user_id, kind, version))"
+                )
+        return self._conn
+
+    def _save(self, user_id: int, kind: str, body: bytes, digest: str, keep: int):
+        with self._lock, self._db() as conn:
+            last = conn.execute(
+                "SELECT version, digest FROM artifacts WHERE user_id=? AND kind=? ORDER BY version DESC LIMIT 1",
+                (user_id, kind),
+            ).fetchone()
+            if last is not None and last[1] == digest:
+                return
+            version = (last[0] if last else 0) + 1
+            conn.execute("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?, ?)",
+                         (user_id, kind, version, body, digest, time.time()))
+            conn.execute("DELETE FROM artifacts WHERE user_id=? AND kind=? AND version <= ?",
+                         (user_id, kind, version - keep))
+
+    def _page(self, user_id: int, offset: int, limit: int):
+        with self._lock:
+            db = self._db()
+            total = db.execute("SELECT count(*) FROM artifacts WHERE user_id=?", (user_id,)).fetchone()[0]
+            rows = db.execute(
+                "SELECT kind, version, body, created_at FROM artifacts WHERE user_id=? "
+                "ORDER BY created_at DESC, kind LIMIT ? OFFSET ?",
+                (user_id, limit, offset),
+            ).fetchall()
+        return [(k, v, b, datetime.fromtimestamp(t, timezone.utc)) for k, v, b, t in rows], total
+
+    async def save(self, user_id: int, kind: str, body: bytes, digest: str, keep: int):
+        await asyncio.to_thread(self._save, user_id, kind, body, digest, keep)
+
+    async def page(self, user_id: int, offset: int, limit: int) -> tuple[list[tuple], int]:
+        return await asyncio.to_thread(self._page, user_id, offset, limit)
+
+
+class ArtifactStore:
+    def __init__(self, backend: ArtifactBackend, *, keep: int = 5):
+        self.backend = backend
+        self.keep = max(keep, 1)
+
+    async def save(self, user_id: int, kind: str, text: str | None):
+        """Сохранить результат новой версией; ошибки только логируются."""
+        if not text:
+            return
+        body, digest = _pack(text)
+        try:
+            await self.backend.save(user_id, kind, body, digest, self.keep)
+        except Exception as e:
+            SAVE_ERRORS.inc(kind=kind)
+            log.warning("artifacts: не удалось сохранить %s для %s: %s", kind, user_id, e)
+            return
+        SAVED.inc(kind=kind)
+
+    async def page(self, user_id: int, offset: int, limit: int) -> tuple[list[Artifact], int]:
+        """Страница результатов от новых к старым и общее их число."""
+        rows, total = await self.backend.page(user_id, offset, limit)
+        items = [Artifact(kind, version, zlib.decompress(body).decode(), created_at)
+                 for kind, version, body, created_at in rows]
+        return items, total
+
+
+def make_store() -> ArtifactStore:
+    if config.ARTIFACT_BACKEND == "postgres":
+        backend = PostgresArtifactBackend(config.BOT_NAME)
+    elif config.ARTIFACT_BACKEND == "sqlite":
+        backend = SQLiteArtifactBackend(config.ARTIFACT_SQLITE_PATH)
+    else:
+        raise ValueError(f"Unknown ARTIFACT_BACKEND: {config.ARTIFACT_BACKEND!r}")
+    return ArtifactStore(backend, keep=config.ARTIFACT_KEEP_VERSIONS)
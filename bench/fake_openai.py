@@ -0,0 +1,128 @@
+"""Заглушка OpenAI Chat Completions с настраиваемой задержкой и стримингом.
+
+Ответ генерируется синтетически; длина зависит от того, что просили:
+короткий комментарий коуча, HTML-сегменты ЦА или обычный длинный текст.
+Задержка = ttft + токены / tps, для стрима токены идут с этой скоростью.
+"""
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+
+from aiohttp import web
+
+_WORDS = (
+    "клиент ценность доверие результат аудитория история опыт стиль энергия забота "
+    "рост решение задача смысл команда продукт путь выбор идея уют"
+).split()
+
+
+class FakeOpenAI:
+    def __init__(self, *, ttft: float = 0.5, tps: float = 60.0, scale: float = 1.0,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.ttft = ttft
+        self.tps = tps
+        self.scale = scale
+        self.error_rate = error_rate
+        self._rnd = random.Random(seed)
+        self._ids = itertools.count(1)
+        self.stats = {"requests": 0, "streams": 0, "errors": 0, "inflight": 0, "inflight_max": 0, "tokens": 0}
+
+    def _answer(self, messages: list[dict]) -> tuple[list[str], str]:
+        """Токены ответа (слова с пробелом) и вид ответа."""
+        prompt = " ".join(m.get("content", "") for m in messages)
+        if "короткий комментарий" in prompt:
+            kind, n = "comment", 40
+        elif "Только названия сегментов" in prompt:
+            count = int(re.search(r"РОВНО (\d+)", prompt).group(1))
+            return [" ".join(self._rnd.sample(_WORDS, 3)) + "\n" for _ in range(count)], "titles"
+        elif "Опиши ровно один сегмент" in prompt:
+            head = re.search(r"Первая строка ответа: (<b>Сегмент \d+: [^<]*</b>)", prompt).group(1)
+            return [head + "\n\n"] + self._segment_body(), "segment"
+        elif "Сегмент" in prompt:
+            kind, n = "segments", 0
+        elif "BIO" in prompt or "краткий анализ" in prompt:
+            kind, n = "short", 150
+        else:
+            kind, n = "long", 700
+        if kind == "segments":
+            count = 3 if "ещё 3" in prompt else 5
+            tokens = []
+            for i in range(count):
+                tokens.append(f"<b>Сегмент {i + 1}: {self._rnd.choice(_WORDS)}</b>\n\n")
+                tokens.extend(self._segment_body())
+            return tokens, kind
+        return self._words(max(1, int(n * self.scale))), kind
+
+    def _segment_body(self) -> list[str]:
+        tokens = []
+        for label in ("JTBD", "Потребности", "Боли", "Решения", "Темы для контента", "Психографика",
+                      "Поведенческая сегментация", "Оффер"):
+            tokens.append(f"<u>{label}:</u> ")
+            tokens.extend(self._words(int(30 * self.scale)))
+            tokens.append("\n\n")
+        return tokens
+
+    def _words(self, n: int) -> list[str]:
+        out = []
+        for i in range(n):
+            word = self._rnd.choice(_WORDS)
+            out.append(word + (".\n\n" if i % 60 == 59 else ". " if i % 12 == 11 else " "))
+        return out
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["requests"] += 1
+        self.stats["inflight"] += 1
+        self.stats["inflight_max"] = max(self.stats["inflight_max"], self.stats["inflight"])
+        try:
+            await asyncio.sleep(self.ttft)
+            if self.error_rate and self._rnd.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return web.json_response(
+                    {"error": {"message": "bench: synthetic overload", "type": "server_error"}}, status=503,
+                )
+            tokens, _ = self._answer(body.get("messages", []))
+            self.stats["tokens"] += len(tokens)
+            if body.get("stream"):
+                self.stats["streams"] += 1
+                return await self._stream(request, body, tokens)
+            await asyncio.sleep(len(tokens) / self.tps)
+            prompt_tokens = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 3
+            return web.json_response({
+                "id": f"chatcmpl-{next(self._ids)}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "bench"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                          "total_tokens": prompt_tokens + len(tokens)},
+            })
+        finally:
+            self.stats["inflight"] -= 1
+
+    async def _stream(self, request: web.Request, body: dict, tokens: list[str]) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        cid = f"chatcmpl-{next(self._ids)}"
+        # пачками по ~50 мс, как реальный API
+        step = max(1, int(self.tps * 0.05))
+        for i in range(0, len(tokens), step):
+            await asyncio.sleep(step / self.tps)
+            chunk = {
+                "id": cid, "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body.get("model", "bench"),
+                "choices": [{"index": 0, "delta": {"content": "".join(tokens[i:i + step])}, "finish_reason": None}],
+            }
+            await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        return app
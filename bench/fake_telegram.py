@@ -0,0 +1,157 @@
+"""Заглушка Bot API: отдаёт боту апдейты через getUpdates и запоминает всё, что бот отправил.
+
+Виртуальные пользователи кладут апдейты через push_update() и ждут ответов бота через
+wait_for(): события (sendMessage, editMessageText, ...) копятся в журнале каждого чата.
+"""
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+# методы, которые возвращают сообщение
+_MESSAGE_METHODS = {"sendMessage", "editMessageText", "sendDocument", "sendPhoto"}
+
+
+class BotEvent:
+    __slots__ = ("method", "params", "t", "message_id")
+
+    def __init__(self, method: str, params: dict, t: float):
+        self.method = method
+        self.params = params
+        self.t = t
+        self.message_id = 0
+
+    @property
+    def text(self) -> str:
+        return self.params.get("text") or self.params.get("caption") or ""
+
+    @property
+    def buttons(self) -> list[str]:
+        """callback_data всех кнопок сообщения."""
+        markup = self.params.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if not markup:
+            return []
+        return [b.get("callback_data") for row in markup.get("inline_keyboard", []) for b in row]
+
+
+class _Chat:
+    __slots__ = ("events", "changed", "message_ids")
+
+    def __init__(self):
+        self.events: list[BotEvent] = []
+        self.changed = asyncio.Event()
+        self.message_ids = itertools.count(1)
+
+
+class FakeTelegram:
+    def __init__(self, token: str, *, latency: float = 0.0, bot_username: str = "bench_bot"):
+        self.token = token
+        self.latency = latency
+        self.bot_username = bot_username
+        self._updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        self._chats: dict[int, _Chat] = {}
+        self.polled = asyncio.Event()          # бот начал опрашивать getUpdates — он готов
+        self.calls: dict[str, int] = {}
+
+    # ---------- сторона пользователей ----------
+    def chat(self, chat_id: int) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat()
+        return chat
+
+    def next_message_id(self, chat_id: int) -> int:
+        return next(self.chat(chat_id).message_ids)
+
+    def push_update(self, update: dict):
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._new_updates.set()
+
+    def mark(self, chat_id: int) -> int:
+        """Позиция в журнале чата: wait_for смотрит только события после неё."""
+        return len(self.chat(chat_id).events)
+
+    async def wait_for(self, chat_id: int, since: int, predicate, timeout: float) -> tuple[BotEvent, BotEvent]:
+        """Ждать события чата, подходящего под predicate; вернуть (первое событие после since, найденное)."""
+        chat = self.chat(chat_id)
+        deadline = time.monotonic() + timeout
+        pos = since
+        while True:
+            while pos < len(chat.events):
+                if predicate(chat.events[pos]):
+                    return chat.events[since], chat.events[pos]
+                pos += 1
+            chat.changed.clear()
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise asyncio.TimeoutError
+            await asyncio.wait_for(chat.changed.wait(), left)
+
+    # ---------- сторона бота ----------
+    async def handle(self, request: web.Request) -> web.Response:
+        if request.match_info["token"] != self.token:
+            return web.json_response({"ok": False, "error_code": 401, "description": "Unauthorized"}, status=401)
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = {k: v for k, v in (await request.post()).items() if isinstance(v, str)}
+        if method == "getUpdates":
+            return _ok(await self._get_updates(params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return _ok(self._record(method, params))
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        self.polled.set()
+        offset = int(params.get("offset") or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                return []
+        limit = int(params.get("limit") or 100)
+        return self._updates[:limit]
+
+    def _record(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": self.bot_username,
+                    "can_join_groups": False, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if "chat_id" not in params:
+            return True  # deleteWebhook, answerCallbackQuery, ...
+        chat_id = int(params["chat_id"])
+        chat = self.chat(chat_id)
+        event = BotEvent(method, params, time.monotonic())
+        chat.events.append(event)
+        chat.changed.set()
+        if method not in _MESSAGE_METHODS:
+            return True
+        message_id = int(params["message_id"]) if "message_id" in params else next(chat.message_ids)
+        event.message_id = message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+def _ok(result) -> web.Response:
+    return web.json_response({"ok": True, "result": result})
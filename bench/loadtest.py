@@ -0,0 +1,347 @@
+"""Нагрузочный тест полного сценария бота.
+
+N виртуальных пользователей проходят весь путь: /start (с токеном) → 15 ответов интервью →
+распаковка и позиционирование → 4 ответа о продукте → анализ ЦА → доп. сегменты.
+Бот — настоящий (bench/run_bot.py, отдельный процесс, polling), Bot API и OpenAI — локальные
+заглушки с настраиваемой задержкой. Задержка этапа — от апдейта пользователя до сообщения
+бота, которым этап заканчивается (следующий вопрос, кнопки), т.е. то, что видит человек.
+
+    python -m bench.loadtest --users 50 --ramp 20 --think 2
+    python -m bench.loadtest --users 50 --save bench/baseline.json
+    python -m bench.loadtest --users 50 --baseline bench/baseline.json --tolerance 0.25
+
+С --baseline прогон завершается с кодом 1, если p95 любого этапа или пропускная способность
+хуже базовой больше чем на tolerance. Без DATABASE_URL в окружении бот работает без Postgres
+(см. run_bot.py); с DATABASE_URL — на настоящей базе, включая погашение токенов.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from aiohttp import web
+
+from bench.fake_openai import FakeOpenAI
+from bench.fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:BENCH"
+USER_BASE = 7_000_000_000
+
+# Порядок строк в отчёте
+STAGES = ["start", "agree", "answer", "finish_interview", "product_q", "product_analysis",
+          "start_jtbd", "jtbd_more", "finish", "flow"]
+
+
+# ---------- статистика ----------
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+class Recorder:
+    def __init__(self):
+        self.total: dict[str, list[float]] = {s: [] for s in STAGES}
+        self.first: dict[str, list[float]] = {s: [] for s in STAGES}
+        self.errors: dict[str, int] = {}
+        self.completed = 0
+
+    def add(self, stage: str, total: float, first: float | None = None):
+        self.total[stage].append(total)
+        if first is not None:
+            self.first[stage].append(first)
+
+    def error(self, stage: str):
+        self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def summary(self) -> dict:
+        out = {}
+        for stage in STAGES:
+            values = self.total[stage]
+            if not values:
+                continue
+            out[stage] = {
+                "n": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": max(values),
+                "first_p50": percentile(self.first[stage], 50),
+                "first_p95": percentile(self.first[stage], 95),
+            }
+        return out
+
+
+# ---------- виртуальный пользователь ----------
+class VirtualUser:
+    def __init__(self, world: FakeTelegram, uid: int, opts, rec: Recorder, questions, product_questions):
+        self.tg = world
+        self.uid = uid
+        self.opts = opts
+        self.rec = rec
+        self.questions = questions
+        self.product_questions = product_questions
+        self.rnd = random.Random(opts.seed * 1_000_003 + uid)
+        self._callback_ids = 0
+        self._last_buttons_msg: dict[str, int] = {}
+
+    # ----- апдейты -----
+    def _from(self) -> dict:
+        return {"id": self.uid, "is_bot": False, "first_name": f"bench{self.uid}"}
+
+    def _chat(self) -> dict:
+        return {"id": self.uid, "type": "private", "first_name": f"bench{self.uid}"}
+
+    def send_text(self, text: str):
+        msg = {
+            "message_id": self.tg.next_message_id(self.uid), "date": int(time.time()),
+            "chat": self._chat(), "from": self._from(), "text": text,
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.tg.push_update({"message": msg})
+
+    def press(self, data: str):
+        self._callback_ids += 1
+        self.tg.push_update({"callback_query": {
+            "id": f"{self.uid}-{self._callback_ids}", "from": self._from(), "chat_instance": str(self.uid),
+            "data": data,
+            "message": {"message_id": self._last_buttons_msg.get(data, 1), "date": int(time.time()),
+                        "chat": self._chat()},
+        }})
+
+    def answer_text(self, n: int) -> str:
+        words = " ".join(self.rnd.choice(("честно", "подробно", "люблю", "делаю", "помогаю", "людям",
+                                          "красиво", "уютно", "быстро", "вместе"))
+                         for _ in range(self.opts.answer_words))
+        return f"Ответ {n} пользователя {self.uid}: {words}"
+
+    async def think(self):
+        if self.opts.think > 0:
+            await asyncio.sleep(min(self.rnd.expovariate(1 / self.opts.think), self.opts.think * 5))
+
+    # ----- этапы -----
+    async def step(self, stage: str, action, until):
+        since = self.tg.mark(self.uid)
+        t0 = time.monotonic()
+        action()
+        try:
+            first, last = await self.tg.wait_for(self.uid, since, until, self.opts.stage_timeout)
+        except asyncio.TimeoutError:
+            self.rec.error(stage)
+            raise
+        for data in last.buttons:
+            self._last_buttons_msg[data] = last.message_id
+        self.rec.add(stage, last.t - t0, first.t - t0)
+        return last
+
+    async def run(self):
+        t0 = time.monotonic()
+        qs, pqs = self.questions, self.product_questions
+        start = "/start" + (f" bench-{self.opts.run_id}-{self.uid}" if self.opts.tokens else "")
+        await self.step("start", lambda: self.send_text(start), lambda e: "agree" in e.buttons)
+        await self.think()
+        await self.step("agree", lambda: self.press("agree"), lambda e: e.text == qs[0])
+        for i in range(len(qs)):
+            await self.think()
+            text = self.answer_text(i + 1)
+            if i + 1 < len(qs):
+                await self.step("answer", lambda: self.send_text(text), lambda e, q=qs[i + 1]: e.text == q)
+            else:
+                await self.step("finish_interview", lambda: self.send_text(text),
+                                lambda e: {"bio", "product", "jtbd"} <= set(e.buttons))
+        await self.think()
+        await self.step("product_q", lambda: self.press("product"), lambda e: e.text == pqs[0])
+        for i in range(len(pqs)):
+            await self.think()
+            text = self.answer_text(100 + i)
+            if i + 1 < len(pqs):
+                await self.step("product_q", lambda: self.send_text(text), lambda e, q=pqs[i + 1]: e.text == q)
+            else:
+                await self.step("product_analysis", lambda: self.send_text(text),
+                                lambda e: "finish_products" in e.buttons)
+        await self.think()
+        await self.step("start_jtbd", lambda: self.press("finish_products"), lambda e: "jtbd_more" in e.buttons)
+        await self.think()
+        await self.step("jtbd_more", lambda: self.press("jtbd_more"), lambda e: "finish_unpack" in e.buttons)
+        await self.step("finish", lambda: self.press("finish_unpack"),
+                        lambda e: e.text.startswith("✅ Распаковка завершена"))
+        self.rec.add("flow", time.monotonic() - t0)
+        self.rec.completed += 1
+
+
+# ---------- бот в отдельном процессе ----------
+def spawn_bot(opts, tg_port: int, llm_port: int, log_path: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "TG_API_URL": f"http://127.0.0.1:{tg_port}",
+        "OPENAI_API_BASE": f"http://127.0.0.1:{llm_port}/v1",
+        "OPENAI_API_KEY": "bench",
+        "BENCH_USER_BASE": str(USER_BASE),
+        "BENCH_USERS": str(opts.users),
+        "BENCH_RUN_ID": opts.run_id,
+        "STREAM_REPLIES": "1" if opts.stream else "0",
+        "TOKEN_SWEEP_INTERVAL": "0",
+        "ACCESS_CACHE_TTL": "1e9",
+    })
+    if not opts.tokens:
+        # «БД в памяти»: пустой DATABASE_URL перекрывает значение из .env
+        env.update({
+            "DATABASE_URL": "",
+            "SESSION_BACKEND": "sqlite",
+            "SESSION_SQLITE_PATH": ":memory:",
+            "ARTIFACT_BACKEND": "sqlite",
+            "ARTIFACT_SQLITE_PATH": ":memory:",
+            "GEN_CACHE_PERSIST": "none",
+            "ACCESS_CACHE_LISTEN": "0",
+        })
+    env.update(dict(kv.split("=", 1) for kv in opts.env))
+    log = open(log_path, "w")
+    return subprocess.Popen([sys.executable, "-m", "bench.run_bot"], cwd=ROOT, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+async def _serve(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+# ---------- прогон ----------
+async def run(opts) -> dict:
+    import bot  # только тексты вопросов; импорт без побочных эффектов
+
+    tg = FakeTelegram(BOT_TOKEN, latency=opts.tg_latency)
+    llm = FakeOpenAI(ttft=opts.llm_ttft, tps=opts.llm_tps, scale=opts.llm_scale,
+                     error_rate=opts.llm_error_rate, seed=opts.seed)
+    runners = [await _serve(tg.make_app(), opts.tg_port), await _serve(llm.make_app(), opts.llm_port)]
+    log_path = os.path.join(tempfile.gettempdir(), f"bench-bot-{opts.run_id}.log")
+    t_spawn = time.monotonic()
+    proc = spawn_bot(opts, opts.tg_port, opts.llm_port, log_path)
+    rec = Recorder()
+    try:
+        await asyncio.wait_for(tg.polled.wait(), 60)
+        ready_s = time.monotonic() - t_spawn
+        print(f"бот готов за {ready_s * 1000:.0f} мс, лог: {log_path}")
+
+        async def one(i: int):
+            await asyncio.sleep(opts.ramp * i / max(opts.users, 1))
+            user = VirtualUser(tg, USER_BASE + i, opts, rec, bot.INTERVIEW_Q, bot.PRODUCT_Q)
+            try:
+                await user.run()
+            except asyncio.TimeoutError:
+                pass
+
+        t0 = time.monotonic()
+        await asyncio.gather(*(one(i) for i in range(opts.users)))
+        wall = time.monotonic() - t0
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, proc.wait, 30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        for r in runners:
+            await r.cleanup()
+
+    calls = dict(sorted(tg.calls.items()))
+    return {
+        "users": opts.users,
+        "completed": rec.completed,
+        "errors": rec.errors,
+        "wall_s": wall,
+        "bot_ready_ms": ready_s * 1000,
+        "throughput_flows_per_min": rec.completed / wall * 60 if wall else 0.0,
+        "bot_api_calls_per_s": sum(calls.values()) / wall if wall else 0.0,
+        "bot_api_calls": calls,
+        "llm": dict(llm.stats),
+        "stages": rec.summary(),
+    }
+
+
+def print_report(res: dict):
+    print(f"\nпользователей: {res['users']}, завершили: {res['completed']}, ошибок по этапам: {res['errors'] or 0}")
+    print(f"время прогона: {res['wall_s']:.1f} с, пропускная способность: "
+          f"{res['throughput_flows_per_min']:.2f} сценариев/мин, Bot API: {res['bot_api_calls_per_s']:.1f} вызовов/с")
+    llm = res["llm"]
+    print(f"LLM: запросов {llm['requests']} (стрим {llm['streams']}), ошибок {llm['errors']}, "
+          f"одновременно до {llm['inflight_max']}")
+    print(f"\n{'этап':<18}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'1-й p50':>10}{'1-й p95':>10}   (с)")
+    for stage, s in res["stages"].items():
+        first = f"{s['first_p50']:>10.2f}{s['first_p95']:>10.2f}" if stage != "flow" else f"{'-':>10}{'-':>10}"
+        print(f"{stage:<18}{s['n']:>6}{s['p50']:>9.2f}{s['p95']:>9.2f}{s['p99']:>9.2f}{s['max']:>9.2f}{first}")
+
+
+def compare(res: dict, base: dict, tolerance: float) -> list[str]:
+    """Регрессии относительно базового прогона."""
+    problems = []
+    for stage, s in res["stages"].items():
+        b = base.get("stages", {}).get(stage)
+        if b and b["p95"] > 0 and s["p95"] > b["p95"] * (1 + tolerance):
+            problems.append(f"{stage}: p95 {s['p95']:.2f} с против {b['p95']:.2f} с")
+    if res["throughput_flows_per_min"] < base["throughput_flows_per_min"] * (1 - tolerance):
+        problems.append(f"пропускная способность {res['throughput_flows_per_min']:.2f} "
+                        f"против {base['throughput_flows_per_min']:.2f} сценариев/мин")
+    if res["completed"] < base["completed"] * res["users"] / max(base["users"], 1):
+        problems.append(f"завершили {res['completed']} из {res['users']}")
+    return problems
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками Bot API и OpenAI")
+    p.add_argument("--users", type=int, default=20, help="виртуальных пользователей")
+    p.add_argument("--ramp", type=float, default=10.0, help="за сколько секунд стартуют все пользователи")
+    p.add_argument("--think", type=float, default=1.0, help="среднее время «на подумать» между действиями, с")
+    p.add_argument("--answer-words", type=int, default=30, help="слов в ответе пользователя")
+    p.add_argument("--stage-timeout", type=float, default=300.0, help="сколько ждать ответа бота на этапе, с")
+    p.add_argument("--llm-ttft", type=float, default=0.5, help="задержка до первого токена, с")
+    p.add_argument("--llm-tps", type=float, default=60.0, help="токенов в секунду")
+    p.add_argument("--llm-scale", type=float, default=1.0, help="множитель длины ответов модели")
+    p.add_argument("--llm-error-rate", type=float, default=0.0, help="доля ответов 503")
+    p.add_argument("--tg-latency", type=float, default=0.02, help="задержка каждого вызова Bot API, с")
+    p.add_argument("--no-stream", dest="stream", action="store_false", help="STREAM_REPLIES=0")
+    p.add_argument("--tokens", action="store_true",
+                   help="погашать настоящие токены (нужен DATABASE_URL; по умолчанию — если он задан)")
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="доп. переменные для бота")
+    p.add_argument("--tg-port", type=int, default=18081)
+    p.add_argument("--llm-port", type=int, default=18082)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--save", help="записать результат в JSON")
+    p.add_argument("--baseline", help="сравнить с сохранённым результатом")
+    p.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение относительно baseline")
+    opts = p.parse_args(argv)
+    opts.tokens = opts.tokens or bool(os.getenv("DATABASE_URL"))
+    opts.run_id = uuid.uuid4().hex[:8]
+    return opts
+
+
+def main(argv=None):
+    opts = parse_args(argv)
+    res = asyncio.run(run(opts))
+    print_report(res)
+    if opts.save:
+        with open(opts.save, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+    if opts.baseline:
+        with open(opts.baseline, encoding="utf-8") as f:
+            problems = compare(res, json.load(f), opts.tolerance)
+        if problems:
+            print("\nРЕГРЕССИЯ:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("\nрегрессий нет")
+
+
+if __name__ == "__main__":
+    main()
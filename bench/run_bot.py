@@ -0,0 +1,60 @@
+"""Бот для нагрузочного теста: настоящие хендлеры и polling, но Bot API и OpenAI — заглушки.
+
+Запускается из bench/loadtest.py отдельным процессом (адреса заглушек — в TG_API_URL и
+OPENAI_API_BASE). Без DATABASE_URL вместо Postgres работает «БД в памяти»: сессии в SQLite
+:memory:, доступ виртуальным пользователям выдаётся сразу в кэш доступа. С DATABASE_URL —
+полный старт с миграциями, а пользователям выписываются настоящие токены.
+"""
+import logging
+import os
+
+import bot
+import config
+import metrics
+from access_cache import access_cache
+from db import db_run, db_run_many
+
+USER_BASE = int(os.environ["BENCH_USER_BASE"])
+USERS = int(os.environ["BENCH_USERS"])
+RUN_ID = os.environ["BENCH_RUN_ID"]
+
+
+def bench_token(uid: int) -> str:
+    return f"bench-{RUN_ID}-{uid}"
+
+
+async def memory_post_init(app):
+    bot.mark_startup("app_initialized")
+    if config.METRICS_PORT:
+        await metrics.serve()  # процесс живёт ровно один прогон — runner не закрываем
+    bot.sessions.start()
+    for uid in range(USER_BASE, USER_BASE + USERS):
+        access_cache.put(uid, config.BOT_NAME, True)
+    bot.mark_startup("ready")
+    logging.getLogger("bench").info("startup: %s", bot.startup_marks)
+
+
+async def postgres_post_init(app):
+    await bot.post_init(app)
+    uids = list(range(USER_BASE, USER_BASE + USERS))
+    # каждый прогон проходит путь /start с токеном с нуля
+    await db_run("DELETE FROM allowed_users WHERE bot_name=%s AND user_id = ANY(%s)", (config.BOT_NAME, uids))
+    await db_run_many(
+        "INSERT INTO tokens(token, bot_name, user_id) VALUES(%s,%s,%s) ON CONFLICT DO NOTHING",
+        [(bench_token(uid), config.BOT_NAME, uid) for uid in uids],
+    )
+    for uid in uids:
+        access_cache.invalidate(uid, config.BOT_NAME)
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.WARNING)
+    logging.getLogger("bench").setLevel(logging.INFO)
+    logging.getLogger("bot").setLevel(logging.INFO)
+    app = bot.build_application()
+    app.post_init = postgres_post_init if config.DATABASE_URL else memory_post_init
+    app.run_polling(poll_interval=0.0, timeout=10)
+
+
+if __name__ == "__main__":
+    main()
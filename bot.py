@@ -1,147 +1,101 @@
-import os
-from datetime import datetime
+import time
+
+_STARTUP_T0 = time.perf_counter()
+
+import asyncio
+import logging
+import csv
+import io
 import secrets
-import sqlite3 
+import sys
+from datetime import datetime, timedelta, timezone
 
-from dotenv import load_dotenv
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile, Update
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler,
+    Application, ApplicationBuilder, CommandHandler,
     CallbackQueryHandler, MessageHandler, filters, ContextTypes
 )
 
-# если используешь openai — оставь свой импорт
-import openai
-
-# БД (psycopg v3)
-import psycopg
-from psycopg.rows import dict_row
-
-load_dotenv()
-
-openai.api_key = os.getenv("OPENAI_API_KEY")
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID"))
-DATABASE_URL = os.getenv("DATABASE_URL")
-BOT_NAME = os.getenv("MAIN_BOT_USERNAME", "jtbd_assistant_bot")
-
-# ---------- БД: одно подключение + авто-переподключение ----------
-conn = None
-
-def _open_conn():
-    """Открыть (или переоткрыть) соединение с БД."""
-    global conn
-    if conn is not None:
-        try:
-            if conn.closed:  # для psycopg v3
-                conn = None
-        except Exception:
-            conn = None
-    if conn is None:
-        conn = psycopg.connect(
-            DATABASE_URL,
-            autocommit=True,
-            sslmode="require",
-            row_factory=dict_row,
-            keepalives=1,
-            keepalives_idle=30,
-            keepalives_interval=10,
-            keepalives_count=5,
-        )
-    return conn
-
-# ---------- БД: подключение «на каждый запрос» + один ретрай ----------
-def db_run(sql: str, args: tuple = (), fetch: str | None = None):
-    """
-    Выполнить SQL с новым подключением.
-    fetch=None -> execute (без fetch)
-    fetch='one' -> fetchone()
-    fetch='all' -> fetchall()
-    """
-    try:
-        with psycopg.connect(
-            DATABASE_URL,
-            sslmode="require",
-            autocommit=True,
-            row_factory=dict_row,
-            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=5
-        ) as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, args)
-                if fetch == "one":
-                    return cur.fetchone()
-                if fetch == "all":
-                    return cur.fetchall()
-                return None
-    except psycopg.OperationalError:
-        # единичный повтор при обрыве соединения
-        with psycopg.connect(
-            DATABASE_URL,
-            sslmode="require",
-            autocommit=True,
-            row_factory=dict_row,
-            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=5
-        ) as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, args)
-                if fetch == "one":
-                    return cur.fetchone()
-                if fetch == "all":
-                    return cur.fetchall()
-                return None
-# ---------- конец блока БД ----------
-
-# Таблицы те же, что у кассира
-db_run("""CREATE TABLE IF NOT EXISTS tokens(
-  token TEXT PRIMARY KEY,
-  bot_name TEXT NOT NULL,
-  user_id BIGINT NOT NULL,
-  expires_at TIMESTAMPTZ NULL
-);""")
-
-db_run("""CREATE TABLE IF NOT EXISTS allowed_users(
-  user_id BIGINT NOT NULL,
-  bot_name TEXT NOT NULL,
-  PRIMARY KEY(user_id, bot_name)
-);""")
-
-db_run("ALTER TABLE tokens ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ NULL;")
-
-# ---------- SQLite: ДОСТУП ЧЕРЕЗ ТОКЕН ----------
-
-DB_PATH = "tokens.db"
-
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS tokens (
-            token TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            used INTEGER DEFAULT 0
-        )
-        """)
-init_db()
-
-def create_token(user_id):
-    token = secrets.token_urlsafe(8)
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("INSERT INTO tokens (token, user_id, used) VALUES (?, ?, 0)", (token, user_id))
-    return token
-
-def validate_token(token, user_id):
-    with sqlite3.connect(DB_PATH) as conn:
-        res = conn.execute(
-            "SELECT used, user_id FROM tokens WHERE token = ?", (token,)
-        ).fetchone()
-        if not res:
-            return False, "Неверный токен."
-        used, db_uid = res
-        if used:
-            return False, "Токен уже использован."
-        if db_uid != user_id:
-            return False, "Нет доступа. Этот токен для другого пользователя."
-        conn.execute("UPDATE tokens SET used = 1 WHERE token = ?", (token,))
-        return True, None
+import config
+from config import BOT_TOKEN, BOT_NAME, ADMIN_ID
+import db
+from db import db_run, db_run_many, open_pool, close_pool
+import llm
+from streaming import StreamingReply
+from session import Session, Stage
+from session_store import make_store
+from segment_fanout import SegmentError, fan_out, parse_titles
+from single_flight import SingleFlight, inputs_hash
+from resilience import CircuitOpen
+from gen_cache import gen_cache
+from send_queue import Priority, make_scheduler
+from html_chunker import split_html
+from prompt_budget import add_product_digest, build_interview_digest, context_for_prompt, ensure_digest
+from access_cache import access_cache, listen_revocations
+import artifacts
+import jobs
+import metrics
+import migrations
+from chat_dispatch import ChatOrderedApplication
+
+log = logging.getLogger(__name__)
+
+# ---------- ВЫДАЧА ТОКЕНОВ (общая таблица tokens в Postgres, её же читает погашение) ----------
+
+def deep_link(token: str) -> str:
+    return f"https://t.me/{BOT_NAME}?start={token}"
+
+async def issue_tokens(rows: list[tuple[int, datetime | None]]) -> list[tuple[int, str, datetime | None]]:
+    """Выдать токены пачкой: rows — (user_id, expires_at); одна транзакция executemany."""
+    issued = [(uid, secrets.token_urlsafe(12), exp) for uid, exp in rows]
+    await db_run_many(
+        "INSERT INTO tokens(token, bot_name, user_id, expires_at) VALUES(%s,%s,%s,%s)",
+        [(token, BOT_NAME, uid, exp) for uid, token, exp in issued],
+    )
+    return issued
+
+def _parse_expiry(value: str) -> datetime | None:
+    """'30' — дней от сейчас, '2025-12-31' — дата (UTC), пусто — бессрочно."""
+    value = value.strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return datetime.now(timezone.utc) + timedelta(days=int(value))
+    exp = datetime.fromisoformat(value)
+    return exp if exp.tzinfo else exp.replace(tzinfo=timezone.utc)
+
+def parse_token_requests(args: list[str], csv_text: str | None) -> tuple[list[tuple[int, datetime | None]], list[str]]:
+    """ID из аргументов команды и/или CSV (user_id[,срок]); days=N — срок по умолчанию.
+    Возвращает (строки, нераспознанное)."""
+    default_exp = None
+    ids = []
+    bad = []
+    for arg in args:
+        if arg.startswith("days="):
+            default_exp = _parse_expiry(arg[len("days="):])
+        else:
+            ids.extend(part for part in arg.split(",") if part)
+    rows = []
+    for part in ids:
+        if part.isdigit():
+            rows.append((int(part), default_exp))
+        else:
+            bad.append(part)
+    if csv_text:
+        for line in csv.reader(io.StringIO(csv_text)):
+            if not line or not line[0].strip():
+                continue
+            uid = line[0].strip()
+            if not uid.isdigit():
+                bad.append(uid)  # заголовок или мусор
+                continue
+            try:
+                exp = _parse_expiry(line[1]) if len(line) > 1 and line[1].strip() else default_exp
+            except ValueError:
+                bad.append(",".join(line))
+                continue
+            rows.append((int(uid), exp))
+    return rows, bad
 
 # ---------- ДАННЫЕ ----------
 WELCOME = (
@@ -179,46 +133,128 @@ PRODUCT_Q = [
     "4. Какой главный результат получает человек после взаимодействия с тобой или твоим продуктом?"
 ]
 
+# Короткие подписи вопросов для дайджеста контекста (prompt_budget.py)
+INTERVIEW_LABELS = [
+    "Опыт", "Вдохновение", "Ценности", "Миссия", "Главное достижение",
+    "Черты характера", "Принципы", "Близкие темы", "Знания и навыки", "Какие проблемы решает",
+    "Как хочет восприниматься", "Эмоции аудитории", "Отличия в нише", "Образ в соцсетях", "Что должны говорить после"
+]
+
+PRODUCT_LABELS = ["Суть", "Чем помогает", "Отличие", "Результат клиента"]
+
 MAIN_MENU = [
     ("📱 BIO", "bio"),
     ("🎯 Продукт / Услуга", "product"),
     ("🔍 Анализ ЦА", "jtbd")
 ]
 
-sessions = {}
+# Сессии: LRU в памяти + отложенная запись в БД (см. session_store.py)
+sessions = make_store()
+results = artifacts.make_store()  # готовые результаты для /myresults
 
-def is_allowed(user_id: int) -> bool:
-    row = db_run(
-        "SELECT 1 FROM allowed_users WHERE user_id=%s AND bot_name=%s",
-        (user_id, BOT_NAME),
-        fetch="one",
-    )
-    return row is not None
+# Версия шаблонов промптов: входит в ключ кэша генераций — поднимай при правке промптов
+PROMPT_VERSION = 2
 
-def try_accept_token(user_id: int, token: str) -> tuple[bool, str]:
+async def is_allowed(user_id: int, fresh: bool = False) -> bool:
+    """fresh=True — мимо кэша доступа, прямо из БД."""
+    cached = None if fresh else access_cache.get(user_id, BOT_NAME)
+    if cached is not None:
+        return cached
+    try:
+        row = await db_run(
+            "SELECT 1 FROM allowed_users WHERE user_id=%s AND bot_name=%s",
+            (user_id, BOT_NAME),
+            fetch="one",
+        )
+    except Exception as e:
+        # БД недоступна — отвечаем последним известным значением, даже протухшим
+        stale = access_cache.peek(user_id, BOT_NAME)
+        if stale is None or not db.unavailable(e):
+            raise
+        log.warning("is_allowed(%s): БД недоступна (%s), ответ из кэша: %s", user_id, e, stale)
+        return stale
+    allowed = row is not None
+    access_cache.put(user_id, BOT_NAME, allowed)
+    return allowed
+
+# Погашение токена одним атомарным запросом: проверка бота и срока, выдача доступа
+# и удаление токена. Строка токена блокируется (FOR UPDATE), поэтому двойной клик
+# не погасит токен дважды — второй запрос увидит его уже удалённым.
+REDEEM_TOKEN_SQL = """
+WITH t AS (
+    SELECT token, bot_name, expires_at FROM tokens WHERE token = %(token)s FOR UPDATE
+), burn AS (
+    DELETE FROM tokens USING t
+    WHERE tokens.token = t.token
+      AND t.bot_name = %(bot)s
+      AND (t.expires_at IS NULL OR t.expires_at > now())
+    RETURNING tokens.token
+), grant_access AS (
+    INSERT INTO allowed_users(user_id, bot_name)
+    SELECT %(uid)s, %(bot)s FROM burn
+    ON CONFLICT DO NOTHING
+)
+SELECT CASE
+    WHEN NOT EXISTS (SELECT 1 FROM t) THEN 'not_found'
+    WHEN EXISTS (SELECT 1 FROM burn) THEN 'ok'
+    WHEN (SELECT bot_name FROM t) <> %(bot)s THEN 'wrong_bot'
+    ELSE 'expired'
+END AS status
+"""
+
+REDEEM_MESSAGES = {
+    "ok": "✅ Доступ активирован. Можно пользоваться ботом.",
+    "not_found": "⛔ Ссылка недействительна или уже активирована.",
+    "wrong_bot": "⛔ Этот токен выдан для другого бота.",
+    "expired": "⛔ Срок действия ссылки истёк. Попросите кассира выдать новую.",
+}
+
+async def try_accept_token(user_id: int, token: str) -> tuple[bool, str]:
     if not token:
         return False, "⛔ Доступ по персональной ссылке. Попросите кассира выдать доступ."
 
-    row = db_run("SELECT * FROM tokens WHERE token=%s", (token,), fetch="one")
-    if not row:
-        return False, "⛔ Ссылка недействительна или уже активирована."
-
-    if row["bot_name"] != BOT_NAME:
-        return False, "⛔ Этот токен выдан для другого бота."
-
-    exp = row.get("expires_at")
-    if exp and datetime.utcnow() > exp.replace(tzinfo=None):
-        return False, "⛔ Срок действия ссылки истёк. Попросите кассира выдать новую."
-
-    # OK — фиксируем доступ и сжигаем токен
-    db_run(
-        "INSERT INTO allowed_users(user_id, bot_name) VALUES(%s,%s) ON CONFLICT DO NOTHING",
-        (user_id, BOT_NAME)
-    )
-    db_run("DELETE FROM tokens WHERE token=%s", (token,))
-    return True, "✅ Доступ активирован. Можно пользоваться ботом."
-# Если хочешь, чтобы админ всегда проходил, задай ADMIN_ID в .env и раскомментируй
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
+    try:
+        row = await db_run(REDEEM_TOKEN_SQL, {"token": token, "bot": BOT_NAME, "uid": user_id}, fetch="one")
+    except Exception as e:
+        if not db.unavailable(e):
+            raise
+        log.warning("Погашение токена для %s: БД недоступна (%s)", user_id, e)
+        return False, "⚠️ Сейчас не получается проверить ссылку — попробуй открыть её ещё раз через минуту."
+    status = row["status"]
+    # двойной клик: токен уже погашен параллельным запросом этого же пользователя
+    if status == "not_found" and await is_allowed(user_id, fresh=True):
+        status = "ok"
+    if status == "ok":
+        access_cache.put(user_id, BOT_NAME, True)
+    return status == "ok", REDEEM_MESSAGES[status]
+
+async def sweep_expired_tokens():
+    """Фоновая задача: удаляет просроченные токены пачками по TOKEN_SWEEP_BATCH."""
+    while True:
+        try:
+            total = 0
+            while True:
+                row = await db_run(
+                    """WITH d AS (
+                        DELETE FROM tokens WHERE token IN (
+                            SELECT token FROM tokens
+                            WHERE expires_at < now() - make_interval(secs => %s)
+                            ORDER BY expires_at LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        ) RETURNING 1
+                    ) SELECT count(*) AS n FROM d""",
+                    (config.TOKEN_SWEEP_GRACE, config.TOKEN_SWEEP_BATCH),
+                    fetch="one",
+                )
+                total += row["n"]
+                if row["n"] < config.TOKEN_SWEEP_BATCH:
+                    break
+                await asyncio.sleep(0.5)  # не держим БД, кассир тоже пишет в tokens
+            if total:
+                log.info("tokens: удалено просроченных: %s", total)
+        except Exception as e:
+            log.warning("tokens: очистка не удалась: %s", e)
+        await asyncio.sleep(config.TOKEN_SWEEP_INTERVAL)
 
 def _uid_from_update(update):
     if getattr(update, "effective_user", None):
@@ -235,7 +271,7 @@ def require_access(fn):
         if ADMIN_ID and uid == ADMIN_ID:
             return await fn(update, context, *args, **kwargs)
         # /start обрабатывается отдельно (там принимаем токен), сюда не навешиваем
-        if uid is None or not is_allowed(uid):
+        if uid is None or not await is_allowed(uid):
             # Ответ в зависимости от типа апдейта
             if getattr(update, "message", None):
                 await update.message.reply_text("⛔ Доступ не активирован. Откройте бота по персональной ссылке от кассира.")
@@ -245,19 +281,19 @@ def require_access(fn):
         return await fn(update, context, *args, **kwargs)
     return wrapper
 
-def ensure_allowed_or_reply(update, ctx) -> bool:
+async def ensure_allowed_or_reply(update, ctx) -> bool:
     if update is None:
         return True  # ⬅️ ОБЯЗАТЕЛЬНО
 
     uid = update.effective_user.id
-    if is_allowed(uid):
+    if await is_allowed(uid):
         return True
 
     try:
         if update.message:
-            ctx.bot.send_message(chat_id=uid, text="⛔ Доступ не активирован...")
+            await ctx.bot.send_message(chat_id=uid, text="⛔ Доступ не активирован...")
         elif update.callback_query:
-            ctx.bot.send_message(chat_id=uid, text="⛔ Доступ не активирован...")
+            await ctx.bot.send_message(chat_id=uid, text="⛔ Доступ не активирован...")
     except:
         pass
 
@@ -269,12 +305,13 @@ def ensure_allowed_or_reply(update, ctx) -> bool:
 from telegram import Update
 from telegram.ext import ContextTypes
 
+@metrics.track_handler
 async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     args = ctx.args or []
 
     # Если пользователь уже авторизован
-    if is_allowed(uid):
+    if await is_allowed(uid):
         await update.message.reply_text("🔓 Доступ уже активирован.")
         
         # Приветствие и кнопка "Начать распаковку"
@@ -286,15 +323,14 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
 
         # Создаём или сбрасываем сессию
-        sessions[uid] = {
-            "stage": "welcome",
-            "answers": []
-        }
+        cancel_pending_comment(uid)
+        cancel_partials(uid)
+        sessions.set(uid, Session())
         return
 
     # Если доступ ещё не активирован — проверяем токен
     token = args[0] if args else ""
-    ok, msg = try_accept_token(uid, token)
+    ok, msg = await try_accept_token(uid, token)
     await update.message.reply_text(msg)
 
     if ok:
@@ -307,10 +343,7 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
 
         # Создаём сессию
-        sessions[uid] = {
-            "stage": "welcome",
-            "answers": []
-        }
+        sessions.set(uid, Session())
         return
     else:
         return
@@ -318,7 +351,7 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 
     token = args[0] if args else ""
-    ok, msg = try_accept_token(uid, token)
+    ok, msg = await try_accept_token(uid, token)
     await update.message.reply_text(msg)
 
     if ok:
@@ -327,6 +360,13 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     else:
         return
 
+GENTOKEN_USAGE = (
+    "Используй:\n"
+    "/gentoken user_id [user_id ...] [days=N]\n"
+    "или пришли CSV (user_id[,срок в днях или дата]) с подписью /gentoken — либо ответь /gentoken на такой файл."
+)
+
+@metrics.track_handler
 async def gentoken(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     user_id = update.effective_user.id
@@ -335,35 +375,164 @@ async def gentoken(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await ctx.bot.send_message(chat_id=cid, text="⛔️ Только для администратора.")
         return
 
-    if not ctx.args or not ctx.args[0].isdigit():
-        await ctx.bot.send_message(chat_id=cid, text="Используй: /gentoken user_id (числовой Telegram ID)")
+    msg = update.message
+    # команда в подписи к файлу приходит без ctx.args
+    args = ctx.args if ctx.args is not None else (msg.caption or "").split()[1:]
+    doc = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    csv_text = None
+    if doc:
+        data = await (await doc.get_file()).download_as_bytearray()
+        csv_text = bytes(data).decode("utf-8-sig", errors="replace")
+
+    try:
+        rows, bad = parse_token_requests(args, csv_text)
+    except ValueError:
+        await ctx.bot.send_message(chat_id=cid, text=GENTOKEN_USAGE)
+        return
+    if not rows:
+        await ctx.bot.send_message(chat_id=cid, text=GENTOKEN_USAGE)
+        return
+    if len(rows) > config.GENTOKEN_MAX_BATCH:
+        await ctx.bot.send_message(chat_id=cid, text=f"⛔️ Не больше {config.GENTOKEN_MAX_BATCH} ID за раз.")
         return
 
-    target_id = int(ctx.args[0])
-    token = create_token(target_id)
-    link = f"https://t.me/{MAIN_BOT_USERNAME}?start={token}"
+    issued = await issue_tokens(rows)
+    skipped = f"\n⚠️ Пропущено нераспознанных строк: {len(bad)}" if bad else ""
 
-    await ctx.bot.send_message(
+    if len(issued) == 1:
+        uid, token, exp = issued[0]
+        until = f"\n⏳ Действует до {exp:%Y-%m-%d %H:%M} UTC" if exp else ""
+        await ctx.bot.send_message(
+            chat_id=cid,
+            text=f"✅ Токен сгенерирован: <code>{token}</code>\n"
+                 f"🔗 Ссылка для пользователя:\n{deep_link(token)}{until}{skipped}",
+            parse_mode="HTML"
+        )
+        return
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["user_id", "token", "link", "expires_at"])
+    for uid, token, exp in issued:
+        writer.writerow([uid, token, deep_link(token), exp.isoformat() if exp else ""])
+    await ctx.bot.send_document(
         chat_id=cid,
-        text=f"✅ Токен сгенерирован: <code>{token}</code>\n"
-             f"🔗 Ссылка для пользователя:\n{link}",
-        parse_mode="HTML"
+        document=InputFile(io.BytesIO(out.getvalue().encode("utf-8")), filename=f"tokens_{len(issued)}.csv"),
+        caption=f"✅ Выдано токенов: {len(issued)}{skipped}",
     )
 
+# ---------- МОИ РЕЗУЛЬТАТЫ (artifacts.py) ----------
+ARTIFACT_TITLES = {
+    "unpacking": "✅ Распаковка",
+    "positioning": "🎯 Позиционирование",
+    "bio": "📱 Варианты BIO",
+    "product": "📝 Краткий анализ продукта",
+    "jtbd": "🎯 Основные сегменты ЦА",
+    "jtbd_more": "🔍 Дополнительные неочевидные сегменты",
+}
+
+@metrics.track_handler
+async def myresults(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not await ensure_allowed_or_reply(update, ctx):
+        return
+    await send_results_page(ctx.bot, update.effective_chat.id)
+
+async def send_results_page(bot, cid, offset=0):
+    """Сохранённые результаты — от новых к старым, по MYRESULTS_PAGE_SIZE за раз, без LLM."""
+    try:
+        items, total = await results.page(cid, offset, config.MYRESULTS_PAGE_SIZE)
+    except Exception as e:
+        log.warning("myresults для %s: %s", cid, e)
+        await bot.send_message(chat_id=cid, text="⚠️ Сейчас не получается достать результаты. Попробуй чуть позже.")
+        return
+    if not items:
+        await bot.send_message(
+            chat_id=cid,
+            text="Больше сохранённых результатов нет." if offset else
+                 "Пока нет сохранённых результатов — они появятся после распаковки."
+        )
+        return
+    for item in items:
+        title = ARTIFACT_TITLES.get(item.kind, item.kind)
+        await send_long_message(bot, cid, f"{title} (версия {item.version}, {item.created_at:%d.%m.%Y}):\n\n{item.text}")
+    shown = offset + len(items)
+    if shown < total:
+        await bot.send_message(
+            chat_id=cid,
+            text=f"Показано {shown} из {total}.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Показать ещё", callback_data=f"myresults:{shown}")]])
+        )
+
+# ---------- SINGLE-FLIGHT ДОРОГИХ КНОПОК (single_flight.py) ----------
+# data кнопки -> действие: разные кнопки, запускающие одну и ту же генерацию, — одно действие
+EXPENSIVE_ACTIONS = {
+    "bio": "bio",
+    "jtbd": "jtbd", "finish_products": "jtbd", "jtbd_again": "jtbd",
+    "jtbd_more": "jtbd_more",
+    "retry_unpack": "interview",
+}
+
+flights = SingleFlight(config.SINGLE_FLIGHT_TTL)
+# update_id тапа -> хэш входов полёта, который этот тап начал: закончит его хендлер (или on_done)
+_tap_flights: dict[int, str | None] = {}
+
+def dedupe_tap(app, update) -> bool:
+    """До очереди чата: повтор дорогой кнопки, пока идёт её генерация, гасим ответом «уже готовлю»."""
+    query = getattr(update, "callback_query", None)
+    if query is None or query.data not in EXPENSIVE_ACTIONS:
+        return False
+    cid = update.effective_chat.id
+    sess = sessions.peek(cid)
+    # холодная сессия: входы неизвестны, но полёт регистрируем — иначе второй тап тоже пройдёт
+    digest = inputs_hash(sess.answers, sess.products) if sess is not None else None
+    if not flights.join(cid, EXPENSIVE_ACTIONS[query.data], digest):
+        _tap_flights[update.update_id] = digest
+        return False
+    app.create_task(query.answer("⏳ Уже готовлю — результат придёт в чат"), update=update)
+    return True
+
+def release_dropped_tap(cid: int, update):
+    """Очередь чата отбросила тап — хендлер не запустится и полёт сам не закончит."""
+    query = getattr(update, "callback_query", None)
+    if query is not None and update.update_id in _tap_flights:
+        flights.done(cid, EXPENSIVE_ACTIONS[query.data], _tap_flights.pop(update.update_id), handler=True)
+
+def tap_flight(update) -> str | None:
+    """Хэш входов полёта, начатого этим тапом (передаётся в задачу, чтобы её on_done закончил полёт)."""
+    return _tap_flights.get(update.update_id)
+
+@metrics.track_handler
 async def callback_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if not ensure_allowed_or_reply(update=None, ctx=ctx):
+    data = update.callback_query.data
+    try:
+        await _callback(update, ctx, data)
+    finally:
+        # полёт, начатый dedupe_tap; ушедший в очередь задач закончит on_done
+        if update.update_id in _tap_flights:
+            flights.done(update.effective_chat.id, EXPENSIVE_ACTIONS[data], _tap_flights.pop(update.update_id),
+                         handler=True)
+
+async def _callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE, data: str):
+    if not await ensure_allowed_or_reply(update=None, ctx=ctx):
         return
     cid = update.effective_chat.id
     query = update.callback_query
-    data = query.data
-    sess = sessions.get(cid)
+    sess = await sessions.get(cid)
     await query.answer()
-    if not sess:
+    if data.startswith("myresults:"):
+        await send_results_page(ctx.bot, cid, int(data.split(":", 1)[1]))
+        return
+    if not sess or await resolve_stale_generation(ctx.bot, cid, sess):
+        return
+
+    # --- Повтор распаковки после сбоя генерации ---
+    if sess.stage == Stage.INTERVIEW and data == "retry_unpack" and len(sess.answers) >= len(INTERVIEW_Q):
+        await finish_interview(cid, sess, ctx)
         return
 
     # --- Согласие ---
-    if sess["stage"] == "welcome" and data == "agree":
-        sess["stage"] = "interview"
+    if sess.stage == Stage.WELCOME and data == "agree":
+        sess.stage = Stage.INTERVIEW
         await ctx.bot.send_message(
             chat_id=cid,
             text="✅ Начинаем распакову личности!\n\nЯ задам тебе 15 вопросов — отвечай подробно и честно 👇"
@@ -372,40 +541,41 @@ async def callback_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
 
     # --- BIO по кнопке ---
-    if sess["stage"] in ("done_interview", "product_finished", "jtbd_done", "done_bio") and data == "bio":
-        sess["stage"] = "bio"
-        await generate_bio(cid, sess, ctx)
+    if sess.stage in (Stage.DONE_INTERVIEW, Stage.PRODUCT_FINISHED, Stage.JTBD_DONE, Stage.DONE_BIO) and data == "bio":
+        prev_stage, sess.stage = sess.stage, Stage.BIO
+        await generate_bio(cid, sess, ctx, prev_stage)
         return
 
     # --- Переход к продукту ---
-    if sess["stage"] in ("done_interview", "done_bio", "jtbd_done", "product_finished") and data == "product":
-        sess["stage"] = "product_ask"
-        sess["product_answers"] = []
+    if sess.stage in (Stage.DONE_INTERVIEW, Stage.DONE_BIO, Stage.JTBD_DONE, Stage.PRODUCT_FINISHED) and data == "product":
+        sess.stage = Stage.PRODUCT_ASK
+        sess.product_answers = []
         await ctx.bot.send_message(chat_id=cid, text=PRODUCT_Q[0])
         return
 
     # --- Следующий продукт (мультипродукт!) ---
-    if sess["stage"] == "product_finished" and data == "add_product":
-        sess["stage"] = "product_ask"
-        sess["product_answers"] = []
+    if sess.stage == Stage.PRODUCT_FINISHED and data == "add_product":
+        sess.stage = Stage.PRODUCT_ASK
+        sess.product_answers = []
         await ctx.bot.send_message(chat_id=cid, text="Окей! Расскажи о новом продукте 👇\n" + PRODUCT_Q[0])
         return
 
-    if sess["stage"] == "product_finished" and data == "finish_products":
+    if sess.stage == Stage.PRODUCT_FINISHED and data == "finish_products":
         await ctx.bot.send_message(chat_id=cid, text="Переходим к анализу ЦА...")
-        await start_jtbd(cid, sess, ctx)
+        await start_jtbd(cid, sess, ctx, flight=tap_flight(update))
         return
 
     # --- Переход к JTBD ---
-    if sess["stage"] in ("done_interview", "done_bio", "done_product", "product_finished") and data == "jtbd":
-        await start_jtbd(cid, sess, ctx)
+    if sess.stage in (Stage.DONE_INTERVIEW, Stage.DONE_BIO, Stage.DONE_PRODUCT, Stage.PRODUCT_FINISHED) and data == "jtbd":
+        await start_jtbd(cid, sess, ctx, flight=tap_flight(update))
         return
 
     # JTBD ещё раз или завершить
-    if sess["stage"] == "jtbd_done" and data == "jtbd_again":
-        await start_jtbd(cid, sess, ctx)
+    if sess.stage == Stage.JTBD_DONE and data == "jtbd_again":
+        # явный «ещё раз» — мимо кэша генераций
+        await start_jtbd(cid, sess, ctx, refresh=True, flight=tap_flight(update))
         return
-    if sess["stage"] == "jtbd_done" and data == "finish_unpack":
+    if sess.stage == Stage.JTBD_DONE and data == "finish_unpack":
         await ctx.bot.send_message(
             chat_id=cid,
             text="✅ Распаковка завершена!\n\n"
@@ -414,56 +584,83 @@ async def callback_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if data == "jtbd_more" and sess.get("stage") == "jtbd_first":
-        await handle_more_jtbd(update=None, ctx=ctx)
+    if data == "jtbd_more" and sess.stage == Stage.JTBD_FIRST:
+        await handle_more_jtbd(update=update, ctx=ctx)
         return
 
-    if data == "jtbd_done" and sess.get("stage") == "jtbd_first":
-        await handle_skip_jtbd(update=None, ctx=ctx)
+    if data == "jtbd_done" and sess.stage == Stage.JTBD_FIRST:
+        await handle_skip_jtbd(update=update, ctx=ctx)
         return
 
+@metrics.track_handler
 async def message_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    if not ensure_allowed_or_reply(update=None, ctx=ctx):
+    if not await ensure_allowed_or_reply(update=None, ctx=ctx):
         return
     cid = update.effective_chat.id
-    sess = sessions.get(cid)
+    sess = await sessions.get(cid)
     text = update.message.text.strip()
-    if not sess:
+    if not sess or await resolve_stale_generation(ctx.bot, cid, sess):
         return
 
     # ---------- INTERVIEW FLOW ----------
-    if sess["stage"] == "interview":
-        sess["answers"].append(text)
-        try:
-            comment = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "Ты — поддерживающий коуч. На «ты». Дай короткий комментарий к ответу — по теме, дружелюбно, без вопросов."},
-                    {"role": "user", "content": text}
-                ]
-            )
-            await ctx.bot.send_message(chat_id=cid, text=comment.choices[0].message.content)
-        except Exception as e:
-            await ctx.bot.send_message(chat_id=cid, text="⚠️ Не удалось получить комментарий, но мы продолжаем.")
-            print("OpenAI comment error:", e)
+    if sess.stage == Stage.INTERVIEW:
+        if len(sess.answers) >= len(INTERVIEW_Q):
+            # ответы уже собраны, распаковка не удалась — повтор только кнопкой
+            await ctx.bot.send_message(chat_id=cid, text="Все ответы уже получены — нажми «Повторить распаковку».",
+                                       reply_markup=retry_markup("interview", Stage.INTERVIEW))
+            return
+        # пользователь ответил раньше, чем пришёл прошлый комментарий — он уже не нужен
+        cancel_pending_comment(cid)
+        sess.answers.append(text)
+        idx = len(sess.answers)
+        if config.INTERVIEW_INCREMENTAL:
+            speculate_partial(ctx.application, cid, sess)
+        comment_task = asyncio.ensure_future(coach_comment(text))
+
+        # strict и последний ответ: комментарий строго перед следующим шагом
+        if config.INTERVIEW_COMMENT_MODE == "strict" or idx >= len(INTERVIEW_Q):
+            await deliver_comment(ctx, cid, comment_task, config.COMMENT_DEADLINE, warn=True)
+            comment_task = None
+        else:
+            done, _ = await asyncio.wait({comment_task}, timeout=config.COMMENT_GRACE)
+            if done:
+                await deliver_comment(ctx, cid, comment_task, 0)
+                comment_task = None
 
-        idx = len(sess["answers"])
         if idx < len(INTERVIEW_Q):
-            await ctx.bot.send_message(chat_id=cid, text=INTERVIEW_Q[idx])
+            try:
+                await ctx.bot.send_message(chat_id=cid, text=INTERVIEW_Q[idx])
+            except BaseException:
+                # вопрос не дошёл — комментарий к нему не нужен, иначе он придёт позже сам по себе
+                if comment_task is not None:
+                    comment_task.cancel()
+                cancel_pending_comment(cid)
+                raise
+            if comment_task is not None:
+                # комментарий догонит вопрос ответом на реплику пользователя
+                _pending_comments[cid] = ctx.application.create_task(
+                    deliver_comment(
+                        ctx, cid, comment_task, config.COMMENT_DEADLINE - config.COMMENT_GRACE,
+                        reply_to=update.message.message_id,
+                    ),
+                    update=update,
+                )
         else:
-            print(f"[INFO] Завершаем интервью для cid {cid}")
+            log.info("Завершаем интервью для cid %s", cid)
             await finish_interview(cid, sess, ctx)
         return
 
     # ---------- PRODUCT FLOW с мультипродуктом ----------
-    if sess["stage"] == "product_ask":
-        sess["product_answers"].append(text)
-        idx = len(sess["product_answers"])
+    if sess.stage == Stage.PRODUCT_ASK:
+        sess.product_answers.append(text)
+        idx = len(sess.product_answers)
         if idx < len(PRODUCT_Q):
             await ctx.bot.send_message(chat_id=cid, text=PRODUCT_Q[idx])
         else:
             # Сохраняем продукт (все его ответы)
-            sess.setdefault("products", []).append(sess["product_answers"].copy())
+            sess.products.append(sess.product_answers.copy())
+            if sess.digest is not None:
+                add_product_digest(sess, sess.product_answers, PRODUCT_LABELS)
             await generate_product_analysis(cid, sess, ctx)
             # Спрашиваем: есть ли ещё продукты?
             kb = [
@@ -475,92 +672,423 @@ async def message_handler(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 text="Спасибо! Все ответы по продукту получены.\nХочешь рассказать ещё об одном продукте?",
                 reply_markup=InlineKeyboardMarkup(kb)
             )
-            sess["stage"] = "product_finished"
+            sess.stage = Stage.PRODUCT_FINISHED
         return
 
     # Здесь идут другие этапы, если есть
 
-async def finish_interview(cid, sess, ctx):
-    if not ensure_allowed_or_reply(update=None, ctx=ctx):
-        return
+# ---------- КОММЕНТАРИЙ КОУЧА ----------
+# cid -> задача доставки «опоздавшего» комментария (режим eager)
+_pending_comments: dict[int, asyncio.Task] = {}
+
+# если модель не успела за дедлайн (llm.POLICIES["comment"]) — интервью не ждёт, отвечаем заготовкой
+COACH_CANNED = (
+    "Спасибо, что делишься так открыто — это очень ценно для распаковки 🙌",
+    "Здорово сформулировано! Из таких деталей и складывается твой образ ✨",
+    "Отличный ответ — чувствуется, что это действительно про тебя.",
+    "Спасибо! Это важная часть твоей истории, обязательно её учтём.",
+    "Классно, что это прозвучало — такие вещи и делают бренд живым 💫",
+    "Звучит искренне и по-настоящему — именно это цепляет аудиторию.",
+)
 
-    print(f"[INFO] Генерация распаковки для cid {cid}")
-    answers = "\n".join(sess["answers"])
-    style_note = (
-        "\n\nОбрати внимание: используй стиль, лексику, энергетику и выражения, которые пользователь использовал в своих ответах. "
-        "Пиши в его манере — не переусложняй, не добавляй шаблонные фразы, старайся повторять тональность."
+async def coach_comment(text):
+    return await llm.chat_tiered(
+        [
+            {"role": "system", "content": "Ты — поддерживающий коуч. На «ты». Дай короткий комментарий к ответу — по теме, дружелюбно, без вопросов."},
+            {"role": "user", "content": text}
+        ],
+        purpose="comment",
+        canned=COACH_CANNED,
     )
 
+async def deliver_comment(ctx, cid, comment_task, timeout, reply_to=None, warn=False):
+    """Дождаться комментария не дольше timeout и отправить; опоздавший выбрасывается."""
     try:
-        unpack = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "Ты профессиональный коуч и бренд-стратег. На основе ответов проведи глубокую, подробную распаковку личности: "
-                    "раскрой ценности, жизненные и профессиональные убеждения, сильные стороны, уникальные черты, мотивы, личную историю, "
-                    "цели, миссию, послание для аудитории, триггеры, раскрывающие потенциал. Пиши на русском языке, с деталями и живыми примерами, "
-                    "разбивая по логическим блокам с подзаголовками. Формат — Markdown."
-                    + style_note
-                )
-            },
-            {"role": "user", "content": answers}
-        ],
-        timeout=25  # ⬅️ после ЗАКРЫТИЯ messages обязательно запятая и таймаут
-    )
+        comment = await asyncio.wait_for(comment_task, timeout=max(timeout, 0))
+    except asyncio.CancelledError:
+        comment_task.cancel()
+        raise
+    except CircuitOpen:
+        return  # API модели лежит — комментарий пропускаем, интервью идёт дальше
     except Exception as e:
-        await ctx.bot.send_message(chat_id=cid, text="⚠️ Ошибка при генерации распаковки:\n" + str(e))
+        if warn:
+            await ctx.bot.send_message(chat_id=cid, text="⚠️ Не удалось получить комментарий, но мы продолжаем.")
+        log.warning("OpenAI comment error: %r", e)
         return
+    finally:
+        if _pending_comments.get(cid) is asyncio.current_task():
+            del _pending_comments[cid]
+    await ctx.bot.send_message(chat_id=cid, text=comment, reply_to_message_id=reply_to)
+
+def cancel_pending_comment(cid):
+    task = _pending_comments.pop(cid, None)
+    if task is not None:
+        task.cancel()
+
+INTERVIEW_STYLE_NOTE = (
+    "\n\nОбрати внимание: используй стиль, лексику, энергетику и выражения, которые пользователь использовал в своих ответах. "
+    "Пиши в его манере — не переусложняй, не добавляй шаблонные фразы, старайся повторять тональность."
+)
 
-    unpack_text = unpack.choices[0].message.content
-    sess["unpacking"] = unpack_text
-    await send_long_message(ctx, cid, "✅ Твоя распаковка:\n\n" + unpack_text)
+# ---------- РАСПАКОВКА ПО БЛОКАМ (пока идёт интервью) ----------
+# Ответы делятся на блоки по INTERVIEW_BLOCK. Закрытый блок (кроме последнего) сразу уходит
+# в фон на частичную распаковку; в конце остаётся один короткий вызов — последний блок и итог.
+# Частичная распаковка привязана к хэшу ответов блока: после /start она не подойдёт.
+# Только в режиме inline: в режиме queue генерирует воркер в другом процессе, и все блоки
+# он пишет сам, параллельно. Фоновые блоки занимают не больше UNPACK_PART_CONCURRENCY слотов
+# LLM_MAX_INFLIGHT — комментариям коуча слоты остаются.
+UNPACK_BLOCK_TITLES = ["Опыт, ценности и миссия", "Характер, принципы и сильные стороны", "Образ и послание для аудитории"]
+
+# cid -> {номер блока: фоновая задача}
+_partial_tasks: dict[int, dict[int, asyncio.Task]] = {}
+_partial_limit: asyncio.Semaphore | None = None
+
+def interview_blocks() -> list[tuple[int, int]]:
+    size = max(config.INTERVIEW_BLOCK, 1)
+    return [(i, min(i + size, len(INTERVIEW_Q))) for i in range(0, len(INTERVIEW_Q), size)]
+
+def _block_title(block: int) -> str:
+    return UNPACK_BLOCK_TITLES[block] if block < len(UNPACK_BLOCK_TITLES) else f"Блок {block + 1}"
+
+def _labelled(answers: list[str], start: int) -> str:
+    return "\n".join(f"{INTERVIEW_LABELS[start + i]}: {a}" for i, a in enumerate(answers))
+
+def partial_unpack_messages(block: int, answers: list[str]) -> list[dict]:
+    start, _ = interview_blocks()[block]
+    return [
+        {
+            "role": "system",
+            "content": (
+                f"Ты профессиональный коуч и бренд-стратег. Это часть распаковки личности — блок «{_block_title(block)}». "
+                "По ответам этого блока раскрой то, что в них видно: ценности, убеждения, сильные стороны, уникальные черты, мотивы, "
+                "личную историю. Пиши на русском языке, с деталями и живыми примерами, 2–4 подзаголовка. "
+                "Без вступления и без общих выводов — итог будет в конце распаковки. Формат — Markdown."
+                + INTERVIEW_STYLE_NOTE
+            )
+        },
+        {"role": "user", "content": _labelled(answers, start)}
+    ]
+
+def final_unpack_messages(answers: list[str], previous: str) -> list[dict]:
+    start, _ = interview_blocks()[-1]
+    prior = ("\n\nУже написанные блоки распаковки (не повторяй их):\n" + previous) if previous else ""
+    return [
+        {
+            "role": "system",
+            "content": (
+                f"Ты профессиональный коуч и бренд-стратег. Это последняя часть распаковки личности — блок «{_block_title(len(interview_blocks()) - 1)}». "
+                "Сначала раскрой ответы этого блока (2–3 подзаголовка), затем допиши раздел «Итог»: цели, миссия, послание для аудитории, "
+                "триггеры, раскрывающие потенциал, — с опорой на все блоки распаковки. Пиши на русском языке, с деталями. Формат — Markdown."
+                + INTERVIEW_STYLE_NOTE
+            )
+        },
+        {"role": "user", "content": _labelled(answers, start) + prior}
+    ]
 
-    # ↓↓↓ Здесь то же самое для позиционирования
+def speculate_partial(app, cid: int, sess):
+    """После ответа, закрывшего блок (кроме последнего), — частичная распаковка в фоне."""
+    if config.JOBS_MODE != "inline":
+        return
+    blocks = interview_blocks()
+    for block, (start, end) in enumerate(blocks[:-1]):
+        if len(sess.answers) == end:
+            answers = list(sess.answers[start:end])
+            task = app.create_task(_run_partial(cid, block, answers))
+            _partial_tasks.setdefault(cid, {})[block] = task
+            return
+
+async def _run_partial(cid: int, block: int, answers: list[str]) -> str | None:
+    global _partial_limit
+    if _partial_limit is None:
+        _partial_limit = asyncio.Semaphore(max(config.UNPACK_PART_CONCURRENCY, 1))
     try:
-        pos = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "Ты бренд-стратег. На основе распаковки личности подробно сформулируй позиционирование на русском языке "
-                    "в развернутом виде — от лица человека (1–2 абзаца о себе), затем детализируй: "
-                    "— основные направления развития\n"
-                    "— ключевые ценности\n"
-                    "— сильные стороны\n"
-                    "— послание для аудитории\n"
-                    "— миссия\n"
-                    "— слоган (1 фраза)\n"
-                    "— цель сообщества (если есть)\n"
-                    "— уникальность и отличия\n"
-                    "— итоговый призыв к действию\n\n"
-                    "Сначала дай общий абзац о человеке, затем — остальные пункты с подзаголовками и списками. Всё на русском, стильно и вдохновляюще. Формат Markdown."
-                    + style_note
-                )
-            },
-            {"role": "user", "content": unpack_text}
-        ],
-        timeout=25  # ⬅️ вот здесь должна быть запятая и timeout
-    )
+        async with _partial_limit:
+            text = await llm.chat(partial_unpack_messages(block, answers), purpose="unpack_part",
+                                  cache_version=PROMPT_VERSION)
     except Exception as e:
-        await ctx.bot.send_message(chat_id=cid, text="⚠️ Ошибка при генерации позиционирования:\n" + str(e))
+        log.info("Частичная распаковка блока %s для cid %s не удалась (%r) — доделаем в конце", block, cid, e)
+        return None
+    sess = await sessions.get(cid)
+    start, end = interview_blocks()[block]
+    if sess is None or sess.answers[start:end] != answers:
+        return None  # сессию начали заново — результат устарел
+    sess.partials[str(block)] = {"h": inputs_hash(answers), "text": text}
+    return text
+
+def cancel_partials(cid: int):
+    for task in _partial_tasks.pop(cid, {}).values():
+        task.cancel()
+
+def collect_partials(sess) -> dict[str, str]:
+    """Готовые частичные распаковки, подходящие к текущим ответам. Недописанные не ждём —
+    их подхватит задача распаковки (incremental_unpack)."""
+    ready = {}
+    for block, (start, end) in enumerate(interview_blocks()[:-1]):
+        entry = sess.partials.get(str(block))
+        if entry and entry["h"] == inputs_hash(sess.answers[start:end]):
+            ready[str(block)] = entry["text"]
+    return ready
+
+async def incremental_unpack(bot, cid: int, answers: list[str], result: dict, checkpoint, *,
+                             on_parts=None) -> str:
+    """Распаковка из частей: недостающие блоки — параллельно, последний блок с итогом — стримом.
+
+    Блок, который ещё пишется в фоне (speculate_partial), ждём не дольше UNPACK_PARTIAL_WAIT,
+    потом пишем заново. on_parts(готовые части) вызывается перед последним блоком.
+    """
+    blocks = interview_blocks()
+    parts = result.setdefault("parts", {})
+    missing = [b for b in range(len(blocks) - 1) if str(b) not in parts]
+    running = _partial_tasks.pop(cid, {})
+
+    async def part(b: int) -> str:
+        task = running.pop(b, None)
+        if task is not None:
+            try:
+                text = await asyncio.wait_for(task, config.UNPACK_PARTIAL_WAIT)
+            except Exception:
+                text = None
+            if text:
+                return text
+        return await llm.chat(partial_unpack_messages(b, answers[blocks[b][0]:blocks[b][1]]),
+                              purpose="unpack_part", cache_version=PROMPT_VERSION)
+
+    try:
+        texts = await asyncio.gather(*(part(b) for b in missing))
+    finally:
+        for task in running.values():
+            task.cancel()
+    if missing:
+        parts.update({str(b): t for b, t in zip(missing, texts)})
+        await checkpoint(result)
+    previous = "\n\n".join(parts[str(b)] for b in range(len(blocks) - 1))
+    if on_parts is not None:
+        on_parts(previous)
+    header = "✅ Твоя распаковка:\n\n"
+    if previous:
+        await send_long_message(bot, cid, header + previous)
+        header = ""
+    last = await generate_to_chat(
+        bot, cid, final_unpack_messages(answers[blocks[-1][0]:], previous),
+        purpose="unpack", cache_version=PROMPT_VERSION, header=header,
+    )
+    return previous + "\n\n" + last if previous else last
+
+async def finish_interview(cid, sess, ctx):
+    if not await ensure_allowed_or_reply(update=None, ctx=ctx):
         return
 
-    positioning_text = pos.choices[0].message.content
-    sess["positioning"] = positioning_text
+    log.info("Генерация распаковки для cid %s", cid)
+    build_interview_digest(sess, INTERVIEW_LABELS)
+    payload = {"answers": sess.answers}
+    if config.INTERVIEW_INCREMENTAL:
+        payload["parts"] = collect_partials(sess)
+    # генерирует воркер очереди (jobs.py); результат применит interview_done
+    await submit_generation(ctx.bot, cid, sess, "interview", payload)
+
+POSITIONING_HEADER = "🎯 Позиционирование:\n\n"
+
+def positioning_messages(source: str) -> list[dict]:
+    return [
+        {
+            "role": "system",
+            "content": (
+                "Ты бренд-стратег. На основе распаковки личности подробно сформулируй позиционирование на русском языке "
+                "в развернутом виде — от лица человека (1–2 абзаца о себе), затем детализируй: "
+                "— основные направления развития\n"
+                "— ключевые ценности\n"
+                "— сильные стороны\n"
+                "— послание для аудитории\n"
+                "— миссия\n"
+                "— слоган (1 фраза)\n"
+                "— цель сообщества (если есть)\n"
+                "— уникальность и отличия\n"
+                "— итоговый призыв к действию\n\n"
+                "Сначала дай общий абзац о человеке, затем — остальные пункты с подзаголовками и списками. Всё на русском, стильно и вдохновляюще. Формат Markdown."
+                + INTERVIEW_STYLE_NOTE
+            )
+        },
+        {"role": "user", "content": source}
+    ]
 
-    await send_long_message(ctx, cid, "🎯 Позиционирование:\n\n" + positioning_text)
+async def run_interview_job(bot, job, checkpoint):
+    """Распаковка, затем позиционирование. Готовая распаковка сохраняется — повтор начнёт с позиционирования.
 
-    sess["stage"] = "done_interview"
+    По блокам (payload["parts"]) позиционирование пишется параллельно с последним блоком
+    распаковки — по готовым частям и ответам последнего блока — и уходит в чат следом за ней:
+    в конце пользователь ждёт один вызов, а не два подряд.
+    """
+    cid = job.chat_id
+    result = dict(job.result)
+    positioning: asyncio.Future | None = None
+    if "unpacking" not in result and "parts" in job.payload:
+        result.setdefault("parts", dict(job.payload["parts"]))
+        answers = job.payload["answers"]
+        last = interview_blocks()[-1][0]
+
+        def start_positioning(previous: str):
+            nonlocal positioning
+            tail = "Ответы последнего блока:\n" + _labelled(answers[last:], last)
+            source = previous + "\n\n" + tail if previous else tail
+            positioning = asyncio.ensure_future(
+                llm.chat(positioning_messages(source), purpose="positioning", cache_version=PROMPT_VERSION)
+            )
+
+        try:
+            result["unpacking"] = await incremental_unpack(bot, cid, answers, result, checkpoint,
+                                                           on_parts=start_positioning)
+        except BaseException:
+            if positioning is not None:
+                positioning.cancel()
+                await asyncio.gather(positioning, return_exceptions=True)
+            raise
+        result.pop("parts")
+        await checkpoint(result)
+    elif "unpacking" not in result:
+        result["unpacking"] = await generate_to_chat(
+            bot, cid,
+            [
+                {
+                    "role": "system",
+                    "content": (
+                        "Ты профессиональный коуч и бренд-стратег. На основе ответов проведи глубокую, подробную распаковку личности: "
+                        "раскрой ценности, жизненные и профессиональные убеждения, сильные стороны, уникальные черты, мотивы, личную историю, "
+                        "цели, миссию, послание для аудитории, триггеры, раскрывающие потенциал. Пиши на русском языке, с деталями и живыми примерами, "
+                        "разбивая по логическим блокам с подзаголовками. Формат — Markdown."
+                        + INTERVIEW_STYLE_NOTE
+                    )
+                },
+                {"role": "user", "content": "\n".join(job.payload["answers"])}
+            ],
+            purpose="unpack",
+            cache_version=PROMPT_VERSION,
+            header="✅ Твоя распаковка:\n\n",
+        )
+        await checkpoint(result)
+
+    if positioning is not None:
+        result["positioning"] = await positioning
+        await send_long_message(bot, cid, POSITIONING_HEADER + result["positioning"])
+    else:
+        result["positioning"] = await generate_to_chat(
+            bot, cid, positioning_messages(result["unpacking"]),
+            purpose="positioning",
+            cache_version=PROMPT_VERSION,
+            header=POSITIONING_HEADER,
+        )
+    return result
+
+# ---------- ЗАПУСК ГЕНЕРАЦИЙ И ЗАВИСШИЕ ЭТАПЫ ----------
+# вид задачи -> (этап на время генерации, этап по умолчанию для возврата)
+GENERATION_STAGES = {
+    "interview": (Stage.UNPACKING, Stage.INTERVIEW),
+    "jtbd": (Stage.JTBD_GENERATING, Stage.PRODUCT_FINISHED),
+    "jtbd_more": (Stage.JTBD_MORE_GENERATING, Stage.JTBD_FIRST),
+}
+_GENERATING = {interim: kind for kind, (interim, _) in GENERATION_STAGES.items()}
+
+async def submit_generation(bot, cid, sess, kind, payload) -> bool:
+    """Перевести сессию в этап генерации и поставить задачу; не вышло — вернуть прошлый этап."""
+    interim = GENERATION_STAGES[kind][0]
+    prev_stage, sess.stage = sess.stage, interim
+    payload["prev_stage"] = prev_stage.value
+    sess.job = {"id": None, "prev": prev_stage.value, "at": time.time()}
+    try:
+        job = await jobs.submit(kind, cid, payload, bot)
+    except Exception as e:
+        log.warning("job %s для чата %s не поставлена: %r", kind, cid, e)
+        if sess.stage == interim:
+            await generation_failed(bot, cid, sess, kind, prev_stage,
+                                    "⚠️ Не получилось запустить генерацию. Попробуй ещё раз чуть позже.")
+        return False
+    if sess.job is not None and job.id is not None:
+        sess.job["id"] = job.id  # inline: задача уже выполнена и применена
+    return True
+
+def retry_markup(kind, prev_stage):
+    if kind == "interview":
+        button = InlineKeyboardButton("🔁 Повторить распаковку", callback_data="retry_unpack")
+    elif kind == "jtbd":
+        button = InlineKeyboardButton("🔁 Повторить анализ ЦА",
+                                      callback_data="jtbd_again" if prev_stage == Stage.JTBD_DONE else "jtbd")
+    else:
+        button = InlineKeyboardButton("🔁 Повторить", callback_data="jtbd_more")
+    return InlineKeyboardMarkup([[button]])
+
+async def generation_failed(bot, cid, sess, kind, prev_stage, text):
+    """Генерация не удалась или потерялась: прошлый этап и кнопка «повторить»."""
+    sess.stage = prev_stage
+    sess.job = None
+    await bot.send_message(chat_id=cid, text=text, reply_markup=retry_markup(kind, prev_stage))
+
+async def resolve_stale_generation(bot, cid, sess) -> bool:
+    """Этап «генерируется», а задачи уже нет: рестарт в режиме inline, потерянный on_done.
+
+    Возвращает True, если генерация действительно идёт — апдейт уже обработан ответом «ещё готовлю».
+    """
+    kind = _GENERATING.get(sess.stage)
+    if kind is None:
+        return False
+    job = sess.job or {}
+    # inline: задача выполняется внутри апдейта этого же чата, а апдейты чата идут по очереди —
+    # раз мы здесь, она уже не выполняется
+    if config.JOBS_MODE == "queue" and job.get("id") and time.time() - job.get("at", 0) < config.JOBS_STALE_AFTER:
+        try:
+            running = await jobs.pending(job["id"])
+        except Exception as e:
+            log.warning("job #%s: состояние неизвестно (%s), считаем, что ещё идёт", job["id"], e)
+            running = True
+        if running:
+            await bot.send_message(chat_id=cid, text="⏳ Ещё готовлю — результат придёт в чат.")
+            return True
+    prev_stage = Stage(job["prev"]) if job.get("prev") else GENERATION_STAGES[kind][1]
+    log.warning("чат %s: этап %s без живой задачи (%s) — возвращаем %s", cid, sess.stage.value, job, prev_stage.value)
+    await generation_failed(bot, cid, sess, kind, prev_stage,
+                            "⚠️ Генерация прервалась. Нажми кнопку, чтобы повторить.")
+    return False
+
+async def job_session(job, interim_stage):
+    """Сессия чата, если она всё ещё ждёт этот результат (а не начата заново через /start)."""
+    sess = await sessions.get(job.chat_id)
+    if not sess or sess.stage != interim_stage or (sess.job or {}).get("id") not in (None, job.id):
+        log.info("job %s #%s: чат %s уже на другом этапе, результат не применяем", job.kind, job.id, job.chat_id)
+        return None
+    sess.job = None
+    return sess
+
+async def interview_done(bot, job):
+    cid = job.chat_id
+    sess = await job_session(job, Stage.UNPACKING)
+    if sess is None:
+        return
+    if "unpacking" in job.result:
+        sess.unpacking = job.result["unpacking"]
+    if job.status != "done":
+        step = "позиционирования" if "unpacking" in job.result else "распаковки"
+        await generation_failed(bot, cid, sess, "interview", Stage(job.payload["prev_stage"]),
+                                f"⚠️ Ошибка при генерации {step}:\n" + (job.last_error or ""))
+        await results.save(cid, "unpacking", job.result.get("unpacking"))
+        return
+
+    sess.positioning = job.result["positioning"]
+    sess.partials = {}  # уже вошли в распаковку
+
+    sess.stage = Stage.DONE_INTERVIEW
     kb = [[InlineKeyboardButton(n, callback_data=c)] for n, c in MAIN_MENU]
-    await ctx.bot.send_message(chat_id=cid, text="Что дальше?", reply_markup=InlineKeyboardMarkup(kb))
+    await bot.send_message(chat_id=cid, text="Что дальше?", reply_markup=InlineKeyboardMarkup(kb))
+    await results.save(cid, "unpacking", job.result["unpacking"])
+    await results.save(cid, "positioning", job.result["positioning"])
 
 # ---------- BIO ----------
-async def generate_bio(cid, sess, ctx):
-    if not ensure_allowed_or_reply(update=None, ctx=ctx):
+def llm_unavailable_text(exc, what):
+    if isinstance(exc, CircuitOpen):
+        return f"⚠️ Сервис генерации сейчас недоступен, {what} сделать не получилось. Попробуй через пару минут."
+    return f"⚠️ Не получилось сделать {what}. Попробуй ещё раз чуть позже."
+
+async def generate_bio(cid, sess, ctx, prev_stage=Stage.DONE_INTERVIEW):
+    if not await ensure_allowed_or_reply(update=None, ctx=ctx):
         return
+    ensure_digest(sess, INTERVIEW_LABELS, PRODUCT_LABELS)
     style_note = (
         "\n\nОбрати внимание: используй стиль и лексику пользователя, пиши фразы в его манере."
     )
@@ -570,33 +1098,44 @@ async def generate_bio(cid, sess, ctx):
         "Варианты пиши только текстом, без оформления Markdown и без номеров. Формулировки — живые, в стиле Instagram: вызывай интерес, добавь call-to-action или эмоцию."
         + style_note
         + "\n\n"
-        + sess["positioning"]
-    )
-    resp = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        timeout=25
+        + sess.positioning
+        + "\n\nОтветы пользователя (ориентир по стилю):\n"
+        + await context_for_prompt(sess, config.CONTEXT_BUDGET_BIO, with_products=False)
     )
+    try:
+        bio_text = await llm.chat([{"role": "user", "content": prompt}], purpose="bio", cache_version=PROMPT_VERSION)
+    except Exception as e:
+        # OpenAI недоступен (открытый breaker, таймаут) — остаёмся на прошлом этапе, меню на месте
+        log.warning("BIO для cid %s: %r", cid, e)
+        sess.stage = prev_stage
+        kb = [[InlineKeyboardButton(n, callback_data=c)] for n, c in MAIN_MENU]
+        await ctx.bot.send_message(
+            chat_id=cid,
+            text=llm_unavailable_text(e, "BIO"),
+            reply_markup=InlineKeyboardMarkup(kb)
+        )
+        return
     await ctx.bot.send_message(
         chat_id=cid,
-        text="📱 Варианты BIO:\n\n" + resp.choices[0].message.content
+        text="📱 Варианты BIO:\n\n" + bio_text
     )
-    sess["stage"] = "done_bio"
+    sess.stage = Stage.DONE_BIO
     kb = [[InlineKeyboardButton(n, callback_data=c)] for n, c in MAIN_MENU if c != "bio"]
     await ctx.bot.send_message(
         chat_id=cid,
         text="Что дальше?",
         reply_markup=InlineKeyboardMarkup(kb)
     )
+    await results.save(cid, "bio", bio_text)
 
 # ---------- КРАТКИЙ АНАЛИЗ ПРОДУКТА (учёт стиля пользователя) ----------
 async def generate_product_analysis(cid, sess, ctx):
-    if not ensure_allowed_or_reply(update=None, ctx=ctx):
+    if not await ensure_allowed_or_reply(update=None, ctx=ctx):
         return
     style_note = (
         "\n\nСохраняй стиль, лексику и тональность пользователя (ориентируйся на его оригинальные формулировки)."
     )
-    answers = "\n".join(sess["product_answers"])
+    answers = "\n".join(sess.product_answers)
     prompt = (
         "На основе ответов пользователя на вопросы о продукте, напиши краткий анализ продукта для Telegram в 3–5 предложениях. "
         "Раскрой суть продукта, ключевые выгоды, отличия от конкурентов, результат для клиента. Язык — русский, стиль деловой, но понятный."
@@ -604,79 +1143,194 @@ async def generate_product_analysis(cid, sess, ctx):
         + "\n\n"
         + answers
     )
-    resp = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        timeout=25
-    )
+    try:
+        analysis = await llm.chat([{"role": "user", "content": prompt}], purpose="product", cache_version=PROMPT_VERSION)
+    except Exception as e:
+        # анализ продукта только для пользователя: ответы сохранены, сценарий идёт дальше без него
+        log.warning("Анализ продукта для cid %s: %r", cid, e)
+        await ctx.bot.send_message(chat_id=cid, text=llm_unavailable_text(e, "краткий анализ продукта"))
+        return
     await ctx.bot.send_message(
         chat_id=cid,
-        text="📝 Краткий анализ продукта:\n\n" + resp.choices[0].message.content
+        text="📝 Краткий анализ продукта:\n\n" + analysis
     )
+    await results.save(cid, "product", analysis)
 
 # ---------- ДЛИННОСООБЩЕНИЯ ----------
-async def send_long_message(ctx, cid, text):
-    MAX_LEN = 4000
-    for i in range(0, len(text), MAX_LEN):
-        await ctx.bot.send_message(chat_id=cid, text=text[i:i+MAX_LEN], parse_mode="HTML")
+async def send_long_message(bot, cid, text):
+    # режем по сегментам/абзацам, не разрывая HTML-теги (html_chunker.py)
+    for chunk in split_html(text):
+        await bot.send_message(chat_id=cid, text=chunk, parse_mode="HTML", rate_limit_args=Priority.BULK)
+
+async def generate_to_chat(bot, cid, messages, *, purpose, header="", **llm_kwargs):
+    """Сгенерировать ответ и вывести его в чат: стримингом (STREAM_REPLIES) или целиком.
+    Возвращает текст ответа без заголовка."""
+    if not config.STREAM_REPLIES:
+        text = await llm.chat(messages, purpose=purpose, **llm_kwargs)
+        await send_long_message(bot, cid, header + text)
+        return text
+    reply = StreamingReply(bot, cid, header=header)
+    await reply.start()
+    async for delta in llm.chat_stream(messages, purpose=purpose, **llm_kwargs):
+        await reply.feed(delta)
+    full = await reply.finish()
+    return full[len(header):]
 
 # ---------- JTBD (5 сегментов, учёт всех продуктов, стиль пользователя) ----------
-async def start_jtbd(cid, sess, ctx):
-    if not ensure_allowed_or_reply(update=None, ctx=ctx):  # update не нужен тут
+# шаблон сегмента ЦА; в параллельном режиме каждый блок сверяется с ним (segment_fanout.py)
+JTBD_EXAMPLE = (
+    "<b>Сегмент 1: Любители уюта и красоты</b>\n"
+    "\n"
+    "<u>JTBD:</u> Создать уютное и красивое пространство для себя и близких, чтобы чувствовать себя комфортно и радостно.\n\n"
+    "<u>Потребности:</u> Уют, красота, эстетическое удовольствие, создание атмосферы.\n\n"
+    "<u>Боли:</u> Недостаток времени на создание уюта, нехватка идей для декора, стресс от некомфортного интерьера.\n\n"
+    "<u>Решения:</u> Услуги по дизайну интерьера, предоставление дизайн-проектов помещений, консультации по созданию уютного и стильного интерьера.\n\n"
+    "<u>Темы для контента:</u> «5 способов создать уют в доме», «Как выбрать цветовую гамму для интерьера», «ТОП-10 украшений для создания уюта», «Дизайн интерьера: тренды и идеи», «Как сделать атмосферу в спальне».\n\n"
+    "<u>Психографика:</u> Ценят уют, комфорт, красоту, стремятся создать особую атмосферу в своём доме.\n\n"
+    "<u>Поведенческая сегментация:</u> Активно изучают дизайн интерьера, следят за интерьерными новинками, делятся своими решениями в социальных сетях.\n\n"
+    "<u>Оффер:</u> Консультация и подбор идей для уютного дома от профессионального дизайнера.\n\n"
+)
+JTBD_MORE_EXAMPLE = (
+    "<b>Сегмент 6: Ценители уюта и необычных решений</b>\n"
+    "\n"
+    "<u>JTBD:</u> Найти идеи для создания стильного и уютного пространства, чтобы проявить индивидуальность.\n\n"
+    "<u>Потребности:</u> Атмосфера, комфорт, оригинальные детали, простота реализации.\n\n"
+    "<u>Боли:</u> Неумение реализовать задумку самостоятельно, страх ошибок в декоре.\n\n"
+    "<u>Решения:</u> Видеоинструкции, подбор материалов, сопровождение на всех этапах.\n\n"
+    "<u>Темы для контента:</u> «5 нестандартных решений для малогабаритной квартиры», «Как объединить разные стили», «ТОП-10 уютных аксессуаров», «Провальные идеи декора: как не повторить», «Где искать вдохновение».\n\n"
+    "<u>Психографика:</u> Интересы — интерьер, Pinterest, скандинавский стиль; ценности — индивидуальность, комфорт; страхи — показаться банальным.\n\n"
+    "<u>Поведенческая сегментация:</u> Активно ищут необычные идеи, участвуют в челленджах, делятся примерами, смотрят блоги о дизайне.\n\n"
+    "<u>Оффер:</u> Создай уют без ошибок — получи подборку идей и бесплатную консультацию по твоей задумке!\n\n"
+)
+JTBD_RULES = (
+    "Не сокращай, не ограничивай себя по объёму. Каждый критерий — отдельной строкой. "
+    "Название сегмента делай <b>жирным</b>, критерии (<u>JTBD:</u>, <u>Потребности:</u> и т.д.) — подчёркнутыми, между критериями и сегментами делай пустую строку. "
+    "Не используй таблицы и списки. Только HTML-теги для оформления. Ответ только на русском языке."
+)
+
+async def start_jtbd(cid, sess, ctx, refresh=False, flight=None):
+    if not await ensure_allowed_or_reply(update=None, ctx=ctx):  # update не нужен тут
         return
 
     # ✅ Проверка, что есть все нужные данные
-    if not sess.get("answers") or not sess.get("products"):
+    if not sess.answers or not sess.products:
         await ctx.bot.send_message(
             chat_id=cid,
             text="❗️Пожалуйста, сначала пройди этапы распаковки и описания продукта."
         )
         return
 
-    all_products = []
-    for prod in sess.get("products", []):
-        all_products.append("\n".join(prod))
-    ctx_text = "\n".join(sess["answers"]) + "\n" + "\n\n".join(all_products)
+    ensure_digest(sess, INTERVIEW_LABELS, PRODUCT_LABELS)
+    ctx_text = await context_for_prompt(sess, config.CONTEXT_BUDGET_JTBD)
 
     style_note = (
         "\n\nПиши подробно, с примерами, в стиле и лексике пользователя. Избегай шаблонных формулировок и повторов."
     )
     prompt = (
         "На основе распаковки, позиционирования и всех продуктов составь РОВНО 5 ключевых сегментов целевой аудитории (ЦА), строго по шаблону и с HTML-разметкой:\n\n"
-        "<b>Сегмент 1: Любители уюта и красоты</b>\n"
-        "\n"
-        "<u>JTBD:</u> Создать уютное и красивое пространство для себя и близких, чтобы чувствовать себя комфортно и радостно.\n\n"
-        "<u>Потребности:</u> Уют, красота, эстетическое удовольствие, создание атмосферы.\n\n"
-        "<u>Боли:</u> Недостаток времени на создание уюта, нехватка идей для декора, стресс от некомфортного интерьера.\n\n"
-        "<u>Решения:</u> Услуги по дизайну интерьера, предоставление дизайн-проектов помещений, консультации по созданию уютного и стильного интерьера.\n\n"
-        "<u>Темы для контента:</u> «5 способов создать уют в доме», «Как выбрать цветовую гамму для интерьера», «ТОП-10 украшений для создания уюта», «Дизайн интерьера: тренды и идеи», «Как сделать атмосферу в спальне».\n\n"
-        "<u>Психографика:</u> Ценят уют, комфорт, красоту, стремятся создать особую атмосферу в своём доме.\n\n"
-        "<u>Поведенческая сегментация:</u> Активно изучают дизайн интерьера, следят за интерьерными новинками, делятся своими решениями в социальных сетях.\n\n"
-        "<u>Оффер:</u> Консультация и подбор идей для уютного дома от профессионального дизайнера.\n\n"
-        "Оформи строго 5 таких сегментов, каждый — отдельным блоком. Не сокращай, не ограничивай себя по объёму. Каждый критерий — отдельной строкой. "
-        "Название сегмента делай <b>жирным</b>, критерии (<u>JTBD:</u>, <u>Потребности:</u> и т.д.) — подчёркнутыми, между критериями и сегментами делай пустую строку. "
-        "Не используй таблицы и списки. Только HTML-теги для оформления. Ответ только на русском языке."
+        + JTBD_EXAMPLE +
+        "Оформи строго 5 таких сегментов, каждый — отдельным блоком. " + JTBD_RULES
         + style_note +
         "\n\nИсходная информация:\n" + ctx_text
     )
 
-    # ✅ GPT-запрос с обработкой ошибок
-    try:
-        resp = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}]
-        )
-    except Exception as e:
-        await ctx.bot.send_message(
-            chat_id=cid,
-            text="⚠️ Не удалось получить анализ ЦА. Попробуй ещё раз позже."
-        )
-        print("OpenAI JTBD error:", e)
-        return
+    payload = {
+        "messages": [{"role": "user", "content": prompt}],
+        "purpose": "jtbd", "header": "🎯 Основные сегменты ЦА:\n\n",
+        "refresh": refresh, "flight": flight,
+    }
+    if config.JTBD_PARALLEL:
+        payload["segments"] = {"variant": "main", "count": 5, "first": 1, "style": style_note, "context": ctx_text}
+    if await submit_generation(ctx.bot, cid, sess, "jtbd", payload) and config.JOBS_MODE == "queue":
+        flights.detach(cid, "jtbd", flight)
+
+def jtbd_titles_messages(spec: dict) -> list[dict]:
+    which = "ключевых" if spec["variant"] == "main" else "новых неочевидных"
+    return [{"role": "user", "content": (
+        f"На основе распаковки, позиционирования и всех продуктов назови РОВНО {spec['count']} {which} сегментов целевой аудитории (ЦА). "
+        "Только названия сегментов: по одному на строку, 2–6 слов, без нумерации, пояснений и разметки. Ответ только на русском языке."
+        "\n\nИсходная информация:\n" + spec["context"]
+    )}]
+
+def jtbd_segment_messages(spec: dict, titles: list[str], i: int) -> list[dict]:
+    number = spec["first"] + i
+    example = JTBD_EXAMPLE if spec["variant"] == "main" else JTBD_MORE_EXAMPLE
+    others = "; ".join(f"«{t}»" for k, t in enumerate(titles) if k != i)
+    return [{"role": "user", "content": (
+        f"Опиши ровно один сегмент целевой аудитории (ЦА) — «{titles[i]}», строго по шаблону и с HTML-разметкой:\n\n"
+        + example +
+        f"Первая строка ответа: <b>Сегмент {number}: {titles[i]}</b>\n"
+        f"Другие сегменты ({others}) описываются отдельно — не повторяй их. " + JTBD_RULES
+        + spec["style"] +
+        "\n\nИсходная информация:\n" + spec["context"]
+    )}]
+
+async def run_segments_job(bot, job, checkpoint):
+    """Сегменты ЦА параллельно (segment_fanout.py): названия, затем блоки; в чат — по порядку.
+    Выведенные сегменты сохраняются — повтор задачи продолжит с первого недостающего."""
+    p, spec = job.payload, job.payload["segments"]
+    refresh = p.get("refresh", False)
+    result = dict(job.result)
+    parts = result.setdefault("parts", {})
+    if "titles" not in result:
+        for attempt in range(2):
+            text = await llm.chat(jtbd_titles_messages(spec), purpose="jtbd_titles",
+                                  cache_version=PROMPT_VERSION, refresh=refresh or attempt > 0)
+            try:
+                result["titles"] = parse_titles(text, spec["count"])
+                break
+            except SegmentError:
+                if attempt:
+                    raise
+        await checkpoint(result)
+    titles = result["titles"]
+
+    async def write(i, retry):
+        return await llm.chat(jtbd_segment_messages(spec, titles, i), purpose="jtbd_segment",
+                              cache_version=PROMPT_VERSION, refresh=refresh or retry)
+
+    async def emit(i, text):
+        await send_long_message(bot, job.chat_id, (p["header"] if i == 0 else "") + text)
+        parts[str(i)] = text
+        await checkpoint(result)
+
+    texts = await fan_out(
+        spec["count"], write, emit, first=spec["first"],
+        concurrency=config.JTBD_CONCURRENCY, attempts=config.JTBD_SEGMENT_ATTEMPTS,
+        ready={int(i): t for i, t in parts.items()},
+    )
+    return {"text": "\n\n".join(texts)}
 
-    await send_long_message(ctx, cid, "🎯 Основные сегменты ЦА:\n\n" + resp.choices[0].message.content)
+async def run_generation_job(bot, job, checkpoint):
+    """Одна генерация со стримингом в чат: промпт собран в процессе бота и лежит в payload."""
+    p = job.payload
+    if "segments" in p:
+        try:
+            return await run_segments_job(bot, job, checkpoint)
+        except SegmentError as e:
+            if job.result.get("parts"):
+                raise  # часть сегментов уже в чате — целиком заново не генерируем
+            log.warning("job %s #%s: %s — генерируем все сегменты одним запросом", job.kind, job.id, e)
+    text = await generate_to_chat(
+        bot, job.chat_id, p["messages"],
+        purpose=p["purpose"], header=p["header"],
+        cache_version=PROMPT_VERSION, refresh=p.get("refresh", False),
+    )
+    return {"text": text}
 
-    await ctx.bot.send_message(
+async def jtbd_done(bot, job):
+    cid = job.chat_id
+    flights.done(cid, "jtbd", job.payload.get("flight"))
+    sess = await job_session(job, Stage.JTBD_GENERATING)
+    if sess is None:
+        return
+    if job.status != "done":
+        await generation_failed(bot, cid, sess, job.kind, Stage(job.payload["prev_stage"]),
+                                "⚠️ Не удалось получить анализ ЦА. Попробуй ещё раз позже.")
+        log.warning("OpenAI JTBD error: %s", job.last_error)
+        return
+
+    await bot.send_message(
         chat_id=cid,
         text="Хочешь увидеть неочевидные сегменты ЦА?",
         reply_markup=InlineKeyboardMarkup([
@@ -684,45 +1338,49 @@ async def start_jtbd(cid, sess, ctx):
             [InlineKeyboardButton("Хватит, благодарю", callback_data="jtbd_done")]
         ])
     )
-    sess["stage"] = "jtbd_first"
+    sess.stage = Stage.JTBD_FIRST
+    await results.save(cid, "jtbd", job.result["text"])
 
 async def handle_more_jtbd(update, ctx):
-    if not ensure_allowed_or_reply(update=None, ctx=ctx):
+    if not await ensure_allowed_or_reply(update=None, ctx=ctx):
         return
     cid = update.effective_chat.id
-    sess = sessions.get(cid)
-    all_products = []
-    for prod in sess.get("products", []):
-        all_products.append("\n".join(prod))
-    ctx_text = "\n".join(sess["answers"]) + "\n" + "\n\n".join(all_products)
+    sess = await sessions.get(cid)
+    ensure_digest(sess, INTERVIEW_LABELS, PRODUCT_LABELS)
+    ctx_text = await context_for_prompt(sess, config.CONTEXT_BUDGET_JTBD)
     style_note = (
         "\n\nПиши подробно, в стиле пользователя, избегай шаблонов и повторов. Для каждого сегмента дай не менее 5 идей для контента. "
         "Психографику разбей на интересы, ценности, страхи."
     )
     prompt = (
         "Добавь ещё 3 неочевидных сегмента целевой аудитории (ЦА), строго по шаблону и с HTML-разметкой:\n\n"
-        "<b>Сегмент 6: Ценители уюта и необычных решений</b>\n"
-        "\n"
-        "<u>JTBD:</u> Найти идеи для создания стильного и уютного пространства, чтобы проявить индивидуальность.\n\n"
-        "<u>Потребности:</u> Атмосфера, комфорт, оригинальные детали, простота реализации.\n\n"
-        "<u>Боли:</u> Неумение реализовать задумку самостоятельно, страх ошибок в декоре.\n\n"
-        "<u>Решения:</u> Видеоинструкции, подбор материалов, сопровождение на всех этапах.\n\n"
-        "<u>Темы для контента:</u> «5 нестандартных решений для малогабаритной квартиры», «Как объединить разные стили», «ТОП-10 уютных аксессуаров», «Провальные идеи декора: как не повторить», «Где искать вдохновение».\n\n"
-        "<u>Психографика:</u> Интересы — интерьер, Pinterest, скандинавский стиль; ценности — индивидуальность, комфорт; страхи — показаться банальным.\n\n"
-        "<u>Поведенческая сегментация:</u> Активно ищут необычные идеи, участвуют в челленджах, делятся примерами, смотрят блоги о дизайне.\n\n"
-        "<u>Оффер:</u> Создай уют без ошибок — получи подборку идей и бесплатную консультацию по твоей задумке!\n\n"
-        "Оформи строго 3 таких новых неочевидных сегмента, каждый — отдельным блоком. Не сокращай, не ограничивай себя по объёму. Каждый критерий — отдельной строкой. "
-        "Название сегмента делай <b>жирным</b>, критерии (<u>JTBD:</u>, <u>Потребности:</u> и т.д.) — подчёркнутыми, между критериями и сегментами делай пустую строку. "
-        "Не используй таблицы и списки. Только HTML-теги для оформления. Ответ только на русском языке."
+        + JTBD_MORE_EXAMPLE +
+        "Оформи строго 3 таких новых неочевидных сегмента, каждый — отдельным блоком. " + JTBD_RULES
         + style_note +
         "\n\nИсходная информация:\n" + ctx_text
     )
-    resp = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}]
-    )
-    await send_long_message(ctx, cid, "🔍 Дополнительные неочевидные сегменты:\n\n" + resp.choices[0].message.content)
-    await ctx.bot.send_message(
+    payload = {
+        "messages": [{"role": "user", "content": prompt}],
+        "purpose": "jtbd_more", "header": "🔍 Дополнительные неочевидные сегменты:\n\n",
+        "flight": tap_flight(update),
+    }
+    if config.JTBD_PARALLEL:
+        payload["segments"] = {"variant": "more", "count": 3, "first": 6, "style": style_note, "context": ctx_text}
+    if await submit_generation(ctx.bot, cid, sess, "jtbd_more", payload) and config.JOBS_MODE == "queue":
+        flights.detach(cid, "jtbd_more", payload["flight"])
+
+async def jtbd_more_done(bot, job):
+    cid = job.chat_id
+    flights.done(cid, "jtbd_more", job.payload.get("flight"))
+    sess = await job_session(job, Stage.JTBD_MORE_GENERATING)
+    if sess is None:
+        return
+    if job.status != "done":
+        await generation_failed(bot, cid, sess, job.kind, Stage(job.payload["prev_stage"]),
+                                "⚠️ Не удалось получить анализ ЦА. Попробуй ещё раз позже.")
+        log.warning("OpenAI JTBD error: %s", job.last_error)
+        return
+    await bot.send_message(
         chat_id=cid,
         text="Что дальше?",
         reply_markup=InlineKeyboardMarkup([
@@ -730,10 +1388,11 @@ async def handle_more_jtbd(update, ctx):
             [InlineKeyboardButton("Завершить распаковку", callback_data="finish_unpack")]
         ])
     )
-    sess["stage"] = "jtbd_done"
+    sess.stage = Stage.JTBD_DONE
+    await results.save(cid, "jtbd_more", job.result["text"])
 
 async def handle_skip_jtbd(update, ctx):
-    if not ensure_allowed_or_reply(update=None, ctx=ctx):
+    if not await ensure_allowed_or_reply(update=None, ctx=ctx):
         return
     cid = update.effective_chat.id
     await ctx.bot.send_message(
@@ -751,18 +1410,196 @@ async def handle_skip_jtbd(update, ctx):
             [InlineKeyboardButton("⏳ Обращусь позже", callback_data="later")]
         ])
     )
-    sessions[cid]["stage"] = "done_jtbd"
+    sess = await sessions.get(cid)
+    if sess:
+        sess.stage = Stage.DONE_JTBD
+
+# ---------- ОЧЕРЕДЬ ГЕНЕРАЦИЙ (jobs.py) ----------
+jobs.register("interview", run_interview_job, interview_done)
+jobs.register("jtbd", run_generation_job, jtbd_done)
+jobs.register("jtbd_more", run_generation_job, jtbd_more_done)
+
+def build_worker_bot():
+    """Bot для процесса-воркера: тот же планировщик отправки и адрес Bot API, что у бота."""
+    from telegram.ext import ExtBot
+    from telegram.request import HTTPXRequest
+
+    kwargs = {}
+    if config.TG_API_URL:
+        root = config.TG_API_URL.rstrip("/")
+        kwargs = {"base_url": f"{root}/bot", "base_file_url": f"{root}/file/bot"}
+    return ExtBot(
+        BOT_TOKEN,
+        rate_limiter=make_scheduler(),
+        # каждая задача стримит в свой чат — соединений нужно не меньше слотов
+        request=HTTPXRequest(connection_pool_size=config.JOBS_WORKER_CONCURRENCY * 2 + 4),
+        **kwargs,
+    )
+
+def run_jobs_worker():
+    """python bot.py worker: отдельный процесс, разбирающий очередь генераций."""
+    import signal
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+
+    async def main():
+        await open_pool()
+        runner = await metrics.serve(config.JOBS_METRICS_PORT) if config.JOBS_METRICS_PORT else None
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        try:
+            async with build_worker_bot() as bot:
+                await jobs.JobWorker(bot, concurrency=config.JOBS_WORKER_CONCURRENCY).run(stop)
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+            await llm.close_client()
+            await close_pool()
+
+    asyncio.run(main())
+
+# ---------- ВРЕМЯ СТАРТА ----------
+# мс от начала импорта bot.py до каждой фазы — следим за холодным стартом между релизами
+startup_marks: dict[str, float] = {}
+
+def mark_startup(phase: str):
+    startup_marks[phase] = (time.perf_counter() - _STARTUP_T0) * 1000
+
+mark_startup("imports")
+
+async def apply_migrations():
+    """Схема БД: одна проверка версии на одном соединении; DDL — только если схема отстала."""
+    async with db.pool.connection() as conn:
+        if config.MIGRATE_ON_START:
+            applied = await migrations.migrate(conn)
+            if applied:
+                log.info("schema: применены миграции %s", applied)
+            return
+        version = await migrations.current_version(conn)
+        if version < migrations.LATEST:
+            log.warning("schema: версия %s < %s, запусти python bot.py migrate", version, migrations.LATEST)
+
+# ---------- МЕТРИКИ (/metrics, см. metrics.py) ----------
+_scheduler = None  # планировщик отправки текущего приложения
+
+metrics.Gauge("bot_sessions_resident", "Сессии в памяти процесса",
+              collect=lambda: {(): sessions.resident_count()})
+metrics.Gauge("bot_sessions_bytes", "Примерный объём сессий в памяти, байт",
+              collect=lambda: {(): sessions.resident_bytes()})
+metrics.Gauge("bot_session_store", "Хранилище сессий: загрузки, записи, выгрузки по причине", ("key",),
+              collect=lambda: sessions.stats)
+metrics.Gauge("bot_sessions_by_stage", "Сессии в памяти по этапу сценария", ("stage",),
+              collect=lambda: sessions.stage_counts())
+metrics.Gauge("bot_single_flights", "Дорогие генерации по кнопкам в работе (повторные тапы гасятся)",
+              collect=lambda: {(): flights.active()})
+metrics.Gauge("bot_pending_comments", "Комментарии коуча, догоняющие вопрос",
+              collect=lambda: {(): len(_pending_comments)})
+metrics.Gauge("bot_startup_seconds", "Время от импорта bot.py до фазы старта", ("phase",),
+              collect=lambda: {k: v / 1000 for k, v in startup_marks.items()})
+metrics.Gauge("llm_gateway", "Шлюз к модели: in-flight, ожидающие слота, счётчики", ("key",), collect=llm.stats)
+metrics.Gauge("db_pool", "Пул соединений Postgres", ("key",), collect=db.pool_stats)
+metrics.Gauge("gen_cache", "Кэш генераций", ("key",), collect=gen_cache.stats)
+metrics.Gauge("access_cache", "Кэш доступа", ("key",), collect=access_cache.stats)
+metrics.Gauge("tg_send_queue", "Очередь исходящих запросов к Telegram", ("key",),
+              collect=lambda: _scheduler.stats() if _scheduler else {})
 
 # ---------- MAIN ----------
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+_background_tasks: list[asyncio.Task] = []
+_metrics_runner = None
+
+async def post_init(app: Application):
+    global _metrics_runner
+    mark_startup("app_initialized")
+    if config.JOBS_MODE not in ("inline", "queue"):
+        raise RuntimeError(f"Unknown JOBS_MODE: {config.JOBS_MODE!r}")
+    if config.JOBS_MODE == "queue" and not config.DATABASE_URL:
+        raise RuntimeError("JOBS_MODE=queue требует DATABASE_URL (очередь живёт в Postgres)")
+    if config.METRICS_PORT:
+        _metrics_runner = await metrics.serve()
+    await open_pool()
+    mark_startup("db_pool")
+    await apply_migrations()
+    mark_startup("migrations")
+    if config.ACCESS_CACHE_LISTEN:
+        _background_tasks.append(asyncio.create_task(listen_revocations()))
+    sessions.start()
+    if config.TOKEN_SWEEP_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(sweep_expired_tokens()))
+    if gen_cache.persistent is not None:
+        _background_tasks.append(asyncio.create_task(gen_cache.purge_loop()))
+    # SDK модели подгружаем в фоне, уже после старта, — первый запрос не ждёт импорта
+    _background_tasks.append(asyncio.create_task(llm.warm_up()))
+    if config.JOBS_MODE == "queue":
+        # результаты воркеров применяем в очереди чата — между его апдейтами, не параллельно им
+        applier = jobs.ResultApplier(app.bot, run_in_chat=app.call_in_chat)
+        _background_tasks.append(asyncio.create_task(applier.run()))
+        if jobs.shard[0] == 0:
+            _background_tasks.append(asyncio.create_task(jobs.queue_stats_loop()))
+    mark_startup("ready")
+    log.info("startup: %s", " ".join(f"{k}={v:.0f}ms" for k, v in startup_marks.items()))
+
+async def post_shutdown(app: Application):
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await sessions.stop()
+    await llm.close_client()
+    await close_pool()
+
+def build_application() -> Application:
+    global _scheduler
+    _scheduler = make_scheduler()
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # разные чаты — параллельно, апдейты одного чата — строго по очереди (chat_dispatch.py)
+        .application_class(ChatOrderedApplication)
+        .rate_limiter(_scheduler)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if config.TG_API_URL:
+        root = config.TG_API_URL.rstrip("/")
+        builder = builder.base_url(f"{root}/bot").base_file_url(f"{root}/file/bot")
+    app = builder.build()
+    app.fast_paths.append(dedupe_tap)
+    # сессия чата закреплена, пока обрабатываются его апдейты (session_store.py)
+    app.chat_dispatcher.on_busy.append(sessions.pin)
+    app.chat_dispatcher.on_idle.append(sessions.unpin)
+    app.chat_dispatcher.on_drop.append(release_dropped_tap)
+    mark_startup("build")
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("gentoken", gentoken))
+    app.add_handler(CommandHandler("myresults", myresults))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/gentoken\b"), gentoken))
     app.add_handler(CallbackQueryHandler(callback_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
     app.add_handler(CallbackQueryHandler(handle_more_jtbd, pattern="jtbd_more"))
     app.add_handler(CallbackQueryHandler(handle_skip_jtbd, pattern="jtbd_done"))
-    app.run_polling()
+    return app
+
+def main():
+    # python bot.py [polling|webhook|migrate|worker]; по умолчанию — BOT_MODE из .env
+    mode = sys.argv[1] if len(sys.argv) > 1 else config.BOT_MODE
+    if mode == "migrate":
+        migrations.main(sys.argv[2:])
+        return
+    if mode == "worker":
+        run_jobs_worker()
+        return
+    if mode == "webhook":
+        from webhook import run_webhook
+        run_webhook(build_application)
+        return
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    build_application().run_polling()
 
 if __name__ == "__main__":
     main()
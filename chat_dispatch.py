@@ -0,0 +1,146 @@
+"""Порядок апдейтов внутри чата при параллельной обработке разных чатов.
+
+PTB забирает апдейты из update_queue по одному (concurrent_updates выключен), а
+ChatOrderedApplication.process_update только раскладывает их по очередям чатов. У каждого
+чата с непустой очередью — одна задача-обработчик: апдейты одного чата идут строго по
+порядку (двойной тап по кнопке не запустит генерацию дважды параллельно), разные чаты —
+одновременно, не больше CHAT_MAX_ACTIVE сразу. Опустевшая очередь удаляется вместе с
+задачей, так что «простаивающих» замков не остаётся.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+
+from telegram.ext import Application
+
+import config
+import metrics
+
+log = logging.getLogger(__name__)
+
+QUEUE_WAIT = metrics.Histogram(
+    "bot_chat_queue_wait_seconds", "Ожидание апдейта в очереди своего чата до начала обработки",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+DROPPED = metrics.Counter("bot_chat_updates_dropped_total", "Апдейты, отброшенные из-за переполненной очереди чата")
+
+_dispatchers: "weakref.WeakSet[ChatDispatcher]" = weakref.WeakSet()
+
+metrics.Gauge("bot_chats_busy", "Чаты с апдейтами в работе или в очереди",
+              collect=lambda: {(): sum(len(d._queues) for d in _dispatchers)})
+metrics.Gauge("bot_chat_queue_depth", "Апдейтов в очередях чатов (без обрабатываемых)",
+              collect=lambda: {(): sum(d.pending() for d in _dispatchers)})
+
+
+def chat_key(update) -> int | None:
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, "effective_user", None)
+    return user.id if user is not None else None
+
+
+class ChatDispatcher:
+    def __init__(self, process, *, max_pending: int = 20, max_active: int = 256):
+        self._process = process                 # корутина обработки одного апдейта
+        self.max_pending = max_pending
+        self._active = asyncio.Semaphore(max_active)
+        self._queues: dict[int, deque] = {}     # есть запись <=> у чата есть задача-обработчик
+        self.stats = {"submitted": 0, "dropped": 0}
+        # fn(key): у чата появилась задача-обработчик / очередь чата опустела
+        self.on_busy: list = []
+        self.on_idle: list = []
+        # fn(key, update): апдейт отброшен из-за переполненной очереди
+        self.on_drop: list = []
+        _dispatchers.add(self)
+
+    def submit(self, key: int, update, spawn, *, force: bool = False) -> bool:
+        """Поставить апдейт в очередь чата; spawn(coro) запускает задачу-обработчик.
+
+        force — не отбрасывать при переполнении (результаты фоновых задач терять нельзя).
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            spawn(self._drain(key, queue))
+        elif len(queue) >= self.max_pending and not force:
+            self.stats["dropped"] += 1
+            DROPPED.inc()
+            log.warning("chat %s: очередь апдейтов переполнена (%s), апдейт отброшен", key, len(queue))
+            self._notify(self.on_drop, key, update)
+            return False
+        queue.append((update, time.perf_counter()))
+        self.stats["submitted"] += 1
+        return True
+
+    async def _drain(self, key: int, queue: deque):
+        self._notify(self.on_busy, key)
+        try:
+            while queue:
+                update, enqueued = queue.popleft()
+                async with self._active:
+                    QUEUE_WAIT.observe(time.perf_counter() - enqueued)
+                    await self._process(update)
+        finally:
+            # очередь пуста (или задачу отменили при остановке) — чат больше не «занят»
+            if self._queues.get(key) is queue:
+                del self._queues[key]
+            self._notify(self.on_idle, key)
+
+    @staticmethod
+    def _notify(listeners: list, *args):
+        for fn in listeners:
+            try:
+                fn(*args)
+            except Exception:
+                log.exception("chat %s: подписчик %s упал", args[0], fn)
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+
+class ChatOrderedApplication(Application):
+    """Application, обрабатывающий чаты параллельно, а апдейты одного чата — по порядку."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.chat_dispatcher = ChatDispatcher(
+            self._process_in_order,
+            max_pending=config.CHAT_QUEUE_MAX,
+            max_active=config.CHAT_MAX_ACTIVE,
+        )
+        # fast_path(app, update) -> True, если апдейт уже обработан и в очередь чата не нужен
+        self.fast_paths: list = []
+
+    async def process_update(self, update: object) -> None:
+        for fast_path in self.fast_paths:
+            if fast_path(self, update):
+                return
+        key = chat_key(update)
+        if key is None:
+            await super().process_update(update)
+            return
+        # create_task: stop() дождётся обработчиков, а ошибки уйдут в error handlers
+        self.chat_dispatcher.submit(key, update, lambda coro: self.create_task(coro, update=update))
+
+    def call_in_chat(self, key: int, fn) -> None:
+        """Выполнить корутину fn() в очереди чата key — между его апдейтами, не параллельно им."""
+        self.chat_dispatcher.submit(key, _ChatCall(fn), self.create_task, force=True)
+
+    async def _process_in_order(self, update: object) -> None:
+        if isinstance(update, _ChatCall):
+            try:
+                await update.fn()
+            except Exception:
+                log.exception("chat call %s", getattr(update.fn, "__name__", update.fn))
+            return
+        await super().process_update(update)
+
+
+class _ChatCall:
+    __slots__ = ("fn",)
+
+    def __init__(self, fn):
+        self.fn = fn
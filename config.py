@@ -0,0 +1,166 @@
+"""Настройки бота из переменных окружения (.env)."""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+DATABASE_URL = os.getenv("DATABASE_URL")
+BOT_NAME = os.getenv("MAIN_BOT_USERNAME", "jtbd_assistant_bot")
+# Если хочешь, чтобы админ всегда проходил, задай ADMIN_ID в .env
+ADMIN_ID = env_int("ADMIN_ID", 0)
+
+# ---------- Пул соединений Postgres ----------
+DB_POOL_MIN = env_int("DB_POOL_MIN", 1)
+DB_POOL_MAX = env_int("DB_POOL_MAX", 10)
+DB_POOL_TIMEOUT = env_float("DB_POOL_TIMEOUT", 10.0)         # ожидание свободного соединения, сек
+DB_POOL_MAX_IDLE = env_float("DB_POOL_MAX_IDLE", 300.0)      # закрывать простаивающие сверх min_size
+DB_POOL_RECONNECT_TIMEOUT = env_float("DB_POOL_RECONNECT_TIMEOUT", 120.0)
+DB_POOL_STATS_INTERVAL = env_float("DB_POOL_STATS_INTERVAL", 300.0)  # 0 — не логировать
+# миграции схемы при старте; 0 — только проверка версии, применять через python bot.py migrate
+MIGRATE_ON_START = env_bool("MIGRATE_ON_START", True)
+
+# ---------- Кэш доступа (allowed_users) ----------
+ACCESS_CACHE_TTL = env_float("ACCESS_CACHE_TTL", 300.0)          # макс. «несвежесть» разрешения, сек
+ACCESS_CACHE_NEGATIVE_TTL = env_float("ACCESS_CACHE_NEGATIVE_TTL", 10.0)
+ACCESS_CACHE_MAX_SIZE = env_int("ACCESS_CACHE_MAX_SIZE", 10000)
+# LISTEN/NOTIFY: отзыв доступа у кассира сразу сбрасывает запись в кэше
+ACCESS_CACHE_LISTEN = env_bool("ACCESS_CACHE_LISTEN", True)
+
+# ---------- OpenAI ----------
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-3.5-turbo")
+LLM_MAX_INFLIGHT = env_int("LLM_MAX_INFLIGHT", 16)   # одновременных запросов на процесс
+LLM_POOL_SIZE = env_int("LLM_POOL_SIZE", 32)         # keep-alive соединений к API
+LLM_TIMEOUT_DEFAULT = env_float("LLM_TIMEOUT_DEFAULT", 60.0)
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL")            # запасная модель для вызовов с дедлайном (llm.POLICIES)
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE")        # прокси или заглушка для нагрузочного теста
+
+# ---------- Стриминг ответов в Telegram ----------
+STREAM_REPLIES = env_bool("STREAM_REPLIES", True)
+STREAM_EDIT_INTERVAL = env_float("STREAM_EDIT_INTERVAL", 1.5)  # не чаще одного edit в N сек на сообщение
+
+# ---------- Хранилище сессий ----------
+# postgres | sqlite; по умолчанию postgres, если задан DATABASE_URL
+SESSION_BACKEND = os.getenv("SESSION_BACKEND") or ("postgres" if DATABASE_URL else "sqlite")
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.db")
+SESSION_MAX_RESIDENT = env_int("SESSION_MAX_RESIDENT", 5000)   # сессий в памяти (LRU)
+SESSION_MAX_BYTES = env_int("SESSION_MAX_BYTES", 64 * 1024 * 1024)  # примерный объём сессий в памяти, 0 — без лимита
+SESSION_IDLE_TTL = env_float("SESSION_IDLE_TTL", 3600.0)       # простаивающая дольше сессия выгружается (остаётся в БД)
+SESSION_COMPRESS_MIN = env_int("SESSION_COMPRESS_MIN", 2048)   # тексты длиннее держим в памяти сжатыми, 0 — не сжимать
+SESSION_FLUSH_INTERVAL = env_float("SESSION_FLUSH_INTERVAL", 2.0)
+SESSION_FLUSH_BATCH = env_int("SESSION_FLUSH_BATCH", 200)      # столько грязных — сбрасываем досрочно
+
+# ---------- Готовые результаты (artifacts.py, /myresults) ----------
+# postgres | sqlite; по умолчанию там же, где сессии
+ARTIFACT_BACKEND = os.getenv("ARTIFACT_BACKEND") or SESSION_BACKEND
+ARTIFACT_SQLITE_PATH = os.getenv("ARTIFACT_SQLITE_PATH", "artifacts.db")
+ARTIFACT_KEEP_VERSIONS = env_int("ARTIFACT_KEEP_VERSIONS", 5)  # версий каждого вида на пользователя
+MYRESULTS_PAGE_SIZE = env_int("MYRESULTS_PAGE_SIZE", 3)        # результатов на одну страницу /myresults
+
+# ---------- Комментарий коуча в интервью ----------
+# strict — комментарий всегда перед следующим вопросом (ждём его);
+# eager  — вопрос уходит сразу, комментарий приходит ответом на реплику пользователя, когда готов
+INTERVIEW_COMMENT_MODE = os.getenv("INTERVIEW_COMMENT_MODE", "eager")
+COMMENT_GRACE = env_float("COMMENT_GRACE", 1.0)        # eager: столько ждём, чтобы сохранить порядок «комментарий → вопрос»
+COMMENT_DEADLINE = env_float("COMMENT_DEADLINE", 12.0)  # позже — комментарий выбрасываем
+# распаковка по блокам ответов прямо во время интервью; в конце остаётся один короткий вызов
+INTERVIEW_INCREMENTAL = env_bool("INTERVIEW_INCREMENTAL", True)
+INTERVIEW_BLOCK = env_int("INTERVIEW_BLOCK", 5)               # вопросов в блоке
+UNPACK_PARTIAL_WAIT = env_float("UNPACK_PARTIAL_WAIT", 15.0)  # задача распаковки ждёт недописанный блок, сек
+UNPACK_PART_CONCURRENCY = env_int("UNPACK_PART_CONCURRENCY", 4)  # фоновых блоков на процесс одновременно
+# анализ ЦА: названия сегментов коротким вызовом, затем каждый сегмент отдельно (segment_fanout.py)
+JTBD_PARALLEL = env_bool("JTBD_PARALLEL", True)
+JTBD_CONCURRENCY = env_int("JTBD_CONCURRENCY", 3)            # сегментов одного пользователя одновременно
+JTBD_SEGMENT_ATTEMPTS = env_int("JTBD_SEGMENT_ATTEMPTS", 3)  # попыток на сегмент (не по шаблону — заново)
+
+# ---------- Кэш генераций ----------
+GEN_CACHE_ENABLED = env_bool("GEN_CACHE_ENABLED", True)
+GEN_CACHE_MAX_ITEMS = env_int("GEN_CACHE_MAX_ITEMS", 500)      # LRU в памяти
+GEN_CACHE_TTL = env_float("GEN_CACHE_TTL", 7 * 24 * 3600.0)
+# postgres | disk | none; по умолчанию postgres, если задан DATABASE_URL
+GEN_CACHE_PERSIST = os.getenv("GEN_CACHE_PERSIST") or ("postgres" if DATABASE_URL else "disk")
+GEN_CACHE_DIR = os.getenv("GEN_CACHE_DIR", ".gen_cache")
+
+# ---------- Бюджет промптов (токены на блок «Исходная информация») ----------
+CONTEXT_BUDGET_JTBD = env_int("CONTEXT_BUDGET_JTBD", 3000)
+CONTEXT_BUDGET_BIO = env_int("CONTEXT_BUDGET_BIO", 800)
+CONTEXT_SUMMARIZE = env_bool("CONTEXT_SUMMARIZE", True)  # при превышении сперва сжать интервью моделью, потом резать
+
+# ---------- Режим работы: polling (локально) или webhook (прод) ----------
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                 # публичный https-адрес, без пути
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")           # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = env_int("WEBHOOK_PORT", 8080)
+WEB_WORKERS = env_int("WEB_WORKERS", os.cpu_count() or 1)
+WEB_WORKER_QUEUE = env_int("WEB_WORKER_QUEUE", 1000)   # апдейтов в очереди одного воркера
+WEB_DRAIN_TIMEOUT = env_float("WEB_DRAIN_TIMEOUT", 60.0)
+
+# ---------- Обработка апдейтов: чаты параллельно, внутри чата по порядку ----------
+CHAT_MAX_ACTIVE = env_int("CHAT_MAX_ACTIVE", 256)      # чатов в обработке одновременно
+CHAT_QUEUE_MAX = env_int("CHAT_QUEUE_MAX", 20)         # апдейтов в очереди одного чата, сверх — отбрасываем
+SINGLE_FLIGHT_TTL = env_float("SINGLE_FLIGHT_TTL", 900.0)  # дольше повторный тап дорогой кнопки не гасим
+
+# ---------- Очередь тяжёлых генераций (gen_jobs) ----------
+# inline — прямо в хендлере; queue — задачи в Postgres, выполняют воркеры `python bot.py worker`.
+# queue только явно: без запущенных воркеров задачи из очереди никто не выполнит
+JOBS_MODE = os.getenv("JOBS_MODE") or "inline"
+JOBS_WORKER_CONCURRENCY = env_int("JOBS_WORKER_CONCURRENCY", 8)  # задач одновременно на процесс воркера
+JOBS_MAX_ATTEMPTS = env_int("JOBS_MAX_ATTEMPTS", 3)
+JOBS_RETRY_BASE = env_float("JOBS_RETRY_BASE", 10.0)   # секунд до повтора, дальше x2
+JOBS_LEASE = env_float("JOBS_LEASE", 120.0)            # без heartbeat дольше — задача возвращается в очередь
+JOBS_STALE_AFTER = env_float("JOBS_STALE_AFTER", 1800.0)  # этап «генерируется» дольше — считаем задачу потерянной
+JOBS_POLL_INTERVAL = env_float("JOBS_POLL_INTERVAL", 5.0)  # опрос на случай потерянного NOTIFY
+JOBS_DRAIN_TIMEOUT = env_float("JOBS_DRAIN_TIMEOUT", 120.0)
+JOBS_STATS_INTERVAL = env_float("JOBS_STATS_INTERVAL", 15.0)
+JOBS_METRICS_PORT = env_int("JOBS_METRICS_PORT", 0)    # /metrics процесса воркера, 0 — выключено
+
+# ---------- Устойчивость: circuit breaker и повторы (resilience.py) ----------
+BREAKER_FAILURES = env_int("BREAKER_FAILURES", 5)          # сбоев подряд до открытия
+BREAKER_OPEN_SECONDS = env_float("BREAKER_OPEN_SECONDS", 5.0)  # первое открытие; дальше x2 до BREAKER_OPEN_MAX
+BREAKER_OPEN_MAX = env_float("BREAKER_OPEN_MAX", 120.0)
+RETRY_BUDGET_RATIO = env_float("RETRY_BUDGET_RATIO", 0.1)  # повторов не больше этой доли вызовов
+RETRY_BACKOFF_BASE = env_float("RETRY_BACKOFF_BASE", 0.2)  # сек, полный джиттер, x2 на попытку
+RETRY_BACKOFF_MAX = env_float("RETRY_BACKOFF_MAX", 5.0)
+
+# ---------- Метрики Prometheus ----------
+METRICS_PORT = env_int("METRICS_PORT", 0)              # 0 — выключено; воркеры webhook: +1, +2, ...
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# ---------- Исходящие сообщения (лимиты Telegram) ----------
+TG_GLOBAL_RATE = env_float("TG_GLOBAL_RATE", 30.0)     # сообщений в секунду на бота
+TG_CHAT_RATE = env_float("TG_CHAT_RATE", 1.0)          # в личный чат, в секунду
+TG_CHAT_BURST = env_int("TG_CHAT_BURST", 3)
+TG_GROUP_RATE = env_float("TG_GROUP_RATE", 20 / 60)    # в группу, в секунду
+TG_MAX_RETRIES = env_int("TG_MAX_RETRIES", 3)          # повторов после RetryAfter
+TG_BULK_THRESHOLD = env_int("TG_BULK_THRESHOLD", 1000) # длиннее — «массовый» кусок текста
+TG_API_URL = os.getenv("TG_API_URL")                   # свой Bot API сервер, например http://127.0.0.1:8081
+
+# ---------- Очистка просроченных токенов ----------
+TOKEN_SWEEP_INTERVAL = env_float("TOKEN_SWEEP_INTERVAL", 3600.0)  # 0 — не чистить
+TOKEN_SWEEP_BATCH = env_int("TOKEN_SWEEP_BATCH", 500)
+TOKEN_SWEEP_GRACE = env_float("TOKEN_SWEEP_GRACE", 86400.0)  # сутки после истечения отвечаем «срок истёк»
+
+# ---------- Выдача токенов ----------
+GENTOKEN_MAX_BATCH = env_int("GENTOKEN_MAX_BATCH", 5000)
@@ -0,0 +1,222 @@
+"""Асинхронный слой БД: пул соединений psycopg вместо подключения на каждый запрос."""
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING
+
+import config
+import metrics
+import resilience
+
+if TYPE_CHECKING:
+    from psycopg_pool import AsyncConnectionPool
+
+# psycopg/psycopg_pool импортируются в open_pool(): импорт модуля не тянет драйвер БД
+
+log = logging.getLogger(__name__)
+
+pool: "AsyncConnectionPool | None" = None
+
+# Своя статистика ожидания соединения — по ней подбираем DB_POOL_MIN/MAX
+_stats = {
+    "acquired": 0,
+    "wait_total_ms": 0.0,
+    "wait_max_ms": 0.0,
+    "retries": 0,
+    "reconnect_failed": 0,
+}
+
+_stats_task: asyncio.Task | None = None
+
+_breaker = resilience.breaker("postgres")
+_retries = resilience.retry_budget("postgres")
+
+
+def _on_reconnect_failed(p: "AsyncConnectionPool"):
+    _stats["reconnect_failed"] += 1
+    log.error("DB pool %s: не удалось переподключиться за %.0f с", p.name, config.DB_POOL_RECONNECT_TIMEOUT)
+
+
+async def open_pool() -> "AsyncConnectionPool":
+    """Открыть пул (идемпотентно). Вызывается из post_init приложения."""
+    global pool, _stats_task
+    if pool is not None:
+        return pool
+    from psycopg.rows import dict_row
+    from psycopg_pool import AsyncConnectionPool
+    pool = AsyncConnectionPool(
+        config.DATABASE_URL,
+        min_size=config.DB_POOL_MIN,
+        max_size=max(config.DB_POOL_MAX, config.DB_POOL_MIN),
+        kwargs=dict(
+            sslmode="require",
+            autocommit=True,
+            row_factory=dict_row,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=5,
+        ),
+        # перед выдачей соединение проверяется — битые выкидываются и заменяются
+        check=AsyncConnectionPool.check_connection,
+        timeout=config.DB_POOL_TIMEOUT,
+        max_idle=config.DB_POOL_MAX_IDLE,
+        reconnect_timeout=config.DB_POOL_RECONNECT_TIMEOUT,
+        reconnect_failed=_on_reconnect_failed,
+        name="jtbd",
+        open=False,
+    )
+    await pool.open(wait=True, timeout=config.DB_POOL_TIMEOUT)
+    if config.DB_POOL_STATS_INTERVAL > 0:
+        _stats_task = asyncio.create_task(_log_stats_loop(config.DB_POOL_STATS_INTERVAL))
+    return pool
+
+
+async def close_pool():
+    global pool, _stats_task
+    if _stats_task is not None:
+        _stats_task.cancel()
+        _stats_task = None
+    if pool is not None:
+        await pool.close()
+        pool = None
+
+
+async def db_run(sql: str, args: tuple | dict = (), fetch: str | None = None):
+    """
+    Выполнить SQL на соединении из пула.
+    fetch=None -> execute (без fetch)
+    fetch='one' -> fetchone()
+    fetch='all' -> fetchall()
+    При обрыве соединения — один повтор на другом соединении из пула, после паузы с джиттером
+    и только в пределах бюджета повторов. Открытый breaker — сразу CircuitOpen.
+    """
+    if pool is None:
+        raise RuntimeError("DB pool is not open: call db.open_pool() first")
+    import psycopg
+    statement = metrics.statement_name(sql)
+    _breaker.before_call()
+    _retries.record_call()
+    for attempt in (1, 2):
+        try:
+            t0 = time.perf_counter()
+            async with pool.connection() as conn:
+                _record_wait((time.perf_counter() - t0) * 1000)
+                async with conn.cursor() as cur:
+                    with metrics.DB_SECONDS.time(statement=statement):
+                        await cur.execute(sql, args)
+                        if fetch == "one":
+                            result = await cur.fetchone()
+                        elif fetch == "all":
+                            result = await cur.fetchall()
+                        else:
+                            result = None
+            _breaker.record_success()
+            return result
+        except psycopg.OperationalError:
+            metrics.DB_ERRORS.inc(statement=statement)
+            _breaker.record_failure()
+            # битое соединение пул выбросит сам при возврате
+            if attempt == 2 or _breaker.rejecting() or not _retries.try_retry():
+                raise
+            _stats["retries"] += 1
+            delay = resilience.backoff(0)
+            log.warning("DB: обрыв соединения, повтор через %.2f с", delay)
+            await asyncio.sleep(delay)
+        except psycopg.Error:
+            metrics.DB_ERRORS.inc(statement=statement)
+            _breaker.record_success()  # БД ответила: ошибка в запросе, а не в доступности
+            raise
+        except BaseException:
+            _breaker.record_ignored()
+            raise
+
+
+async def db_run_many(sql: str, rows: list[tuple]):
+    """executemany одной транзакцией на одном соединении (psycopg шлёт его пайплайном)."""
+    if pool is None:
+        raise RuntimeError("DB pool is not open: call db.open_pool() first")
+    if not rows:
+        return
+    import psycopg
+    _breaker.before_call()
+    t0 = time.perf_counter()
+    try:
+        async with pool.connection() as conn:
+            _record_wait((time.perf_counter() - t0) * 1000)
+            with metrics.DB_SECONDS.time(statement=metrics.statement_name(sql) + " (batch)"):
+                async with conn.transaction():
+                    async with conn.cursor() as cur:
+                        await cur.executemany(sql, rows)
+    except psycopg.OperationalError:
+        _breaker.record_failure()
+        raise
+    except psycopg.Error:
+        _breaker.record_success()
+        raise
+    except BaseException:
+        _breaker.record_ignored()
+        raise
+    _breaker.record_success()
+
+
+def unavailable(exc: BaseException) -> bool:
+    """Ошибка доступности БД (обрыв, таймаут пула, открытый breaker), а не ошибка самого запроса."""
+    if isinstance(exc, resilience.CircuitOpen):
+        return True
+    import psycopg
+    return isinstance(exc, psycopg.OperationalError)
+
+
+async def listen(channel: str, on_notify, on_connect=None):
+    """Фоновая задача: LISTEN channel на отдельном соединении (вне пула), с переподключением.
+
+    on_notify(payload) вызывается на каждое уведомление, on_connect() — после каждого
+    (пере)подключения: уведомления за время обрыва потеряны, их надо добрать самому.
+    """
+    import psycopg
+    failures = 0
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(
+                config.DATABASE_URL, sslmode="require", autocommit=True,
+                keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=5,
+            ) as conn:
+                await conn.execute(f"LISTEN {channel}")
+                if on_connect is not None:
+                    await on_connect()
+                failures = 0
+                async for notify in conn.notifies():
+                    await on_notify(notify.payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            delay = resilience.backoff(failures, base=1.0, cap=60.0)
+            failures += 1
+            log.warning("LISTEN %s: соединение потеряно (%s), повтор через %.0f с", channel, e, delay)
+            await asyncio.sleep(delay)
+
+
+def _record_wait(ms: float):
+    _stats["acquired"] += 1
+    _stats["wait_total_ms"] += ms
+    if ms > _stats["wait_max_ms"]:
+        _stats["wait_max_ms"] = ms
+
+
+def pool_stats() -> dict:
+    """Состояние пула и время ожидания соединения (для подбора размеров)."""
+    stats = dict(_stats)
+    stats["wait_avg_ms"] = stats["wait_total_ms"] / stats["acquired"] if stats["acquired"] else 0.0
+    if pool is not None:
+        # pool_size, pool_available, requests_waiting, requests_wait_ms, ...
+        stats.update(pool.get_stats())
+    return stats
+
+
+async def _log_stats_loop(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        s = pool_stats()
+        log.info(
+            "DB pool: size=%s available=%s waiting=%s wait_avg=%.1fms wait_max=%.1fms retries=%s",
+            s.get("pool_size"), s.get("pool_available"), s.get("requests_waiting"),
+            s["wait_avg_ms"], s["wait_max_ms"], s["retries"],
+        )
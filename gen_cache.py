@@ -0,0 +1,187 @@
+"""Кэш генераций LLM по хэшу (модель, версия шаблона, messages, параметры).
+
+Два уровня: LRU в памяти и постоянный (таблица llm_cache в Postgres или файлы на диске), оба с TTL.
+Явные «сгенерируй заново» обходят кэш на чтение, но перезаписывают его.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import config
+from db import db_run
+
+log = logging.getLogger(__name__)
+
+
+def cache_key(model: str, template: str, messages: list[dict], params: dict) -> str:
+    payload = json.dumps(
+        {"model": model, "template": template, "messages": messages, "params": params},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class PostgresTier:
+    async def get(self, key: str):
+        row = await db_run(
+            "SELECT body, tokens, latency_ms FROM llm_cache WHERE key=%s AND expires_at > now()",
+            (key,), fetch="one",
+        )
+        return (row["body"], row["tokens"], row["latency_ms"]) if row else None
+
+    async def put(self, key: str, body: str, tokens: int, latency_ms: int, ttl: float):
+        await db_run(
+            "INSERT INTO llm_cache(key, body, tokens, latency_ms, expires_at) "
+            "VALUES(%s,%s,%s,%s, now() + make_interval(secs => %s)) "
+            "ON CONFLICT (key) DO UPDATE SET body=EXCLUDED.body, tokens=EXCLUDED.tokens, "
+            "latency_ms=EXCLUDED.latency_ms, expires_at=EXCLUDED.expires_at",
+            (key, body, tokens, latency_ms, ttl),
+        )
+
+    async def purge(self):
+        await db_run("DELETE FROM llm_cache WHERE expires_at <= now()")
+
+
+class DiskTier:
+    def __init__(self, path: str):
+        self.path = path
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key + ".json")
+
+    def _get(self, key: str):
+        try:
+            with open(self._file(key), encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data["expires_at"] <= time.time():
+            return None
+        return data["body"], data["tokens"], data["latency_ms"]
+
+    def _put(self, key: str, body: str, tokens: int, latency_ms: int, ttl: float):
+        path = self._file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"body": body, "tokens": tokens, "latency_ms": latency_ms,
+                       "expires_at": time.time() + ttl}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def _purge(self):
+        now = time.time()
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                full = os.path.join(root, name)
+                try:
+                    with open(full, encoding="utf-8") as f:
+                        if json.load(f)["expires_at"] <= now:
+                            os.remove(full)
+                except (OSError, ValueError, KeyError):
+                    continue
+
+    async def get(self, key: str):
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key: str, body: str, tokens: int, latency_ms: int, ttl: float):
+        await asyncio.to_thread(self._put, key, body, tokens, latency_ms, ttl)
+
+    async def purge(self):
+        await asyncio.to_thread(self._purge)
+
+
+class GenerationCache:
+    def __init__(self, *, enabled: bool, max_items: int, ttl: float, persistent=None):
+        self.enabled = enabled
+        self.max_items = max_items
+        self.ttl = ttl
+        self.persistent = persistent
+        # key -> (body, tokens, latency_ms, expires_monotonic)
+        self._memory: OrderedDict[str, tuple[str, int, int, float]] = OrderedDict()
+        self._stats = {
+            "hits_memory": 0, "hits_persistent": 0, "misses": 0, "bypassed": 0,
+            "stores": 0, "tokens_saved": 0, "latency_saved_ms": 0, "persistent_errors": 0,
+        }
+
+    async def get(self, key: str) -> str | None:
+        entry = self._memory.get(key)
+        if entry is not None and entry[3] > time.monotonic():
+            self._memory.move_to_end(key)
+            self._hit("hits_memory", entry[1], entry[2])
+            return entry[0]
+        if entry is not None:
+            del self._memory[key]
+        if self.persistent is not None:
+            try:
+                found = await self.persistent.get(key)
+            except Exception as e:
+                self._stats["persistent_errors"] += 1
+                log.warning("gen_cache: постоянный уровень недоступен: %s", e)
+                found = None
+            if found is not None:
+                body, tokens, latency_ms = found
+                self._remember(key, body, tokens, latency_ms)
+                self._hit("hits_persistent", tokens, latency_ms)
+                return body
+        self._stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, body: str, tokens: int, latency_ms: int):
+        self._remember(key, body, tokens, latency_ms)
+        self._stats["stores"] += 1
+        if self.persistent is not None:
+            try:
+                await self.persistent.put(key, body, tokens, latency_ms, self.ttl)
+            except Exception as e:
+                self._stats["persistent_errors"] += 1
+                log.warning("gen_cache: не удалось сохранить: %s", e)
+
+    def note_bypass(self):
+        self._stats["bypassed"] += 1
+
+    def _remember(self, key, body, tokens, latency_ms):
+        self._memory[key] = (body, tokens, latency_ms, time.monotonic() + self.ttl)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _hit(self, kind: str, tokens: int, latency_ms: int):
+        self._stats[kind] += 1
+        self._stats["tokens_saved"] += tokens
+        self._stats["latency_saved_ms"] += latency_ms
+
+    async def purge_loop(self, interval: float = 3600.0):
+        while True:
+            await asyncio.sleep(interval)
+            if self.persistent is not None:
+                try:
+                    await self.persistent.purge()
+                except Exception as e:
+                    log.warning("gen_cache: очистка не удалась: %s", e)
+
+    def stats(self) -> dict:
+        s = dict(self._stats)
+        hits = s["hits_memory"] + s["hits_persistent"]
+        s["hit_rate"] = hits / (hits + s["misses"]) if hits + s["misses"] else 0.0
+        s["memory_items"] = len(self._memory)
+        return s
+
+
+def _make_persistent():
+    if config.GEN_CACHE_PERSIST == "postgres":
+        return PostgresTier()
+    if config.GEN_CACHE_PERSIST == "disk":
+        return DiskTier(config.GEN_CACHE_DIR)
+    return None
+
+
+gen_cache = GenerationCache(
+    enabled=config.GEN_CACHE_ENABLED,
+    max_items=config.GEN_CACHE_MAX_ITEMS,
+    ttl=config.GEN_CACHE_TTL,
+    persistent=_make_persistent(),
+)
@@ -0,0 +1,224 @@
+"""Нарезка HTML-текста на сообщения Telegram.
+
+- режет по границам сегментов, абзацев, строк, предложений и только в крайнем случае — слов;
+- не рвёт теги: открытые теги закрываются в конце куска и заново открываются в следующем;
+- длину считает как Telegram — в UTF-16 единицах видимого текста (без тегов, сущности = 1 символ);
+- набивает куски как можно ближе к лимиту, чтобы сообщений было меньше: граница сегмента
+  выигрывает, только если кусок до неё почти полный (MIN_FILL);
+- работает инкрементально: feed() по мере стрима отдаёт уже закрытые куски.
+
+Неподдерживаемые Telegram теги и «голые» <, >, & экранируются.
+"""
+import html
+import re
+
+LIMIT = 4096
+
+ALLOWED_TAGS = {
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre",
+    "span", "tg-spoiler", "tg-emoji", "blockquote",
+}
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)((?:\s[^<>]*)?)>")
+_ENTITY_RE = re.compile(r"&(?:lt|gt|amp|quot|#\d{1,7}|#x[0-9a-fA-F]{1,6});")
+_BREAK_RE = re.compile(r"\n[ \t]*\n\s*|\n|(?<=[.!?…])[ \t]+|[ \t]+")
+
+# сила границы после куска
+NO_BREAK, WORD, SENTENCE, LINE, PARAGRAPH, SEGMENT = -1, 0, 1, 2, 3, 4
+
+# граница годится для разреза, только если сообщение до неё заполнено хотя бы на эту долю
+# лимита: чем сильнее граница, тем ближе к лимиту. Иначе ради «красивого» разреза по
+# сегментам сообщений выходит больше, чем нужно; не нашлось ни одной — режем по последней любой
+MIN_FILL = {SEGMENT: 0.9, PARAGRAPH: 0.8, LINE: 0.8, SENTENCE: 0.6, WORD: 0.6}
+
+
+def utf16_len(text: str) -> int:
+    return len(text) + sum(1 for ch in text if ord(ch) > 0xFFFF)
+
+
+def to_plain(fragment: str) -> str:
+    """Видимый текст HTML-фрагмента (как его покажет Telegram)."""
+    return html.unescape(_TAG_RE.sub("", fragment))
+
+
+class _Piece:
+    __slots__ = ("raw", "vis", "brk", "stack")
+
+    def __init__(self, raw: str, vis: int, brk: int, stack: tuple):
+        self.raw = raw          # готовый HTML
+        self.vis = vis          # видимая длина в UTF-16
+        self.brk = brk          # можно ли резать сразу после куска и насколько это хорошо
+        self.stack = stack      # открытые теги после куска: ((name, raw_open), ...)
+
+
+class HtmlChunker:
+    def __init__(self, limit: int = LIMIT):
+        self.limit = limit
+        self._buf = ""                     # ещё не разобранный хвост стрима
+        self._stack: tuple = ()            # открытые теги после последнего куска
+        self._prefix_stack: tuple = ()     # открытые теги на начало текущего сообщения
+        self._cur: list[_Piece] = []
+        self._cur_vis = 0
+
+    # ---------- публичное API ----------
+    def feed(self, text: str) -> list[str]:
+        """Добавить текст; вернуть куски, которые уже точно не изменятся."""
+        self._buf += text
+        safe = self._safe_end(self._buf)
+        if safe <= 0:
+            return []
+        head, self._buf = self._buf[:safe], self._buf[safe:]
+        return self._consume(head)
+
+    def close(self) -> list[str]:
+        """Дописать хвост и отдать все оставшиеся куски."""
+        head, self._buf = self._buf, ""
+        out = self._consume(head)
+        if self._cur:
+            out.extend(self._emit(len(self._cur)))
+        return out
+
+    def pending_plain(self) -> str:
+        """Видимый текст ещё не отданной части (для промежуточного показа при стриминге)."""
+        return to_plain("".join(p.raw for p in self._cur) + self._buf)
+
+    # ---------- разбор ----------
+    @staticmethod
+    def _safe_end(buf: str) -> int:
+        # не трогаем незакрытый тег/сущность и последнее (возможно, недописанное) слово с пробелами после него
+        lt = buf.rfind("<")
+        if lt != -1 and buf.find(">", lt) == -1 and len(buf) - lt < 256:
+            buf = buf[:lt]
+        amp = buf.rfind("&")
+        if amp != -1 and buf.find(";", amp) == -1 and len(buf) - amp < 10:
+            buf = buf[:amp]
+        m = re.search(r"\S*\s*$", buf)
+        end = m.start() if m else len(buf)
+        # пробел внутри тега с атрибутами (<a href="...">) — не место для разреза
+        lt = buf.rfind("<", 0, end)
+        if lt != -1 and buf.find(">", lt, end) == -1:
+            end = lt
+        return end
+
+    def _consume(self, text: str) -> list[str]:
+        out = []
+        pos = 0
+        for m in _TAG_RE.finditer(text):
+            out.extend(self._text(text[pos:m.start()]))
+            out.extend(self._tag(m))
+            pos = m.end()
+        out.extend(self._text(text[pos:]))
+        return out
+
+    def _tag(self, m: re.Match) -> list[str]:
+        closing, name = m.group(1) == "/", m.group(2).lower()
+        if name == "br":
+            return self._text("\n")
+        if name not in ALLOWED_TAGS:
+            return self._text(m.group(0))
+        if closing:
+            names = [n for n, _ in self._stack]
+            if name not in names:
+                return []  # лишний закрывающий тег — выбрасываем
+            # закрываем всё, что открыто внутри (Telegram требует правильной вложенности)
+            idx = len(names) - 1 - names[::-1].index(name)
+            raw = "".join(f"</{n}>" for n, _ in reversed(self._stack[idx:]))
+            self._stack = self._stack[:idx]
+            return self._add(_Piece(raw, 0, NO_BREAK, self._stack))
+        # «\n\n<b>Сегмент…» — граница сегмента, лучшее место для разреза
+        if name in ("b", "strong") and self._cur and self._cur[-1].brk == PARAGRAPH:
+            self._cur[-1].brk = SEGMENT
+        self._stack = self._stack + ((name, m.group(0)),)
+        return self._add(_Piece(m.group(0), 0, NO_BREAK, self._stack))
+
+    def _text(self, text: str) -> list[str]:
+        out = []
+        pos = 0
+        for m in _BREAK_RE.finditer(text):
+            sep = m.group(0)
+            if "\n" in sep:
+                brk = PARAGRAPH if sep.count("\n") >= 2 else LINE
+            elif m.start() > 0 and text[m.start() - 1] in ".!?…":
+                brk = SENTENCE
+            else:
+                brk = WORD
+            out.extend(self._word(text[pos:m.end()], brk))
+            pos = m.end()
+        if pos < len(text):
+            out.extend(self._word(text[pos:], NO_BREAK))
+        return out
+
+    def _word(self, text: str, brk: int) -> list[str]:
+        raw, vis = _escape(text)
+        if vis <= self.limit:
+            return self._add(_Piece(raw, vis, brk, self._stack))
+        # слово длиннее лимита — режем посимвольно
+        out = []
+        step = self.limit // 2
+        for i in range(0, len(text), step):
+            part = text[i:i + step]
+            raw, vis = _escape(part)
+            out.extend(self._add(_Piece(raw, vis, brk if i + step >= len(text) else WORD, self._stack)))
+        return out
+
+    # ---------- упаковка ----------
+    def _add(self, piece: _Piece) -> list[str]:
+        out = []
+        while self._cur and self._cur_vis + piece.vis > self.limit:
+            out.extend(self._emit(self._cut_index()))
+        self._cur.append(piece)
+        self._cur_vis += piece.vis
+        return out
+
+    def _cut_index(self) -> int:
+        """Сколько кусков забрать в сообщение: самая сильная граница, до которой сообщение
+        заполнено не меньше MIN_FILL[сила]; иначе последняя любая."""
+        best = best_key = None
+        last_any = None
+        acc = 0
+        for i, p in enumerate(self._cur):
+            acc += p.vis
+            if p.brk == NO_BREAK:
+                continue
+            last_any = i
+            if acc >= self.limit * MIN_FILL[p.brk]:
+                key = (p.brk, i)
+                if best_key is None or key > best_key:
+                    best, best_key = i, key
+        if best is not None:
+            return best + 1
+        if last_any is not None:
+            return last_any + 1
+        return len(self._cur)
+
+    def _emit(self, k: int) -> list[str]:
+        taken, self._cur = self._cur[:k], self._cur[k:]
+        end_stack = taken[-1].stack if taken else self._prefix_stack
+        body = "".join(p.raw for p in taken)
+        opening = "".join(raw for _, raw in self._prefix_stack)
+        closing = "".join(f"</{n}>" for n, _ in reversed(end_stack))
+        self._prefix_stack = end_stack
+        self._cur_vis = sum(p.vis for p in self._cur)
+        chunk = opening + body + closing
+        return [chunk] if to_plain(chunk).strip() else []
+
+
+def _escape(text: str) -> tuple[str, int]:
+    """Экранировать текст для parse_mode=HTML, сохранив валидные сущности; вернуть (html, видимая длина)."""
+    parts = []
+    vis = 0
+    pos = 0
+    for m in _ENTITY_RE.finditer(text):
+        plain = text[pos:m.start()]
+        parts.append(html.escape(plain, quote=False))
+        vis += utf16_len(plain) + utf16_len(html.unescape(m.group(0)))
+        parts.append(m.group(0))
+        pos = m.end()
+    plain = text[pos:]
+    parts.append(html.escape(plain, quote=False))
+    vis += utf16_len(plain)
+    return "".join(parts), vis
+
+
+def split_html(text: str, limit: int = LIMIT) -> list[str]:
+    chunker = HtmlChunker(limit)
+    return chunker.feed(text) + chunker.close()
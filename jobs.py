@@ -0,0 +1,405 @@
+"""Очередь тяжёлых генераций в Postgres (gen_jobs) и воркеры, которые её разбирают.
+
+Бот не генерирует распаковку и JTBD сам: он кладёт задачу в gen_jobs и сразу освобождается
+для интерактивных апдейтов. Воркеры (python bot.py worker, сколько угодно процессов)
+забирают задачи через FOR UPDATE SKIP LOCKED, стримят ответ прямо в чат и помечают задачу
+выполненной. Бот узнаёт об этом по NOTIFY gen_jobs_done и применяет результат к сессии
+(этап, кнопки «что дальше») — сессии живут только в процессе бота.
+
+Жизненный цикл: queued → running → done | failed (после max_attempts), затем applied_at —
+результат применён ботом. Упавший воркер не держит задачу: без heartbeat дольше JOBS_LEASE
+она возвращается в очередь (или становится failed, если попытки исчерпаны).
+Очередь включается явно (JOBS_MODE=queue) вместе с запуском воркеров; по умолчанию
+(JOBS_MODE=inline) задача выполняется прямо в хендлере тем же кодом.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from dataclasses import dataclass, field
+
+import config
+import metrics
+from db import db_run, listen
+
+log = logging.getLogger(__name__)
+
+QUEUED_CHANNEL = "gen_jobs"
+DONE_CHANNEL = "gen_jobs_done"
+
+JOB_WAIT = metrics.Histogram("gen_job_wait_seconds", "Ожидание задачи в очереди до взятия воркером", ("kind",))
+JOB_RUN = metrics.Histogram("gen_job_run_seconds", "Выполнение задачи воркером", ("kind", "outcome"))
+JOB_TOTAL = metrics.Counter("gen_jobs_total", "Задачи по исходу: done, retry, failed, lease_lost", ("kind", "outcome"))
+
+_queue_stats: dict[str, float] = {}
+metrics.Gauge("gen_jobs_queue", "Очередь генераций: число задач и возраст старейшей по статусу", ("key",),
+              collect=lambda: _queue_stats)
+
+# (номер процесса, число процессов): результаты применяет процесс, владеющий чатом
+# (в webhook-режиме чат живёт в воркере chat_id % N, как в Python — и для отрицательных id)
+shard = (0, 1)
+
+
+@dataclass
+class Job:
+    id: int | None
+    chat_id: int
+    kind: str
+    payload: dict
+    result: dict = field(default_factory=dict)
+    status: str = "queued"
+    attempts: int = 0
+    max_attempts: int = 1
+    last_error: str | None = None
+    created_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class JobKind:
+    run: object        # async (bot, job, checkpoint) -> dict: выполняется воркером
+    on_done: object    # async (bot, job): в процессе бота, job.status — done или failed
+
+
+_kinds: dict[str, JobKind] = {}
+
+
+def register(kind: str, run, on_done):
+    _kinds[kind] = JobKind(run, on_done)
+
+
+def _row_to_job(row: dict) -> Job:
+    return Job(
+        id=row["id"], chat_id=row["chat_id"], kind=row["kind"], payload=row["payload"],
+        result=row.get("result") or {}, status=row.get("status", "running"),
+        attempts=row.get("attempts", 0), max_attempts=row.get("max_attempts", 1),
+        last_error=row.get("last_error"), created_at=row["created_at"].timestamp(),
+    )
+
+
+# ---------- постановка (процесс бота) ----------
+async def submit(kind: str, chat_id: int, payload: dict, bot, *, max_attempts: int | None = None) -> Job:
+    """Поставить генерацию в очередь (или выполнить сразу в режиме inline)."""
+    job = Job(None, chat_id, kind, payload, max_attempts=max_attempts or config.JOBS_MAX_ATTEMPTS)
+    if config.JOBS_MODE == "inline":
+        await _run_inline(job, bot)
+        return job
+    row = await db_run(
+        """WITH j AS (
+            INSERT INTO gen_jobs(bot_name, chat_id, kind, payload, max_attempts)
+            VALUES(%s, %s, %s, %s::jsonb, %s) RETURNING id
+        ) SELECT id, pg_notify(%s, '') AS _ FROM j""",
+        (config.BOT_NAME, chat_id, kind, json.dumps(payload, ensure_ascii=False), job.max_attempts, QUEUED_CHANNEL),
+        fetch="one",
+    )
+    job.id = row["id"]
+    return job
+
+
+async def pending(job_id: int) -> bool:
+    """Результат задачи ещё впереди: она ждёт, выполняется или её результат ещё не применён."""
+    row = await db_run("SELECT applied_at IS NULL AS pending FROM gen_jobs WHERE id = %s", (job_id,), fetch="one")
+    return bool(row and row["pending"])
+
+
+async def _run_inline(job: Job, bot):
+    spec = _kinds[job.kind]
+
+    async def checkpoint(result: dict):
+        job.result = dict(result)
+
+    t0 = time.perf_counter()
+    try:
+        job.result = await spec.run(bot, job, checkpoint)
+        job.status = "done"
+    except Exception as e:
+        log.warning("job %s (inline) для чата %s: %s", job.kind, job.chat_id, e)
+        job.status, job.last_error = "failed", str(e)
+    JOB_RUN.observe(time.perf_counter() - t0, kind=job.kind, outcome=job.status)
+    JOB_TOTAL.inc(kind=job.kind, outcome=job.status)
+    await spec.on_done(bot, job)
+
+
+# ---------- применение результатов (процесс бота) ----------
+class ResultApplier:
+    """Забирает завершённые задачи своих чатов и вызывает on_done в порядке апдейтов чата.
+
+    run_in_chat(chat_id, coro_fn) — как выполнить on_done; по умолчанию сразу.
+    """
+
+    def __init__(self, bot, run_in_chat=None):
+        self.bot = bot
+        self.run_in_chat = run_in_chat
+        self._wake = asyncio.Event()
+
+    async def run(self):
+        listener = asyncio.create_task(listen(DONE_CHANNEL, self._on_notify, self._on_notify))
+        try:
+            while True:
+                self._wake.clear()
+                try:
+                    while await self._apply_batch():
+                        pass
+                except Exception as e:
+                    log.warning("jobs: не удалось применить результаты: %s", e)
+                try:
+                    await asyncio.wait_for(self._wake.wait(), config.JOBS_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            listener.cancel()
+
+    async def _on_notify(self, payload: str = ""):
+        self._wake.set()
+
+    async def _apply_batch(self) -> bool:
+        index, count = shard
+        rows = await db_run(
+            """UPDATE gen_jobs SET applied_at = now() WHERE id IN (
+                SELECT id FROM gen_jobs
+                WHERE bot_name = %s AND status IN ('done', 'failed') AND applied_at IS NULL
+                  AND (chat_id %% %s + %s) %% %s = %s
+                ORDER BY id LIMIT 50 FOR UPDATE SKIP LOCKED
+            ) RETURNING id, chat_id, kind, payload, result, status, attempts, max_attempts, last_error, created_at""",
+            (config.BOT_NAME, count, count, count, index),
+            fetch="all",
+        )
+        for row in sorted(rows, key=lambda r: r["id"]):
+            job = _row_to_job(row)
+            spec = _kinds.get(job.kind)
+            if spec is None:
+                log.error("jobs: неизвестный тип задачи %s (id %s)", job.kind, job.id)
+                continue
+            call = lambda spec=spec, job=job: spec.on_done(self.bot, job)
+            if self.run_in_chat is not None:
+                self.run_in_chat(job.chat_id, call)
+            else:
+                await call()
+        return len(rows) == 50
+
+
+async def queue_stats_loop():
+    """Фоновая задача: глубина очереди и возраст старейшей задачи для /metrics и логов."""
+    while True:
+        try:
+            rows = await db_run(
+                """SELECT status, count(*) AS n, extract(epoch FROM now() - min(created_at)) AS age
+                   FROM gen_jobs WHERE bot_name = %s AND status IN ('queued', 'running') GROUP BY status""",
+                (config.BOT_NAME,),
+                fetch="all",
+            )
+            stats = {"queued": 0, "running": 0, "queued_oldest_age_s": 0.0, "running_oldest_age_s": 0.0}
+            for row in rows:
+                stats[row["status"]] = row["n"]
+                stats[f"{row['status']}_oldest_age_s"] = float(row["age"] or 0)
+            _queue_stats.clear()
+            _queue_stats.update(stats)
+        except Exception as e:
+            log.warning("jobs: статистика очереди недоступна: %s", e)
+        await asyncio.sleep(config.JOBS_STATS_INTERVAL)
+
+
+# ---------- воркер ----------
+class LeaseLost(Exception):
+    """Аренду задачи забрали (reaper вернул её в очередь): писать в неё воркеру больше нельзя."""
+
+    def __init__(self, job: Job):
+        super().__init__(f"job {job.kind} #{job.id}: аренда потеряна")
+
+
+class JobWorker:
+    def __init__(self, bot, *, concurrency: int, name: str | None = None):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wake = asyncio.Event()
+        self._running: set[asyncio.Task] = set()
+
+    async def run(self, stop: asyncio.Event):
+        helpers = [
+            asyncio.create_task(listen(QUEUED_CHANNEL, self._on_notify, self._on_notify)),
+            asyncio.create_task(self._reaper()),
+            asyncio.create_task(queue_stats_loop()),
+        ]
+        log.info("jobs worker %s: %s слотов", self.name, self.concurrency)
+        try:
+            while not stop.is_set():
+                await self._slots.acquire()
+                try:
+                    job = await self._claim()
+                except Exception as e:
+                    log.warning("jobs: не удалось взять задачу: %s", e)
+                    job = None
+                if job is None:
+                    self._slots.release()
+                    self._wake.clear()
+                    waiters = [asyncio.ensure_future(self._wake.wait()), asyncio.ensure_future(stop.wait())]
+                    await asyncio.wait(waiters, timeout=config.JOBS_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                    for w in waiters:
+                        w.cancel()
+                    continue
+                task = asyncio.create_task(self._execute(job))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                task.add_done_callback(lambda _: self._slots.release())
+        finally:
+            for h in helpers:
+                h.cancel()
+            if self._running:
+                log.info("jobs worker: дорабатываем %s задач", len(self._running))
+                _, pending = await asyncio.wait(self._running, timeout=config.JOBS_DRAIN_TIMEOUT)
+                for task in pending:
+                    task.cancel()  # задача вернётся в очередь по истечении аренды
+
+    async def _on_notify(self, payload: str = ""):
+        self._wake.set()
+
+    async def _claim(self) -> Job | None:
+        row = await db_run(
+            """UPDATE gen_jobs SET status = 'running', attempts = attempts + 1, locked_at = now(), locked_by = %s
+               WHERE id = (
+                   SELECT id FROM gen_jobs
+                   WHERE bot_name = %s AND status = 'queued' AND run_at <= now()
+                   ORDER BY run_at, id LIMIT 1 FOR UPDATE SKIP LOCKED
+               ) RETURNING id, chat_id, kind, payload, result, attempts, max_attempts, created_at""",
+            (self.name, config.BOT_NAME),
+            fetch="one",
+        )
+        if row is None:
+            return None
+        job = _row_to_job(row)
+        JOB_WAIT.observe(max(time.time() - job.created_at, 0), kind=job.kind)
+        return job
+
+    async def _execute(self, job: Job):
+        spec = _kinds.get(job.kind)
+        t0 = time.perf_counter()
+
+        async def work():
+            if spec is None:
+                raise RuntimeError(f"неизвестный тип задачи {job.kind}")
+            return await spec.run(self.bot, job, lambda res: self._checkpoint(job, res))
+
+        run = asyncio.ensure_future(work())
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            # heartbeat заканчивается сам, только если аренду забрали — тогда прерываем генерацию
+            await asyncio.wait((run, heartbeat), return_when=asyncio.FIRST_COMPLETED)
+            if not run.done():
+                raise LeaseLost(job)
+            await self._finish(job, run.result())
+            outcome = "done"
+        except LeaseLost as e:
+            log.warning("%s — прерываем, результат не применяем", e)
+            outcome = "lease_lost"
+        except Exception as e:
+            outcome = await self._fail(job, e)
+        finally:
+            # и при отмене: без heartbeat задача вернётся в очередь по аренде
+            heartbeat.cancel()
+            run.cancel()
+            await asyncio.gather(run, heartbeat, return_exceptions=True)
+        JOB_RUN.observe(time.perf_counter() - t0, kind=job.kind, outcome=outcome)
+        JOB_TOTAL.inc(kind=job.kind, outcome=outcome)
+
+    # Все записи воркера — только пока задача за ним (locked_by) и выполняется: после истечения
+    # аренды reaper мог вернуть её в очередь, и её уже ведёт другой воркер.
+    async def _heartbeat(self, job: Job):
+        """Продлевает аренду; завершается, только если задачу у воркера забрали."""
+        # сбой одного продления не должен останавливать остальные: до истечения аренды их ещё два
+        while True:
+            await asyncio.sleep(config.JOBS_LEASE / 3)
+            try:
+                row = await db_run(
+                    "UPDATE gen_jobs SET locked_at = now() WHERE id = %s AND locked_by = %s AND status = 'running' "
+                    "RETURNING id",
+                    (job.id, self.name), fetch="one",
+                )
+            except Exception as e:
+                log.warning("job %s #%s: heartbeat не прошёл: %s", job.kind, job.id, e)
+                continue
+            if row is None:
+                return
+
+    async def _checkpoint(self, job: Job, result: dict):
+        """Промежуточный результат: повтор после сбоя не переделывает готовые шаги."""
+        job.result = dict(result)
+        row = await db_run(
+            "UPDATE gen_jobs SET result = %s::jsonb, locked_at = now() "
+            "WHERE id = %s AND locked_by = %s AND status = 'running' RETURNING id",
+            (json.dumps(job.result, ensure_ascii=False), job.id, self.name), fetch="one",
+        )
+        if row is None:
+            raise LeaseLost(job)
+
+    async def _finish(self, job: Job, result: dict):
+        row = await db_run(
+            """WITH j AS (
+                UPDATE gen_jobs SET status = 'done', result = %s::jsonb, finished_at = now(), locked_by = NULL
+                WHERE id = %s AND locked_by = %s AND status = 'running' RETURNING id
+            ) SELECT pg_notify(%s, id::text) AS _ FROM j""",
+            (json.dumps(result, ensure_ascii=False), job.id, self.name, DONE_CHANNEL),
+            fetch="one",
+        )
+        if row is None:
+            raise LeaseLost(job)
+
+    async def _fail(self, job: Job, error: Exception) -> str:
+        final = job.attempts >= job.max_attempts
+        log.warning("job %s #%s (чат %s), попытка %s/%s: %s",
+                    job.kind, job.id, job.chat_id, job.attempts, job.max_attempts, error)
+        if not final:
+            delay = config.JOBS_RETRY_BASE * 2 ** (job.attempts - 1)
+            row = await db_run(
+                """UPDATE gen_jobs SET status = 'queued', locked_by = NULL, last_error = %s,
+                   run_at = now() + make_interval(secs => %s)
+                   WHERE id = %s AND locked_by = %s AND status = 'running' RETURNING id""",
+                (str(error)[:1000], delay, job.id, self.name),
+                fetch="one",
+            )
+            return "retry" if row is not None else "lease_lost"
+        row = await db_run(
+            """WITH j AS (
+                UPDATE gen_jobs SET status = 'failed', locked_by = NULL, last_error = %s, finished_at = now()
+                WHERE id = %s AND locked_by = %s AND status = 'running' RETURNING id
+            ) SELECT pg_notify(%s, id::text) AS _ FROM j""",
+            (str(error)[:1000], job.id, self.name, DONE_CHANNEL),
+            fetch="one",
+        )
+        return "failed" if row is not None else "lease_lost"
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(config.JOBS_LEASE / 2)
+            try:
+                await self.reap()
+            except Exception as e:
+                log.warning("jobs: reaper: %s", e)
+
+    async def reap(self) -> tuple[int, int]:
+        """Задачи упавших воркеров (нет heartbeat дольше аренды): обратно в очередь, а исчерпавшие
+        попытки — в failed (бот применит их как неудачные). Возвращает (в очередь, failed)."""
+        row = await db_run(
+            """WITH r AS (
+                UPDATE gen_jobs SET
+                    status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                    finished_at = CASE WHEN attempts >= max_attempts THEN now() END,
+                    locked_by = NULL, last_error = 'lease expired'
+                WHERE status = 'running' AND bot_name = %s
+                  AND locked_at < now() - make_interval(secs => %s)
+                RETURNING status
+            ) SELECT count(*) FILTER (WHERE status = 'queued') AS requeued,
+                     count(*) FILTER (WHERE status = 'failed') AS failed FROM r""",
+            (config.BOT_NAME, config.JOBS_LEASE),
+            fetch="one",
+        )
+        requeued, failed = row["requeued"], row["failed"]
+        if requeued:
+            log.warning("jobs: вернули в очередь зависших задач: %s", requeued)
+        if failed:
+            log.warning("jobs: зависшие задачи без попыток — failed: %s", failed)
+            await db_run("SELECT pg_notify(%s, '')", (DONE_CHANNEL,))
+        return requeued, failed
+
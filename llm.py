@@ -0,0 +1,390 @@
+"""Асинхронный шлюз к OpenAI: общий keep-alive пул, таймауты по назначению вызова, лимит одновременных запросов.
+
+Все вызовы модели идут через chat(): так генерация одного пользователя не блокирует
+event loop, а тяжёлые запросы не занимают больше LLM_MAX_INFLIGHT слотов.
+Короткие вызовы, от которых зависит темп диалога (комментарий коуча), идут через
+chat_tiered(): жёсткий дедлайн, хедж-запрос и запасная модель (POLICIES).
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import config
+import metrics
+import resilience
+from gen_cache import cache_key, gen_cache
+
+if TYPE_CHECKING:
+    import aiohttp
+
+log = logging.getLogger(__name__)
+
+_openai = None
+
+# Таймауты (сек) по назначению вызова; переопределяются LLM_TIMEOUT_<PURPOSE>, например LLM_TIMEOUT_JTBD=180
+TIMEOUTS = {
+    "comment": config.env_float("LLM_TIMEOUT_COMMENT", 20.0),
+    "unpack": config.env_float("LLM_TIMEOUT_UNPACK", 90.0),
+    "unpack_part": config.env_float("LLM_TIMEOUT_UNPACK_PART", 60.0),
+    "positioning": config.env_float("LLM_TIMEOUT_POSITIONING", 90.0),
+    "bio": config.env_float("LLM_TIMEOUT_BIO", 30.0),
+    "product": config.env_float("LLM_TIMEOUT_PRODUCT", 30.0),
+    "jtbd": config.env_float("LLM_TIMEOUT_JTBD", 150.0),
+    "jtbd_more": config.env_float("LLM_TIMEOUT_JTBD_MORE", 150.0),
+    "jtbd_titles": config.env_float("LLM_TIMEOUT_JTBD_TITLES", 30.0),
+    "jtbd_segment": config.env_float("LLM_TIMEOUT_JTBD_SEGMENT", 60.0),
+    "digest": config.env_float("LLM_TIMEOUT_DIGEST", 60.0),
+}
+
+_session: "aiohttp.ClientSession | None" = None
+_semaphore: asyncio.Semaphore | None = None
+
+_stats = {"calls": 0, "errors": 0, "timeouts": 0, "inflight": 0, "waiting": 0, "slot_wait_max_ms": 0.0}
+
+
+def _sdk():
+    """Модуль openai (вместе с aiohttp) импортируется при первом вызове модели, а не при старте бота."""
+    global _openai
+    if _openai is None:
+        import openai
+        openai.api_key = config.OPENAI_API_KEY
+        if config.OPENAI_API_BASE:
+            openai.api_base = config.OPENAI_API_BASE
+        _openai = openai
+    return _openai
+
+
+def _client() -> tuple["aiohttp.ClientSession", asyncio.Semaphore]:
+    """Общая HTTP-сессия и семафор; создаются лениво внутри работающего event loop."""
+    global _session, _semaphore
+    if _session is None or _session.closed:
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=config.LLM_POOL_SIZE, keepalive_timeout=60, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector)
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(config.LLM_MAX_INFLIGHT)
+    return _session, _semaphore
+
+
+async def warm_up():
+    await asyncio.to_thread(_sdk)
+
+
+async def close_client():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def timeout_for(purpose: str) -> float:
+    return TIMEOUTS.get(purpose, config.LLM_TIMEOUT_DEFAULT)
+
+
+SLOT_WAIT = metrics.Histogram("llm_slot_wait_seconds", "Ожидание слота LLM_MAX_INFLIGHT", ("purpose",))
+
+
+_breaker = resilience.breaker("openai")
+_retries = resilience.retry_budget("openai")
+
+
+def _is_outage(exc: BaseException, openai) -> bool:
+    """Сбой на стороне API (считается breaker'ом), а не ошибка нашего запроса."""
+    return isinstance(exc, (asyncio.TimeoutError, openai.error.Timeout, openai.error.APIError,
+                            openai.error.APIConnectionError, openai.error.ServiceUnavailableError,
+                            openai.error.RateLimitError, openai.error.TryAgain))
+
+
+def available() -> bool:
+    """False — breaker открыт: вызов модели сейчас сразу получит CircuitOpen."""
+    return not _breaker.rejecting()
+
+
+@contextlib.asynccontextmanager
+async def _slot(purpose: str, stream: bool):
+    """Слот семафора + breaker + учёт ожидания, in-flight, ошибок и времени вызова."""
+    _breaker.before_call()
+    session, semaphore = _client()
+    openai = _sdk()
+    t0 = time.perf_counter()
+    _stats["waiting"] += 1
+    try:
+        await semaphore.acquire()
+    except BaseException:
+        _breaker.record_ignored()
+        raise
+    finally:
+        _stats["waiting"] -= 1
+    try:
+        t1 = time.perf_counter()
+        SLOT_WAIT.observe(t1 - t0, purpose=purpose)
+        _stats["slot_wait_max_ms"] = max(_stats["slot_wait_max_ms"], (t1 - t0) * 1000)
+        _stats["inflight"] += 1
+        _stats["calls"] += 1
+        _retries.record_call()
+        # aiosession — ContextVar, выставляем в контексте текущей задачи
+        openai.aiosession.set(session)
+        try:
+            yield
+        except BaseException as e:
+            # SDK превращает отмену (проигравший хедж, остановка) в Timeout — это не сбой API
+            cancelled = isinstance(e, asyncio.CancelledError) or asyncio.current_task().cancelling()
+            if cancelled or not _is_outage(e, openai):
+                _breaker.record_ignored()
+            else:
+                _breaker.record_failure()
+            if isinstance(e, (asyncio.TimeoutError, openai.error.Timeout)):
+                _stats["timeouts"] += 1
+                metrics.LLM_ERRORS.inc(purpose=purpose, kind="timeout")
+            elif isinstance(e, Exception):
+                _stats["errors"] += 1
+                metrics.LLM_ERRORS.inc(purpose=purpose, kind="error")
+            raise
+        else:
+            _breaker.record_success()
+        finally:
+            _stats["inflight"] -= 1
+            metrics.LLM_SECONDS.observe(time.perf_counter() - t1, purpose=purpose, stream=str(stream).lower())
+    finally:
+        semaphore.release()
+
+
+def _cache_key(purpose, cache_version, model, messages, params):
+    if cache_version is None or not gen_cache.enabled:
+        return None
+    return cache_key(model, f"{purpose}:{cache_version}", messages, params)
+
+
+def _estimate_tokens(messages: list[dict], text: str) -> int:
+    # у стрима нет usage: грубая оценка, ~3 символа на токен для русского текста
+    return (sum(len(m["content"]) for m in messages) + len(text)) // 3
+
+
+def _count_tokens(purpose: str, prompt: int, completion: int):
+    metrics.LLM_TOKENS.inc(prompt, purpose=purpose, kind="prompt")
+    metrics.LLM_TOKENS.inc(completion, purpose=purpose, kind="completion")
+
+
+async def chat(messages: list[dict], *, purpose: str, model: str | None = None,
+               timeout: float | None = None, cache_version: int | None = None,
+               refresh: bool = False, **params) -> str:
+    """Один запрос ChatCompletion; возвращает текст ответа.
+
+    purpose — назначение вызова (comment, unpack, jtbd, ...): по нему берётся таймаут.
+    cache_version — включает кэш генераций (версия шаблона промпта входит в ключ);
+    refresh=True — сгенерировать заново, не читая кэш, и перезаписать его.
+    Ошибки OpenAI и таймауты пробрасываются вызывающему.
+    """
+    model = model or config.LLM_MODEL
+    key = _cache_key(purpose, cache_version, model, messages, params)
+    if key is not None:
+        if refresh:
+            gen_cache.note_bypass()
+        else:
+            cached = await gen_cache.get(key)
+            if cached is not None:
+                metrics.LLM_CACHE_HITS.inc(purpose=purpose)
+                return cached
+    t0 = time.perf_counter()
+    async with _slot(purpose, stream=False):
+        resp = await _sdk().ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            request_timeout=timeout or timeout_for(purpose),
+            **params,
+        )
+    text = resp.choices[0].message.content
+    usage = resp.get("usage") or {}
+    if usage:
+        _count_tokens(purpose, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    else:
+        _count_tokens(purpose, _estimate_tokens(messages, ""), len(text) // 3)
+    if key is not None:
+        tokens = usage.get("total_tokens") or _estimate_tokens(messages, text)
+        await gen_cache.put(key, text, tokens, int((time.perf_counter() - t0) * 1000))
+    return text
+
+
+async def chat_stream(messages: list[dict], *, purpose: str, model: str | None = None,
+                      timeout: float | None = None, cache_version: int | None = None,
+                      refresh: bool = False, **params):
+    """То же, что chat(), но отдаёт ответ кусками (async-генератор дельт текста).
+
+    Слот семафора занят до конца стрима; timeout ограничивает весь ответ целиком.
+    Попадание в кэш отдаётся одним куском.
+    """
+    model = model or config.LLM_MODEL
+    key = _cache_key(purpose, cache_version, model, messages, params)
+    if key is not None:
+        if refresh:
+            gen_cache.note_bypass()
+        else:
+            cached = await gen_cache.get(key)
+            if cached is not None:
+                metrics.LLM_CACHE_HITS.inc(purpose=purpose)
+                yield cached
+                return
+    t0 = time.perf_counter()
+    parts = []
+    async with _slot(purpose, stream=True):
+        chunks = await _sdk().ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            request_timeout=timeout or timeout_for(purpose),
+            stream=True,
+            **params,
+        )
+        async for chunk in chunks:
+            delta = chunk.choices[0].get("delta", {}).get("content")
+            if delta:
+                parts.append(delta)
+                yield delta
+    text = "".join(parts)
+    _count_tokens(purpose, _estimate_tokens(messages, ""), len(text) // 3)
+    if key is not None:
+        await gen_cache.put(key, text, _estimate_tokens(messages, text), int((time.perf_counter() - t0) * 1000))
+
+
+# ---------- вызовы с дедлайном: хедж и запасная модель ----------
+@dataclass(frozen=True)
+class LatencyPolicy:
+    deadline: float                    # жёсткий срок на весь вызов, с
+    hedge_quantile: float = 0.9        # второй такой же запрос, если первый дольше этого перцентиля
+    hedge_min: float = 0.5             # но не раньше, чем через столько секунд
+    fallback_model: str | None = None  # быстрая/дешёвая модель, если оба запроса не успевают
+    fallback_at: float = 0.6           # доля deadline, после которой (или когда оба упали) — запрос к ней
+
+
+# Политики по назначению вызова; переопределяются LLM_DEADLINE_<PURPOSE>, LLM_HEDGE_QUANTILE_<PURPOSE>,
+# LLM_FALLBACK_MODEL_<PURPOSE> (по умолчанию LLM_FAST_MODEL)
+POLICIES = {
+    "comment": LatencyPolicy(
+        deadline=config.env_float("LLM_DEADLINE_COMMENT", 8.0),
+        hedge_quantile=config.env_float("LLM_HEDGE_QUANTILE_COMMENT", 0.9),
+        fallback_model=os.getenv("LLM_FALLBACK_MODEL_COMMENT") or config.LLM_FAST_MODEL,
+    ),
+}
+
+TIERED = metrics.Counter("llm_tiered_total", "Вызовы с дедлайном по исходу: primary, hedge, fallback, canned, failed",
+                         ("purpose", "outcome"))
+TIERED_EXTRA = metrics.Counter("llm_tiered_extra_requests_total", "Дополнительные запросы: хедж и запасная модель",
+                               ("purpose", "kind"))
+
+
+class _LatencyWindow:
+    """Последние задержки успешных вызовов — из них берётся порог хеджа."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self._values: deque = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float):
+        self._values.append(seconds)
+
+    def hedge_delay(self, policy: LatencyPolicy) -> float:
+        if len(self._values) < self.min_samples:
+            return max(policy.deadline * 0.4, policy.hedge_min)  # истории ещё нет
+        ordered = sorted(self._values)
+        value = ordered[min(int(len(ordered) * policy.hedge_quantile), len(ordered) - 1)]
+        return min(max(value, policy.hedge_min), policy.deadline)
+
+
+_latency: dict[str, _LatencyWindow] = {}
+
+
+async def _attempt(messages, purpose, model, timeout, params) -> str:
+    t0 = time.perf_counter()
+    text = await chat(messages, purpose=purpose, model=model, timeout=max(timeout, 0.1), **params)
+    if model is None:
+        _latency.setdefault(purpose, _LatencyWindow()).add(time.perf_counter() - t0)
+    return text
+
+
+def _consume_error(task: asyncio.Future):
+    # проигравшие попытки отменяются, а SDK превращает отмену в openai.error.Timeout —
+    # забираем исключение, чтобы asyncio не писал «exception was never retrieved»
+    if not task.cancelled():
+        task.exception()
+
+
+async def chat_tiered(messages: list[dict], *, purpose: str, canned: tuple[str, ...] = (), **params) -> str:
+    """chat() с политикой задержки для purpose: ответ не позже policy.deadline.
+
+    Если первый запрос дольше перцентиля последних задержек — параллельно уходит второй
+    (если свои запросы не ждут слота: при перегрузке хедж только добавит очередь); если
+    и он не успевает — запрос к запасной модели. Оба — в пределах бюджета повторов.
+    Раньше срока они уходят, только если попытка упала по таймауту или сбою API (_is_outage);
+    ошибка самого запроса сразу ведёт к заготовке (или пробрасывается).
+    Открытый breaker — сразу resilience.CircuitOpen. Побеждает первый ответ, остальные отменяются.
+    Не успел никто — случайный ответ из canned, а без него — asyncio.TimeoutError.
+    Без политики для purpose — обычный chat().
+    """
+    policy = POLICIES.get(purpose)
+    if policy is None:
+        return await chat(messages, purpose=purpose, **params)
+    _breaker.check()  # API лежит — не ждём дедлайн и не отвечаем заготовкой, а сразу CircuitOpen
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start + policy.deadline
+    hedge_at = start + _latency.setdefault(purpose, _LatencyWindow()).hedge_delay(policy)
+    fallback_at = start + policy.deadline * policy.fallback_at if policy.fallback_model else None
+    attempts: dict[asyncio.Future, str] = {}
+
+    def launch(kind: str, model: str | None = None):
+        task = asyncio.ensure_future(_attempt(messages, purpose, model, deadline - loop.time(), params))
+        task.add_done_callback(_consume_error)
+        attempts[task] = kind
+        if kind != "primary":
+            TIERED_EXTRA.inc(purpose=purpose, kind=kind)
+
+    launch("primary")
+    last_error: BaseException | None = None
+    openai = _sdk()
+    try:
+        while loop.time() < deadline:
+            pending = {t for t in attempts if not t.done()}
+            if hedge_at is not None and (loop.time() >= hedge_at or not pending):
+                hedge_at = None
+                if _stats["waiting"] == 0 and _retries.try_retry():
+                    launch("hedge")
+            elif fallback_at is not None and (loop.time() >= fallback_at or not pending):
+                fallback_at = None
+                if _retries.try_retry():
+                    launch("fallback", policy.fallback_model)
+            pending = {t for t in attempts if not t.done()}
+            if not pending:
+                break  # все попытки упали, новых не будет
+            wake = min(x for x in (hedge_at, fallback_at, deadline) if x is not None)
+            done, _ = await asyncio.wait(pending, timeout=max(wake - loop.time(), 0),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    TIERED.inc(purpose=purpose, outcome=attempts[task])
+                    return task.result()
+                last_error = task.exception()
+            if last_error is not None and not _is_outage(last_error, openai):
+                # ошибка самого запроса (неверный запрос, ключ, длина контекста): хедж и запасная
+                # модель получат её же — больше не запускаем, сразу заготовка или ошибка
+                break
+    finally:
+        for task in attempts:
+            task.cancel()
+    if canned:
+        log.info("llm %s: ни один запрос не успел за %.1f с (%r), отвечаем заготовкой",
+                 purpose, policy.deadline, last_error)
+        TIERED.inc(purpose=purpose, outcome="canned")
+        return random.choice(canned)
+    TIERED.inc(purpose=purpose, outcome="failed")
+    if last_error is not None:
+        raise last_error
+    raise asyncio.TimeoutError(f"{purpose}: нет ответа за {policy.deadline} с")
+
+
+def stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,208 @@
+"""Метрики в формате Prometheus: гистограммы времени хендлеров, вызовов модели и запросов к БД.
+
+Без внешних зависимостей: счётчики живут в памяти процесса, /metrics отдаёт текстовый формат
+exposition 0.0.4. В webhook-режиме каждый воркер слушает свой порт (METRICS_PORT + 1 + номер),
+фронт отдаёт свои метрики на том же порту, что и webhook.
+"""
+import functools
+import logging
+import math
+import re
+import time
+from contextlib import contextmanager
+
+import config
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+_registry: list["_Metric"] = []
+
+# сдвиг порта /metrics: 0 — одиночный процесс, 1 + i — webhook-воркер i
+port_offset = 0
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), register: bool = True):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        if register:
+            _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, _labels(self.labelnames, key), value
+
+
+class Gauge(_Metric):
+    """Значение считается при каждом запросе /metrics: collect() -> {значения меток: число}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), collect=None, register: bool = True):
+        super().__init__(name, doc, labels, register)
+        self.collect = collect
+
+    def samples(self):
+        try:
+            values = self.collect() if self.collect else {}
+        except Exception as e:  # сломанный сборщик не должен ронять весь /metrics
+            log.warning("metrics: %s: %s", self.name, e)
+            return
+        for key, value in values.items():
+            if not isinstance(value, (int, float)):
+                continue  # в stats() бывают строки и None
+            if not isinstance(key, tuple):
+                key = (key,) if self.labelnames else ()
+            yield self.name, _labels(self.labelnames, key), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series: dict[tuple, list] = {}   # key -> [counts по бакетам..., sum]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def samples(self):
+        for key, series in self._series.items():
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket", _labels(self.labelnames, key, f'le="{_number(bound)}"'), count
+            yield f"{self.name}_sum", _labels(self.labelnames, key), series[-1]
+            yield f"{self.name}_count", _labels(self.labelnames, key), series[len(self.buckets) - 1]
+
+
+def render(registry: list | None = None) -> str:
+    return "\n".join(m.render() for m in (_registry if registry is None else registry)) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ---------- метрики бота ----------
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки апдейта хендлером", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ("handler",))
+
+LLM_SECONDS = Histogram("llm_request_seconds", "Время вызова модели по назначению", ("purpose", "stream"))
+LLM_TOKENS = Counter("llm_tokens_total", "Токены запросов и ответов модели", ("purpose", "kind"))
+LLM_ERRORS = Counter("llm_errors_total", "Ошибки и таймауты вызовов модели", ("purpose", "kind"))
+LLM_CACHE_HITS = Counter("llm_cache_hits_total", "Ответы из кэша генераций (без вызова модели)", ("purpose",))
+
+DB_SECONDS = Histogram("db_query_seconds", "Время запроса к Postgres", ("statement",), buckets=DB_BUCKETS)
+DB_ERRORS = Counter("db_query_errors_total", "Ошибки запросов к Postgres", ("statement",))
+
+
+def track_handler(fn):
+    """Декоратор хендлера PTB: время и исключения по имени функции."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, handler=name)
+
+    return wrapper
+
+
+_STATEMENT_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+([a-zA-Z_][a-zA-Z0-9_]*)", re.IGNORECASE)
+_statement_names: dict[str, str] = {}
+
+
+def statement_name(sql: str) -> str:
+    """Короткая метка запроса: «глагол таблица», например «select allowed_users»."""
+    name = _statement_names.get(sql)
+    if name is None:
+        verb = sql.split(None, 1)[0].lower() if sql.strip() else "?"
+        table = _STATEMENT_RE.search(sql)
+        name = f"{verb} {table.group(1).lower()}" if table else verb
+        if len(_statement_names) < 1000:  # SQL у нас константный, но на всякий случай
+            _statement_names[sql] = name
+    return name
+
+
+# ---------- HTTP ----------
+async def handle_metrics(request):
+    from aiohttp import web
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def serve(port: int | None = None):
+    """Поднять /metrics на METRICS_LISTEN:port; вернуть runner (закрыть через runner.cleanup())."""
+    from aiohttp import web
+    port = (config.METRICS_PORT + port_offset) if port is None else port
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.METRICS_LISTEN, port).start()
+    log.info("metrics: http://%s:%s/metrics", config.METRICS_LISTEN, port)
+    return runner
@@ -0,0 +1,200 @@
+"""Версионные миграции схемы Postgres.
+
+Применённые версии записываются в schema_migrations: каждая миграция выполняется ровно
+один раз, в своей транзакции, на одном соединении. Одновременный старт нескольких
+процессов (webhook-воркеры) разводит advisory lock — второй дождётся первого и увидит,
+что применять уже нечего.
+
+    python migrations.py           # применить недостающие
+    python migrations.py status    # текущая версия и список миграций
+
+Новая миграция — новая запись в конце MIGRATIONS; уже выпущенные записи не меняем.
+SQL каждой миграции записан здесь же, а не взят из модулей: правка кода не должна
+менять то, что уже применено на выпущенных базах.
+"""
+import asyncio
+import logging
+import sys
+import time
+
+import config
+
+log = logging.getLogger(__name__)
+
+# произвольная константа: ключ pg_advisory_lock для миграций этого бота
+_LOCK_KEY = 0x6A74_6264
+
+# (версия, описание, SQL-выражения)
+MIGRATIONS: list[tuple[int, str, tuple[str, ...]]] = [
+    (1, "tokens и allowed_users (общие с кассиром)", (
+        """CREATE TABLE IF NOT EXISTS tokens(
+  token TEXT PRIMARY KEY,
+  bot_name TEXT NOT NULL,
+  user_id BIGINT NOT NULL,
+  expires_at TIMESTAMPTZ NULL
+);""",
+        """CREATE TABLE IF NOT EXISTS allowed_users(
+  user_id BIGINT NOT NULL,
+  bot_name TEXT NOT NULL,
+  PRIMARY KEY(user_id, bot_name)
+);""",
+        "ALTER TABLE tokens ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ NULL;",
+    )),
+    (2, "индекс по сроку токенов для чистки", (
+        "CREATE INDEX IF NOT EXISTS tokens_expires_at_idx ON tokens (expires_at) WHERE expires_at IS NOT NULL;",
+    )),
+    # триггер на allowed_users: кассир удаляет строку -> pg_notify('access_revoked', 'user_id:bot_name')
+    (3, "NOTIFY при отзыве доступа", (
+        """CREATE OR REPLACE FUNCTION notify_access_revoked() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('access_revoked', OLD.user_id::text || ':' || OLD.bot_name);
+  RETURN OLD;
+END
+$$ LANGUAGE plpgsql;""",
+        """DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'allowed_users_revoke') THEN
+    CREATE TRIGGER allowed_users_revoke AFTER DELETE ON allowed_users
+      FOR EACH ROW EXECUTE FUNCTION notify_access_revoked();
+  END IF;
+END
+$$;""",
+    )),
+    (4, "сессии бота", (
+        """CREATE TABLE IF NOT EXISTS bot_sessions(
+  chat_id BIGINT NOT NULL,
+  bot_name TEXT NOT NULL,
+  data JSONB NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY(chat_id, bot_name)
+);""",
+    )),
+    (5, "кэш генераций", (
+        """CREATE TABLE IF NOT EXISTS llm_cache(
+  key TEXT PRIMARY KEY,
+  body TEXT NOT NULL,
+  tokens INTEGER NOT NULL DEFAULT 0,
+  latency_ms INTEGER NOT NULL DEFAULT 0,
+  expires_at TIMESTAMPTZ NOT NULL
+);""",
+    )),
+    (6, "очередь тяжёлых генераций", (
+        """CREATE TABLE IF NOT EXISTS gen_jobs(
+  id BIGSERIAL PRIMARY KEY,
+  bot_name TEXT NOT NULL,
+  chat_id BIGINT NOT NULL,
+  kind TEXT NOT NULL,
+  payload JSONB NOT NULL,
+  result JSONB NULL,
+  status TEXT NOT NULL DEFAULT 'queued',
+  attempts INT NOT NULL DEFAULT 0,
+  max_attempts INT NOT NULL,
+  run_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  locked_at TIMESTAMPTZ NULL,
+  locked_by TEXT NULL,
+  last_error TEXT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at TIMESTAMPTZ NULL,
+  applied_at TIMESTAMPTZ NULL
+);""",
+        "CREATE INDEX IF NOT EXISTS gen_jobs_queued_idx ON gen_jobs (bot_name, run_at, id) WHERE status = 'queued';",
+        "CREATE INDEX IF NOT EXISTS gen_jobs_running_idx ON gen_jobs (locked_at) WHERE status = 'running';",
+        "CREATE INDEX IF NOT EXISTS gen_jobs_unapplied_idx ON gen_jobs (bot_name, id) "
+        "WHERE status IN ('done', 'failed') AND applied_at IS NULL;",
+    )),
+    (7, "готовые результаты пользователей", (
+        """CREATE TABLE IF NOT EXISTS bot_artifacts(
+  user_id BIGINT NOT NULL,
+  bot_name TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  version INTEGER NOT NULL,
+  body BYTEA NOT NULL,
+  digest TEXT NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY(user_id, bot_name, kind, version)
+);""",
+        # body уже сжат zlib — TOAST не пытается сжимать его повторно
+        "ALTER TABLE bot_artifacts ALTER COLUMN body SET STORAGE EXTERNAL;",
+        "CREATE INDEX IF NOT EXISTS bot_artifacts_recent_idx ON bot_artifacts (user_id, bot_name, created_at DESC);",
+    )),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+_VERSIONS_DDL = """CREATE TABLE IF NOT EXISTS schema_migrations(
+  version INT PRIMARY KEY,
+  description TEXT NOT NULL,
+  applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);"""
+
+
+async def _scalar(conn, sql: str):
+    # соединения пула отдают dict-строки — здесь явно просим кортежи
+    from psycopg.rows import tuple_row
+    async with conn.cursor(row_factory=tuple_row) as cur:
+        await cur.execute(sql)
+        return (await cur.fetchone())[0]
+
+
+async def current_version(conn) -> int:
+    if not await _scalar(conn, "SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return 0
+    return await _scalar(conn, "SELECT coalesce(max(version), 0) FROM schema_migrations")
+
+
+async def migrate(conn) -> list[int]:
+    """Применить недостающие миграции на соединении conn (autocommit); вернуть применённые версии."""
+    # быстрый путь обычного рестарта: схема актуальна — ни блокировки, ни DDL
+    if await current_version(conn) >= LATEST:
+        return []
+    applied = []
+    await conn.execute("SELECT pg_advisory_lock(%s)", (_LOCK_KEY,))
+    try:
+        await conn.execute(_VERSIONS_DDL)
+        done = await current_version(conn)
+        for version, description, statements in MIGRATIONS:
+            if version <= done:
+                continue
+            t0 = time.perf_counter()
+            async with conn.transaction():
+                for sql in statements:
+                    await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_migrations(version, description) VALUES(%s, %s)",
+                    (version, description),
+                )
+            applied.append(version)
+            log.info("migration %s (%s): %.0f ms", version, description, (time.perf_counter() - t0) * 1000)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock(%s)", (_LOCK_KEY,))
+    return applied
+
+
+async def _connect():
+    import psycopg
+    return await psycopg.AsyncConnection.connect(config.DATABASE_URL, sslmode="require", autocommit=True)
+
+
+async def _cli(command: str):
+    async with await _connect() as conn:
+        if command == "status":
+            version = await current_version(conn)
+            for v, description, _ in MIGRATIONS:
+                print(f"{'✓' if v <= version else ' '} {v:>3}  {description}")
+            print(f"версия схемы: {version}, последняя: {LATEST}")
+            return
+        applied = await migrate(conn)
+        print(f"применено миграций: {len(applied)}" if applied else f"схема актуальна (версия {LATEST})")
+
+
+def main(argv: list[str] | None = None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "up"
+    if command not in ("up", "status"):
+        sys.exit("usage: python migrations.py [up|status]")
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    asyncio.run(_cli(command))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Бюджет промптов: подсчёт токенов и компактный «дайджест контекста» сессии.
+
+Дайджест строится один раз после интервью (sess.digest), дополняется при каждом
+новом продукте и переиспользуется в промптах JTBD, доп. сегментов и BIO. Сжатие
+(суммаризация моделью, затем обрезка) включается только при превышении бюджета.
+"""
+import logging
+import re
+
+import config
+import llm
+from session import Session
+
+log = logging.getLogger(__name__)
+
+try:  # точный подсчёт, если установлен tiktoken
+    import tiktoken
+except ImportError:  # pragma: no cover - необязательная зависимость
+    tiktoken = None
+
+_encoding = None
+
+DIGEST_VERSION = 1
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.encoding_for_model(config.LLM_MODEL)
+        return len(_encoding.encode(text))
+    # без tiktoken: ~3 символа на токен для русского текста (оценка сверху)
+    return len(text) // 3 + 1
+
+
+def _compact(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def build_interview_digest(sess: Session, labels: list[str]):
+    """Собрать дайджест интервью (вызывается один раз после finish_interview)."""
+    lines = [f"{label}: {_compact(answer)}" for label, answer in zip(labels, sess.answers) if answer.strip()]
+    sess.digest = {
+        "v": DIGEST_VERSION,
+        "interview": "\n".join(lines),
+        "interview_summary": None,
+        "products": [],
+    }
+
+
+def add_product_digest(sess: Session, answers: list[str], labels: list[str]):
+    """Дописать в дайджест один продукт (инкрементально, без пересборки)."""
+    digest = sess.digest
+    n = len(digest["products"]) + 1
+    body = "; ".join(f"{label}: {_compact(a)}" for label, a in zip(labels, answers) if a.strip())
+    digest["products"].append(f"Продукт {n} — {body}")
+
+
+def ensure_digest(sess: Session, interview_labels: list[str], product_labels: list[str]) -> dict:
+    """Для сессий, начатых до появления дайджеста, — собрать его из сырых ответов."""
+    digest = sess.digest
+    if digest is None or digest.get("v") != DIGEST_VERSION:
+        build_interview_digest(sess, interview_labels)
+        for answers in sess.products:
+            add_product_digest(sess, answers, product_labels)
+        digest = sess.digest
+    return digest
+
+
+def render(digest: dict, *, with_products: bool = True, summarized: bool = False) -> str:
+    interview = digest["interview_summary"] if summarized and digest.get("interview_summary") else digest["interview"]
+    parts = ["Интервью:\n" + interview]
+    if with_products and digest["products"]:
+        parts.append("Продукты:\n" + "\n".join(digest["products"]))
+    return "\n\n".join(parts)
+
+
+_SECTION_HEADERS = ("Интервью:", "Продукты:")
+
+
+def _trim(text: str, budget: int) -> str:
+    """Урезать самые длинные строки, пока текст не влезет в бюджет. Если короче строки уже
+    не сделать — выбрасывать их целиком с конца (последние продукты, затем поздние ответы
+    интервью); заголовки разделов — в последнюю очередь."""
+    lines = text.split("\n")
+
+    def fits() -> bool:
+        return count_tokens("\n".join(lines)) <= budget
+
+    while not fits():
+        longest = max(range(len(lines)), key=lambda i: len(lines[i]))
+        if len(lines[longest]) <= 80:
+            break
+        lines[longest] = lines[longest][: int(len(lines[longest]) * 0.75)].rstrip() + "…"
+    while not fits() and len(lines) > 1:
+        content = [i for i, line in enumerate(lines) if line.strip() and line not in _SECTION_HEADERS]
+        del lines[content[-1] if content else -1]
+    text = "\n".join(lines).rstrip()
+    while count_tokens(text) > budget and text:
+        text = text[: int(len(text) * 0.75)]
+    return text
+
+
+async def context_for_prompt(sess: Session, budget: int, *, with_products: bool = True) -> str:
+    """Текст «Исходной информации» в пределах budget токенов."""
+    digest = sess.digest
+    text = render(digest, with_products=with_products)
+    if count_tokens(text) <= budget:
+        return text
+    if config.CONTEXT_SUMMARIZE:
+        if not digest.get("interview_summary"):
+            try:
+                digest["interview_summary"] = await llm.chat(
+                    [
+                        {"role": "system", "content": (
+                            "Сожми ответы интервью в плотную выжимку на русском: факты, ценности, аудитория, "
+                            "отличия и характерные выражения пользователя (дословно, в кавычках). Без вступлений."
+                        )},
+                        {"role": "user", "content": digest["interview"]},
+                    ],
+                    purpose="digest",
+                    cache_version=DIGEST_VERSION,
+                )
+            except Exception as e:
+                log.warning("digest: не удалось сжать интервью, режем: %s", e)
+        text = render(digest, with_products=with_products, summarized=True)
+        if count_tokens(text) <= budget:
+            return text
+    return _trim(text, budget)
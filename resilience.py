@@ -0,0 +1,161 @@
+"""Устойчивость к сбоям зависимостей: circuit breaker, backoff с джиттером, бюджет повторов.
+
+Один breaker на зависимость (openai, postgres). После BREAKER_FAILURES сбоев подряд он
+открывается: вызовы сразу получают CircuitOpen, не дожидаясь таймаута, а вызывающий
+отвечает деградированно (доступ — из кэша, комментарий коуча — пропускаем). Через
+open_for breaker полуоткрыт и пропускает один пробный вызов: успех — закрыт, сбой — снова
+открыт на вдвое больший срок (до BREAKER_OPEN_MAX, с джиттером).
+Повторы ограничены бюджетом: не больше RETRY_BUDGET_RATIO от числа вызовов, чтобы при
+сбое повторы не умножали нагрузку на восстанавливающуюся зависимость.
+"""
+import logging
+import random
+import time
+
+import config
+import metrics
+
+log = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_breakers: dict[str, "CircuitBreaker"] = {}
+_budgets: dict[str, "RetryBudget"] = {}
+
+TRANSITIONS = metrics.Counter("circuit_breaker_transitions_total", "Смены состояния breaker", ("name", "state"))
+REJECTED = metrics.Counter("circuit_breaker_rejected_total", "Вызовы, отклонённые открытым breaker", ("name",))
+RETRY_DENIED = metrics.Counter("retry_budget_exhausted_total", "Повторы, не выполненные из-за исчерпанного бюджета",
+                               ("name",))
+metrics.Gauge("circuit_breaker_state", "Состояние breaker: 0 — закрыт, 1 — полуоткрыт, 2 — открыт", ("name",),
+              collect=lambda: {name: _STATE_VALUE[b.state] for name, b in _breakers.items()})
+
+# подписчики на смену состояния: fn(name, old, new)
+listeners: list = []
+
+
+class CircuitOpen(Exception):
+    """Зависимость недоступна (breaker открыт): вызов не выполнялся."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} временно недоступен, повтор через {retry_after:.0f} с")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def backoff(attempt: int, base: float | None = None, cap: float | None = None) -> float:
+    """Экспоненциальная задержка с полным джиттером: random(0, min(cap, base * 2**attempt))."""
+    base = config.RETRY_BACKOFF_BASE if base is None else base
+    cap = config.RETRY_BACKOFF_MAX if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, *, failures: int, open_for: float, open_max: float):
+        self.name = name
+        self.failures = failures
+        self.base_open_for = open_for
+        self.open_max = open_max
+        self.state = CLOSED
+        self._consecutive = 0
+        self._reopens = 0          # открытий подряд без успешной пробы — срок растёт
+        self._open_until = 0.0
+        self._probe = False        # в полуоткрытом состоянии идёт пробный вызов
+
+    def rejecting(self) -> bool:
+        """Открыт и срок не вышел — вызов сейчас точно будет отклонён."""
+        return self.state == OPEN and time.monotonic() < self._open_until
+
+    def check(self):
+        """CircuitOpen, если breaker открыт; пробный вызов не занимает (для быстрых отказов наверху)."""
+        if self.rejecting():
+            REJECTED.inc(name=self.name)
+            raise CircuitOpen(self.name, self._open_until - time.monotonic())
+
+    def before_call(self):
+        """Вызвать перед обращением к зависимости; CircuitOpen — обращаться нельзя."""
+        if self.state == CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == OPEN and now >= self._open_until:
+            self._set(HALF_OPEN)
+        if self.state == HALF_OPEN and not self._probe:
+            self._probe = True
+            return
+        REJECTED.inc(name=self.name)
+        raise CircuitOpen(self.name, max(self._open_until - now, 0))
+
+    def record_success(self):
+        self._probe = False
+        self._consecutive = 0
+        if self.state != CLOSED:
+            self._reopens = 0
+            self._set(CLOSED)
+
+    def record_failure(self):
+        self._probe = False
+        self._consecutive += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self._consecutive >= self.failures):
+            self._open()
+
+    def record_ignored(self):
+        """Вызов завершился ошибкой не зависимости (отмена, неверный запрос) — проба не считается."""
+        self._probe = False
+
+    def _open(self):
+        open_for = min(self.base_open_for * 2 ** self._reopens, self.open_max)
+        open_for *= random.uniform(0.8, 1.2)  # разные процессы не пробуют одновременно
+        self._reopens += 1
+        self._open_until = time.monotonic() + open_for
+        self._set(OPEN)
+
+    def _set(self, state: str):
+        old, self.state = self.state, state
+        TRANSITIONS.inc(name=self.name, state=state)
+        if state == OPEN:
+            log.error("circuit %s: %s -> open на %.0f с (сбоев подряд: %s)",
+                      self.name, old, self._open_until - time.monotonic(), self._consecutive)
+        else:
+            log.warning("circuit %s: %s -> %s", self.name, old, state)
+        for listener in listeners:
+            try:
+                listener(self.name, old, state)
+            except Exception:
+                log.exception("circuit %s: подписчик упал", self.name)
+
+
+class RetryBudget:
+    """Повторы — не больше ratio от числа вызовов (плюс небольшой запас min_tokens)."""
+
+    def __init__(self, name: str, *, ratio: float, min_tokens: float = 3.0, max_tokens: float = 20.0):
+        self.name = name
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = min_tokens
+
+    def record_call(self):
+        self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+    def try_retry(self) -> bool:
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        RETRY_DENIED.inc(name=self.name)
+        return False
+
+
+def breaker(name: str) -> CircuitBreaker:
+    b = _breakers.get(name)
+    if b is None:
+        b = _breakers[name] = CircuitBreaker(
+            name, failures=config.BREAKER_FAILURES,
+            open_for=config.BREAKER_OPEN_SECONDS, open_max=config.BREAKER_OPEN_MAX,
+        )
+    return b
+
+
+def retry_budget(name: str) -> RetryBudget:
+    b = _budgets.get(name)
+    if b is None:
+        b = _budgets[name] = RetryBudget(name, ratio=config.RETRY_BUDGET_RATIO)
+    return b
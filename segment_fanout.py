@@ -0,0 +1,113 @@
+"""Анализ ЦА по сегментам параллельно (JTBD_PARALLEL).
+
+Вместо одного длинного ответа сразу на все сегменты: короткий вызов даёт названия
+сегментов, затем каждый сегмент пишется отдельным запросом — одновременно не больше
+JTBD_CONCURRENCY на пользователя. Каждый блок сверяется с шаблоном (validate_segment),
+повторяются только упавшие или не прошедшие проверку сегменты. В чат блоки уходят
+строго по порядку номеров, как только готов очередной: ждать приходится самый длинный
+сегмент, а не сумму всех, и один испорченный блок не портит остальные.
+"""
+import asyncio
+import logging
+import re
+
+import metrics
+import resilience
+from resilience import CircuitOpen
+
+log = logging.getLogger(__name__)
+
+# критерии шаблона сегмента — в этом порядке, каждый ровно один раз
+CRITERIA = ("JTBD", "Потребности", "Боли", "Решения", "Темы для контента", "Психографика",
+            "Поведенческая сегментация", "Оффер")
+
+SEGMENT_RETRIES = metrics.Counter("jtbd_segment_retries_total", "Повторные генерации сегмента ЦА",
+                                  ("reason",))
+
+_FENCE_RE = re.compile(r"^\s*```(?:html)?\s*|\s*```\s*$")
+_LIST_MARK_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])?\s*(?:Сегмент\s*\d+\s*[:.—-]\s*)?", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^<>]+>")
+_SEGMENT_HEAD_RE = re.compile(r"<b>\s*Сегмент\s+(\d+)\s*:[^<]*</b>")
+
+
+class SegmentError(Exception):
+    """Ответ модели не соответствует шаблону сегмента (или списку названий)."""
+
+
+def parse_titles(text: str, count: int) -> list[str]:
+    """Названия сегментов из короткого ответа «по одному на строку»."""
+    titles = []
+    for line in _FENCE_RE.sub("", text).splitlines():
+        title = _TAG_RE.sub("", _LIST_MARK_RE.sub("", line, count=1)).strip(" «»\"*.")
+        if title:
+            titles.append(title)
+    if len(titles) < count:
+        raise SegmentError(f"ожидалось {count} названий сегментов, получено {len(titles)}")
+    return titles[:count]
+
+
+def validate_segment(text: str, number: int) -> str:
+    """Блок сегмента, очищенный от обёрток; SegmentError — не по шаблону."""
+    text = _FENCE_RE.sub("", text).strip()
+    head = _SEGMENT_HEAD_RE.match(text)
+    if head is None or int(head.group(1)) != number:
+        raise SegmentError(f"сегмент {number}: нет заголовка <b>Сегмент {number}: …</b>")
+    extra = len(_SEGMENT_HEAD_RE.findall(text)) - 1
+    if extra:
+        raise SegmentError(f"сегмент {number}: в ответе лишние сегменты ({extra})")
+    pos = 0
+    for label in CRITERIA:
+        found = text.find(f"<u>{label}:</u>", pos)
+        if found < 0:
+            raise SegmentError(f"сегмент {number}: нет критерия «{label}» (или нарушен порядок)")
+        pos = found
+    for tag in ("b", "u"):
+        if text.count(f"<{tag}>") != text.count(f"</{tag}>"):
+            raise SegmentError(f"сегмент {number}: не закрыт тег <{tag}>")
+    return text
+
+
+async def fan_out(count: int, write, emit, *, first: int, concurrency: int, attempts: int,
+                  ready: dict[int, str] | None = None) -> list[str]:
+    """Сгенерировать count сегментов параллельно и вывести их по порядку.
+
+    write(i, retry) -> текст i-го сегмента (номер first + i); retry=True — повтор, кэш не читать.
+    emit(i, text) — вывести очередной сегмент (вызывается строго по возрастанию i).
+    ready — уже выведенные сегменты {i: текст} (задача перезапущена после чекпоинта).
+    """
+    limit = asyncio.Semaphore(max(concurrency, 1))
+    attempts = max(attempts, 1)
+    budget = resilience.retry_budget("openai")
+    texts = dict(ready or {})
+
+    async def one(i: int) -> str:
+        async with limit:
+            for attempt in range(attempts):
+                last = attempt == attempts - 1
+                try:
+                    return validate_segment(await write(i, attempt > 0), first + i)
+                except SegmentError as e:
+                    if last:
+                        raise
+                    SEGMENT_RETRIES.inc(reason="invalid")
+                    log.info("%s — генерируем заново", e)
+                except CircuitOpen:
+                    raise
+                except Exception as e:
+                    if last or not budget.try_retry():
+                        raise
+                    SEGMENT_RETRIES.inc(reason="error")
+                    log.info("сегмент %s: %r — повтор", first + i, e)
+                    await asyncio.sleep(resilience.backoff(attempt))
+
+    tasks = {i: asyncio.ensure_future(one(i)) for i in range(count) if i not in texts}
+    try:
+        for i in range(count):
+            if i not in texts:
+                texts[i] = await tasks[i]
+                await emit(i, texts[i])
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+    return [texts[i] for i in range(count)]
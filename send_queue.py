@@ -0,0 +1,248 @@
+"""Планировщик исходящих запросов к Telegram (rate limiter для python-telegram-bot).
+
+Все запросы с chat_id проходят через очередь: token bucket на каждый чат и общий на бота,
+строгий порядок внутри чата (в полёте не больше одного запроса на чат), приоритет коротких
+интерактивных ответов (вопросы, меню) над длинными кусками текста и автоматический
+повтор после RetryAfter — с паузой только для чата, на который он пришёл.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import config
+
+log = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        self.refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class _Request:
+    callback: object
+    args: tuple
+    kwargs: dict
+    priority: Priority
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.monotonic)
+    retries: int = 0
+
+
+class _Chat:
+    __slots__ = ("queue", "bucket", "busy", "blocked_until")
+
+    def __init__(self, bucket: TokenBucket):
+        self.queue: deque[_Request] = deque()
+        self.bucket = bucket
+        self.busy = False
+        self.blocked_until = 0.0
+
+
+class SendScheduler(BaseRateLimiter[Priority]):
+    def __init__(self, *, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: int = 3,
+                 group_rate: float = 20 / 60, max_retries: int = 3, bulk_threshold: int = 1000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.bulk_threshold = bulk_threshold
+        self._chats: dict[int | str, _Chat] = {}
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closed = False
+        self._running: set[asyncio.Task] = set()
+        self._stats = {"dispatched": 0, "sent": 0, "retry_after": 0, "failed": 0, "delay_total_ms": 0.0, "delay_max_ms": 0.0}
+
+    async def initialize(self):
+        if self._task is None:
+            self._closed = False
+            self._task = asyncio.create_task(self._loop())
+
+    async def shutdown(self):
+        if self._task is not None:
+            # wait_for в Python 3.11 глотает отмену, если _wake уже взведён (запрос только что
+            # отработал), — цикл выходит по флагу, а не только по CancelledError
+            self._closed = True
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for chat in self._chats.values():
+            for req in chat.queue:
+                req.future.cancel()
+        self._chats.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery и т.п. — без очереди
+            return await callback(*args, **kwargs)
+        priority = rate_limit_args if isinstance(rate_limit_args, Priority) else self._classify(endpoint, data)
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(self._chat_bucket(chat_id))
+        req = _Request(callback, args, kwargs, priority, asyncio.get_running_loop().create_future())
+        chat.queue.append(req)
+        self._wake.set()
+        return await req.future
+
+    def _classify(self, endpoint: str, data: dict) -> Priority:
+        if endpoint == "sendMessage":
+            if data.get("reply_markup") is not None or len(data.get("text") or "") <= self.bulk_threshold:
+                return Priority.INTERACTIVE
+            return Priority.BULK
+        if endpoint in ("sendChatAction",):
+            return Priority.INTERACTIVE
+        # правки при стриминге, документы и прочее — фоновые
+        return Priority.BULK
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        is_group = isinstance(chat_id, int) and chat_id < 0 or isinstance(chat_id, str)
+        if is_group:
+            return TokenBucket(self.group_rate, 1)
+        return TokenBucket(self.chat_rate, self.chat_burst)
+
+    # ---------- диспетчер ----------
+    async def _loop(self):
+        while not self._closed:
+            timeout = self._dispatch_ready()
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch_ready(self) -> float | None:
+        """Отправить всё, что можно отправить сейчас; вернуть, через сколько проверить снова."""
+        now = time.monotonic()
+        wait = None
+        while True:
+            g_ready = self.global_bucket.ready_at(now)
+            if g_ready > now:
+                wait = _min(wait, g_ready - now)
+                break
+            best = best_key = None
+            for cid, chat in list(self._chats.items()):
+                if chat.busy:
+                    continue
+                while chat.queue and chat.queue[0].future.done():
+                    chat.queue.popleft()  # вызывающий уже отменил запрос
+                if not chat.queue:
+                    if chat.bucket.full(now):
+                        del self._chats[cid]
+                    continue
+                ready = max(chat.blocked_until, chat.bucket.ready_at(now))
+                if ready > now:
+                    wait = _min(wait, ready - now)
+                    continue
+                head = chat.queue[0]
+                key = (head.priority, head.enqueued)
+                if best_key is None or key < best_key:
+                    best, best_key = (cid, chat), key
+            if best is None:
+                break
+            self._start(*best, now)
+        # пустые чаты со временем освободят ведро — перепроверим позже
+        if wait is None and self._chats:
+            wait = 1.0
+        return wait
+
+    def _start(self, cid, chat: _Chat, now: float):
+        req = chat.queue.popleft()
+        chat.busy = True
+        chat.bucket.take()
+        self.global_bucket.take()
+        delay_ms = (now - req.enqueued) * 1000
+        self._stats["dispatched"] += 1
+        self._stats["delay_total_ms"] += delay_ms
+        self._stats["delay_max_ms"] = max(self._stats["delay_max_ms"], delay_ms)
+        task = asyncio.create_task(self._run(cid, chat, req))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, cid, chat: _Chat, req: _Request):
+        try:
+            result = await req.callback(*req.args, **req.kwargs)
+        except RetryAfter as e:
+            self._stats["retry_after"] += 1
+            req.retries += 1
+            if req.retries > self.max_retries:
+                self._stats["failed"] += 1
+                req.future.set_exception(e)
+            else:
+                log.warning("Telegram RetryAfter %ss (chat %s), повтор %s", e.retry_after, cid, req.retries)
+                # пауза только для этого чата: остальные чаты отправляются дальше
+                chat.blocked_until = time.monotonic() + e.retry_after
+                chat.queue.appendleft(req)  # порядок в чате сохраняется
+        except Exception as e:
+            if not req.future.done():
+                req.future.set_exception(e)
+        else:
+            self._stats["sent"] += 1
+            if not req.future.done():
+                req.future.set_result(result)
+        finally:
+            chat.busy = False
+            self._wake.set()
+
+    def stats(self) -> dict:
+        depth = {p.name.lower(): 0 for p in Priority}
+        for chat in self._chats.values():
+            for req in chat.queue:
+                depth[req.priority.name.lower()] += 1
+        s = dict(self._stats)
+        s["delay_avg_ms"] = s["delay_total_ms"] / s["dispatched"] if s["dispatched"] else 0.0
+        s["queue_depth"] = sum(depth.values())
+        s.update({f"queue_depth_{k}": v for k, v in depth.items()})
+        s["chats_pending"] = sum(1 for c in self._chats.values() if c.queue)
+        return s
+
+
+def _min(a: float | None, b: float) -> float:
+    return b if a is None else min(a, b)
+
+
+def make_scheduler() -> SendScheduler:
+    return SendScheduler(
+        global_rate=config.TG_GLOBAL_RATE,
+        chat_rate=config.TG_CHAT_RATE,
+        chat_burst=config.TG_CHAT_BURST,
+        group_rate=config.TG_GROUP_RATE,
+        max_retries=config.TG_MAX_RETRIES,
+        bulk_threshold=config.TG_BULK_THRESHOLD,
+    )
@@ -0,0 +1,122 @@
+"""Сессия пользователя: этап сценария (Stage) и собранные ответы.
+
+Session — класс со __slots__: без __dict__ на каждый экземпляр, набор полей фиксирован.
+Длинные сгенерированные тексты (распаковка, позиционирование) нужны редко (BIO), поэтому
+в памяти хранятся сжатыми zlib, если длиннее SESSION_COMPRESS_MIN символов.
+В БД сессия пишется тем же JSON, что и раньше (to_dict/from_dict), — старые записи читаются.
+"""
+import logging
+import sys
+import zlib
+from enum import Enum
+
+import config
+
+log = logging.getLogger(__name__)
+
+
+class Stage(Enum):
+    WELCOME = "welcome"
+    INTERVIEW = "interview"
+    UNPACKING = "unpacking"                      # генерация распаковки в очереди (jobs.py)
+    DONE_INTERVIEW = "done_interview"
+    BIO = "bio"
+    DONE_BIO = "done_bio"
+    PRODUCT_ASK = "product_ask"
+    DONE_PRODUCT = "done_product"
+    PRODUCT_FINISHED = "product_finished"
+    JTBD_GENERATING = "jtbd_generating"
+    JTBD_FIRST = "jtbd_first"
+    JTBD_MORE_GENERATING = "jtbd_more_generating"
+    JTBD_DONE = "jtbd_done"
+    DONE_JTBD = "done_jtbd"
+
+
+class _PackedText:
+    """Строковое поле, которое хранится сжатым, если длинное."""
+
+    def __set_name__(self, owner, name):
+        self.slot = "_" + name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot)
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode()
+        return value
+
+    def __set__(self, obj, value: str | None):
+        if value is not None and config.SESSION_COMPRESS_MIN and len(value) >= config.SESSION_COMPRESS_MIN:
+            value = zlib.compress(value.encode(), 6)
+        setattr(obj, self.slot, value)
+
+
+def _size(obj) -> int:
+    """Примерный объём в памяти: сам объект и вложенные строки/списки/словари."""
+    n = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        n += sum(_size(k) + _size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        n += sum(_size(v) for v in obj)
+    return n
+
+
+class Session:
+    __slots__ = ("stage", "answers", "product_answers", "products", "digest", "partials", "job",
+                 "_unpacking", "_positioning")
+
+    unpacking = _PackedText()
+    positioning = _PackedText()
+
+    def __init__(self, stage: Stage = Stage.WELCOME):
+        self.stage = stage
+        self.answers: list[str] = []
+        self.product_answers: list[str] = []
+        self.products: list[list[str]] = []   # ответы по каждому продукту (мультипродукт)
+        self.digest: dict | None = None       # prompt_budget.py
+        # распаковка по блокам интервью, готовая заранее: номер блока -> {"h": хэш ответов, "text": ...}
+        self.partials: dict[str, dict] = {}
+        # идущая генерация (этапы *_GENERATING): {"id": id задачи или None, "prev": прошлый этап, "at": time.time()}
+        self.job: dict | None = None
+        self.unpacking = None
+        self.positioning = None
+
+    def to_dict(self) -> dict:
+        data = {
+            "stage": self.stage.value,
+            "answers": self.answers,
+            "product_answers": self.product_answers,
+            "products": self.products,
+        }
+        if self.partials:
+            data["partials"] = self.partials
+        for key in ("digest", "job", "unpacking", "positioning"):
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = value
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Session":
+        try:
+            stage = Stage(data.get("stage", Stage.WELCOME.value))
+        except ValueError:
+            log.warning("session: неизвестный этап %r, начинаем с приветствия", data.get("stage"))
+            stage = Stage.WELCOME
+        sess = cls(stage)
+        sess.answers = data.get("answers", [])
+        sess.product_answers = data.get("product_answers", [])
+        sess.products = data.get("products", [])
+        sess.digest = data.get("digest")
+        sess.partials = data.get("partials", {})
+        sess.job = data.get("job")
+        sess.unpacking = data.get("unpacking")
+        sess.positioning = data.get("positioning")
+        return sess
+
+    def nbytes(self) -> int:
+        """Примерный объём сессии в памяти (для бюджета SESSION_MAX_BYTES)."""
+        return sys.getsizeof(self) + sum(
+            _size(getattr(self, slot)) for slot in self.__slots__ if slot != "stage"
+        )
@@ -0,0 +1,332 @@
+"""Хранилище сессий: LRU в памяти + отложенная пакетная запись в Postgres (или SQLite локально).
+
+Хендлеры работают с объектами Session (session.py) и меняют их на месте. Каждая выданная
+через get()/set() сессия считается «возможно изменённой»; фоновый flush раз в
+SESSION_FLUSH_INTERVAL сериализует такие сессии и пишет одним пакетом только те, что реально
+изменились. Из памяти выгружаются (только уже записанные) сессии сверх SESSION_MAX_RESIDENT
+или SESSION_MAX_BYTES и простаивающие дольше SESSION_IDLE_TTL — при следующем обращении
+сессия поднимется из БД.
+
+Хендлер меняет сессию и после await, когда flush уже мог её записать. Поэтому на время
+обработки апдейтов чата сессия закреплена (pin/unpin от диспетчера чатов): закреплённую
+не выгружаем, а при откреплении она снова помечается изменённой — flush запишет итог.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from db import db_run, db_run_many
+from session import Session
+
+log = logging.getLogger(__name__)
+
+
+class SessionBackend:
+    """Постоянное хранилище сессий."""
+
+    async def load(self, chat_id: int) -> dict | None:
+        raise NotImplementedError
+
+    async def save_many(self, items: dict[int, str | None]):
+        """items: chat_id -> JSON сессии или None (удалить)."""
+        raise NotImplementedError
+
+
+class PostgresSessionBackend(SessionBackend):
+    def __init__(self, bot_name: str):
+        self.bot_name = bot_name
+
+    async def load(self, chat_id: int) -> dict | None:
+        row = await db_run(
+            "SELECT data FROM bot_sessions WHERE chat_id=%s AND bot_name=%s",
+            (chat_id, self.bot_name), fetch="one",
+        )
+        return row["data"] if row else None
+
+    async def save_many(self, items: dict[int, str | None]):
+        upserts = [(cid, self.bot_name, data) for cid, data in items.items() if data is not None]
+        deletes = [cid for cid, data in items.items() if data is None]
+        await db_run_many(
+            "INSERT INTO bot_sessions(chat_id, bot_name, data, updated_at) VALUES(%s,%s,%s::jsonb,now()) "
+            "ON CONFLICT (chat_id, bot_name) DO UPDATE SET data=EXCLUDED.data, updated_at=now()",
+            upserts,
+        )
+        if deletes:
+            await db_run(
+                "DELETE FROM bot_sessions WHERE bot_name=%s AND chat_id = ANY(%s)",
+                (self.bot_name, deletes),
+            )
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Локальная замена Postgres (разработка, тесты). Запросы выполняются в отдельном потоке."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        # файл создаётся при первом обращении, а не при импорте
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+                )
+        return self._conn
+
+    def _load(self, chat_id: int):
+        with self._lock:
+            row = self._db().execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save_many(self, items: dict[int, str | None]):
+        with self._lock, self._db() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (chat_id, data) VALUES (?, ?)",
+                [(cid, data) for cid, data in items.items() if data is not None],
+            )
+            conn.executemany(
+                "DELETE FROM sessions WHERE chat_id = ?",
+                [(cid,) for cid, data in items.items() if data is None],
+            )
+
+    async def load(self, chat_id: int) -> dict | None:
+        return await asyncio.to_thread(self._load, chat_id)
+
+    async def save_many(self, items: dict[int, str | None]):
+        await asyncio.to_thread(self._save_many, items)
+
+
+_MISSING = object()
+
+
+class SessionStore:
+    def __init__(self, backend: SessionBackend, *, max_resident: int = 5000, max_bytes: int = 0,
+                 idle_ttl: float = 0, flush_interval: float = 2.0, flush_batch: int = 200):
+        self.backend = backend
+        self.max_resident = max_resident
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        # chat_id -> сессия или None («в БД сессии нет», чтобы не спрашивать повторно);
+        # порядок — от давно не использованных к недавним
+        self._resident: OrderedDict[int, Session | None] = OrderedDict()
+        self._used: dict[int, float] = {}          # chat_id -> monotonic последнего обращения
+        self._sizes: dict[int, int] = {}           # chat_id -> Session.nbytes() на момент записи/загрузки
+        self._bytes = 0
+        self._dirty: set[int] = set()
+        self._pins: dict[int, int] = {}            # chat_id -> сколько обработчиков держат сессию
+        self._hashes: dict[int, bytes] = {}        # хэш последней записанной версии
+        self._loading: dict[int, asyncio.Future] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closed = False
+        self.stats = {"loads": 0, "flushes": 0, "rows_written": 0, "skipped_unchanged": 0,
+                      "evicted_idle": 0, "evicted_full": 0}
+
+    # ---------- доступ ----------
+    async def get(self, chat_id: int) -> Session | None:
+        """Сессия чата; холодная сессия поднимается из БД одним запросом."""
+        sess = self._resident.get(chat_id, _MISSING)
+        if sess is _MISSING:
+            fut = self._loading.get(chat_id)
+            if fut is None:
+                fut = asyncio.get_running_loop().create_future()
+                self._loading[chat_id] = fut
+                try:
+                    self.stats["loads"] += 1
+                    data = await self.backend.load(chat_id)
+                    fut.set_result(data)
+                except Exception as e:
+                    fut.set_exception(e)
+                    raise
+                finally:
+                    del self._loading[chat_id]
+                if chat_id not in self._resident:
+                    sess = Session.from_dict(data) if data is not None else None
+                    self._resident[chat_id] = sess
+                    self._hashes[chat_id] = _digest(_dump(sess)) if sess is not None else b""
+                    self._set_size(chat_id, sess)
+                    self._used[chat_id] = time.monotonic()
+                    self._evict(keep=chat_id)
+            else:
+                await fut
+            sess = self._resident.get(chat_id)
+        else:
+            self._resident.move_to_end(chat_id)
+        self._used[chat_id] = time.monotonic()
+        if sess is not None:
+            self._mark(chat_id)
+        return sess
+
+    def peek(self, chat_id: int) -> Session | None:
+        """Сессия, если она уже в памяти: без загрузки из БД и без пометки «изменена»."""
+        return self._resident.get(chat_id)
+
+    def set(self, chat_id: int, sess: Session):
+        self._resident[chat_id] = sess
+        self._resident.move_to_end(chat_id)
+        self._used[chat_id] = time.monotonic()
+        self._mark(chat_id)
+        self._evict(keep=chat_id)
+
+    def pin(self, chat_id: int):
+        """Сессия используется (идёт обработка апдейтов чата) — не выгружать."""
+        self._pins[chat_id] = self._pins.get(chat_id, 0) + 1
+
+    def unpin(self, chat_id: int):
+        n = self._pins.get(chat_id, 0) - 1
+        if n > 0:
+            self._pins[chat_id] = n
+            return
+        self._pins.pop(chat_id, None)
+        if self._resident.get(chat_id) is not None:
+            # изменения после последнего get() (после await) — тоже в следующий flush
+            self._used[chat_id] = time.monotonic()
+            self._mark(chat_id)
+
+    def delete(self, chat_id: int):
+        self._resident[chat_id] = None
+        self._used[chat_id] = time.monotonic()
+        self._mark(chat_id)
+
+    def _mark(self, chat_id: int):
+        self._dirty.add(chat_id)
+        if len(self._dirty) >= self.flush_batch:
+            self._wakeup.set()
+
+    def _set_size(self, chat_id: int, sess: Session | None):
+        size = sess.nbytes() if sess is not None else 0
+        self._bytes += size - self._sizes.get(chat_id, 0)
+        self._sizes[chat_id] = size
+
+    def _over_limit(self) -> bool:
+        return len(self._resident) > self.max_resident or bool(self.max_bytes and self._bytes > self.max_bytes)
+
+    def _evict(self, keep: int | None = None):
+        # выгружаем только чистые и не закреплённые сессии; грязные дождутся flush.
+        # keep — сессия, которую только что выдали вызывающему.
+        # Идём от давно не использованных: первая свежая сессия при соблюдённых лимитах — стоп
+        if not self._over_limit() and not self.idle_ttl:
+            return
+        idle_before = time.monotonic() - self.idle_ttl if self.idle_ttl else None
+        for cid in list(self._resident):
+            full = self._over_limit()
+            idle = idle_before is not None and self._used.get(cid, 0) < idle_before
+            if not full and not idle:
+                break
+            if cid in self._dirty or cid in self._loading or cid in self._pins or cid == keep:
+                continue
+            del self._resident[cid]
+            self._hashes.pop(cid, None)
+            self._used.pop(cid, None)
+            self._bytes -= self._sizes.pop(cid, 0)
+            self.stats["evicted_full" if full else "evicted_idle"] += 1
+
+    # ---------- запись ----------
+    async def flush(self):
+        """Записать изменившиеся сессии одним пакетом."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            batch, hashes = {}, {}
+            for cid in dirty:
+                sess = self._resident.get(cid)
+                self._set_size(cid, sess)
+                data = _dump(sess) if sess is not None else None
+                h = _digest(data) if data is not None else b""
+                if self._hashes.get(cid) == h:
+                    self.stats["skipped_unchanged"] += 1
+                    continue
+                batch[cid], hashes[cid] = data, h
+            if not batch:
+                return
+            try:
+                await self.backend.save_many(batch)
+            except Exception:
+                # вернём в очередь — попробуем в следующий раз
+                self._dirty |= set(batch)
+                raise
+            self._hashes.update(hashes)
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(batch)
+            self._evict()
+
+    async def _flush_loop(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.warning("sessions: не удалось записать пакет: %s", e)
+            self._evict()  # простаивающие выгружаем, даже если писать было нечего
+
+    def start(self):
+        if self._task is None:
+            self._closed = False
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            # отмена теряется, если _wakeup уже взведён (wait_for в Python 3.11), — выходим по флагу
+            self._closed = True
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def resident_count(self) -> int:
+        return sum(1 for s in self._resident.values() if s is not None)
+
+    def resident_bytes(self) -> int:
+        """Примерный объём сессий в памяти (по последнему замеру при загрузке/flush)."""
+        return self._bytes
+
+    def stage_counts(self) -> dict[str, int]:
+        """Сколько сессий в памяти на каждом этапе сценария."""
+        counts: dict[str, int] = {}
+        for sess in self._resident.values():
+            if sess is not None:
+                stage = sess.stage.value
+                counts[stage] = counts.get(stage, 0) + 1
+        return counts
+
+
+def _dump(sess: Session) -> str:
+    return json.dumps(sess.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+
+def _digest(data: str) -> bytes:
+    return hashlib.blake2b(data.encode(), digest_size=16).digest()
+
+
+def make_store() -> SessionStore:
+    if config.SESSION_BACKEND == "postgres":
+        backend = PostgresSessionBackend(config.BOT_NAME)
+    elif config.SESSION_BACKEND == "sqlite":
+        backend = SQLiteSessionBackend(config.SESSION_SQLITE_PATH)
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND: {config.SESSION_BACKEND!r}")
+    return SessionStore(
+        backend,
+        max_resident=config.SESSION_MAX_RESIDENT,
+        max_bytes=config.SESSION_MAX_BYTES,
+        idle_ttl=config.SESSION_IDLE_TTL,
+        flush_interval=config.SESSION_FLUSH_INTERVAL,
+        flush_batch=config.SESSION_FLUSH_BATCH,
+    )
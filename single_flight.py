@@ -0,0 +1,62 @@
+"""Single-flight для дорогих кнопок: повторный тап не запускает генерацию второй раз.
+
+Ключ — (чат, действие, хэш входных данных). Пока генерация по ключу идёт, такой же тап
+не попадает в очередь чата: пользователь сразу получает «уже готовлю» через query.answer,
+а результат придёт в чат один раз — из уже идущей генерации. Полёт начинается до очереди
+чата (иначе дубль ждал бы, пока первый отработает) и заканчивается, когда отработал хендлер,
+а если генерация ушла в очередь задач (jobs.py) — когда её результат применён.
+Тап, отброшенный переполненной очередью чата, полёт сразу освобождает (on_drop диспетчера).
+TTL страхует от задачи, результат которой так и не пришёл.
+"""
+import hashlib
+import json
+import time
+
+import metrics
+
+DEDUPED = metrics.Counter("bot_single_flight_deduped_total", "Повторные тапы, присоединённые к идущей генерации",
+                          ("action",))
+
+
+def inputs_hash(*parts) -> str:
+    payload = json.dumps(parts, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=12).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, ttl: float = 900.0):
+        self.ttl = ttl
+        # (chat_id, action) -> [хэш входа, monotonic-дедлайн, передан ли в очередь задач]
+        self._flights: dict[tuple[int, str], list] = {}
+
+    def join(self, chat_id: int, action: str, digest: str | None) -> bool:
+        """True — такая же генерация уже идёт (тап — дубль); False — начат новый полёт.
+
+        digest=None — входные данные неизвестны (сессия ещё не в памяти): такой полёт
+        совпадает с любым полётом того же действия, и наоборот.
+        """
+        now = time.monotonic()
+        flight = self._flights.get((chat_id, action))
+        if flight is not None and flight[1] > now and (flight[0] == digest or None in (flight[0], digest)):
+            DEDUPED.inc(action=action)
+            return True
+        self._flights[(chat_id, action)] = [digest, now + self.ttl, False]
+        return False
+
+    def detach(self, chat_id: int, action: str, digest: str | None):
+        """Генерация ушла в очередь задач: полёт закончит on_done, а не хендлер."""
+        flight = self._flights.get((chat_id, action))
+        if flight is not None and flight[0] == digest:
+            flight[2] = True
+
+    def done(self, chat_id: int, action: str, digest: str | None, *, handler: bool = False):
+        """Полёт с этим хэшем входов закончен. Если его уже сменил полёт с другими входами
+        (тап после изменения данных), тот не трогаем — он ещё идёт."""
+        flight = self._flights.get((chat_id, action))
+        if flight is None or flight[0] != digest or (handler and flight[2]):
+            return
+        del self._flights[(chat_id, action)]
+
+    def active(self) -> int:
+        now = time.monotonic()
+        return sum(1 for f in self._flights.values() if f[1] > now)
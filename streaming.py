@@ -0,0 +1,100 @@
+"""Стриминг генерации в Telegram: заглушка + периодический edit_message_text с переносом в новое сообщение."""
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+import config
+from html_chunker import LIMIT, HtmlChunker, to_plain
+
+log = logging.getLogger(__name__)
+
+PLACEHOLDER = "⏳"
+
+
+class StreamingReply:
+    """Постепенно выводит HTML-текст в чат по мере поступления дельт от модели.
+
+    Текст режет HtmlChunker: как только кусок закрыт, текущее сообщение получает его
+    финальную HTML-версию, а стрим продолжается в новом сообщении. Промежуточные правки
+    идут простым текстом (недописанный HTML Telegram не примет).
+    """
+
+    def __init__(self, bot, chat_id: int, header: str = "", *,
+                 min_interval: float | None = None, max_len: int = LIMIT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.min_interval = config.STREAM_EDIT_INTERVAL if min_interval is None else min_interval
+        self.text = header            # весь накопленный текст
+        self._chunker = HtmlChunker(max_len - len(PLACEHOLDER) - 1)
+        self._chunker.feed(header)
+        self._msg = None              # текущее сообщение, которое правим
+        self._shown = ""              # что сейчас видно в текущем сообщении
+        self._next_edit = 0.0
+
+    async def start(self):
+        await self._new_message()
+
+    async def feed(self, delta: str):
+        if self._msg is None:
+            await self.start()
+        self.text += delta
+        for chunk in self._chunker.feed(delta):
+            await self._finalize(chunk)
+            await self._new_message()
+        if time.monotonic() >= self._next_edit:
+            await self._edit(self._pending(), parse_mode=None)
+
+    async def finish(self) -> str:
+        """Финальная правка с разметкой; возвращает весь накопленный текст вместе с заголовком."""
+        if self._msg is None:
+            await self.start()
+        chunks = self._chunker.close() or [PLACEHOLDER]
+        await self._finalize(chunks[0])
+        for chunk in chunks[1:]:
+            await self._new_message()
+            await self._finalize(chunk)
+        return self.text
+
+    def _pending(self) -> str:
+        return (self._chunker.pending_plain() + PLACEHOLDER).lstrip() or PLACEHOLDER
+
+    async def _new_message(self):
+        text = self._pending()
+        self._msg = await self.bot.send_message(chat_id=self.chat_id, text=text)
+        self._shown = text
+        self._next_edit = time.monotonic() + self.min_interval
+
+    async def _finalize(self, chunk: str):
+        try:
+            await self._edit(chunk, parse_mode="HTML", force=True)
+        except BadRequest as e:
+            log.info("stream: разметка не принята (%s), оставляем простой текст", e)
+            await self._edit(to_plain(chunk), parse_mode=None, force=True)
+
+    async def _edit(self, text: str, parse_mode: str | None, force: bool = False):
+        """Правка текущего сообщения. Промежуточные правки при ошибках пропускаются,
+        финальные (force) ждут RetryAfter, а BadRequest пробрасывают в _finalize."""
+        if text == self._shown and not force:
+            return
+        while True:
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id, message_id=self._msg.message_id, text=text, parse_mode=parse_mode,
+                )
+                break
+            except RetryAfter as e:
+                if not force:
+                    self._next_edit = time.monotonic() + e.retry_after
+                    return
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    break
+                if force:
+                    raise
+                log.info("stream: правка не удалась: %s", e)
+                return
+        self._shown = text
+        self._next_edit = time.monotonic() + self.min_interval
@@ -0,0 +1,37 @@
+"""Окружение тестов: без Postgres и без .env разработчика, всё локальное — в памяти."""
+import os
+import sys
+import time
+
+import pytest
+
+os.environ.update({
+    "DATABASE_URL": "",
+    "BOT_TOKEN": "test:token",
+    "JOBS_MODE": "inline",
+    "SESSION_BACKEND": "sqlite",
+    "SESSION_SQLITE_PATH": ":memory:",
+    "ARTIFACT_BACKEND": "sqlite",
+    "ARTIFACT_SQLITE_PATH": ":memory:",
+    "GEN_CACHE_PERSIST": "none",
+    "METRICS_PORT": "0",
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Clock:
+    """Ручные часы вместо time.monotonic: время идёт, только когда тест сдвигает now."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(time, "monotonic", c)
+    return c
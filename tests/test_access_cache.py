@@ -0,0 +1,86 @@
+import asyncio
+
+import psycopg
+import pytest
+
+import bot
+from access_cache import AccessCache
+
+
+def test_positive_and_negative_verdicts_expire_separately(clock):
+    cache = AccessCache(ttl=10, negative_ttl=1, max_size=10)
+    cache.put(1, "bot", True)
+    cache.put(2, "bot", False)
+    assert cache.get(1, "bot") is True and cache.get(2, "bot") is False
+    clock.now += 2
+    assert cache.get(1, "bot") is True
+    assert cache.get(2, "bot") is None     # отказ помним недолго — оплативший получит доступ сразу
+    clock.now += 9
+    assert cache.get(1, "bot") is None
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 2
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = AccessCache(ttl=10, negative_ttl=1, max_size=2)
+    cache.put(1, "bot", True)
+    cache.put(2, "bot", True)
+    cache.get(1, "bot")
+    cache.put(3, "bot", True)
+    assert cache.get(2, "bot") is None
+    assert cache.get(1, "bot") is True and cache.get(3, "bot") is True
+    assert cache.stats()["evictions"] == 1
+
+
+def test_is_allowed_asks_the_db_once(clock, monkeypatch):
+    queries = []
+
+    async def db_run(sql, args=(), fetch=None):
+        queries.append(args)
+        return {"?column?": 1}
+
+    monkeypatch.setattr(bot, "access_cache", AccessCache(ttl=10, negative_ttl=1, max_size=10))
+    monkeypatch.setattr(bot, "db_run", db_run)
+    assert asyncio.run(bot.is_allowed(42)) is True
+    assert asyncio.run(bot.is_allowed(42)) is True
+    assert queries == [(42, bot.BOT_NAME)]
+
+
+def test_expired_entry_is_a_miss_but_stays_for_peek(clock):
+    cache = AccessCache(ttl=10, negative_ttl=1, max_size=10)
+    cache.put(1, "bot", True)
+    assert cache.get(1, "bot") is True
+    clock.now += 11
+    assert cache.get(1, "bot") is None
+    assert cache.get(1, "bot") is None      # повторный get не стирает запись
+    assert cache.peek(1, "bot") is True
+    assert cache.stats()["misses"] == 2
+
+
+def test_stale_entry_leaves_with_lru_or_invalidate(clock):
+    cache = AccessCache(ttl=10, negative_ttl=1, max_size=2)
+    cache.put(1, "bot", True)
+    clock.now += 11
+    cache.put(2, "bot", True)
+    cache.put(3, "bot", True)
+    assert cache.peek(1, "bot") is None
+    cache.invalidate(2, "bot")
+    assert cache.peek(2, "bot") is None
+
+
+def _db_down(*args, **kwargs):
+    raise psycopg.OperationalError("connection refused")
+
+
+def test_is_allowed_serves_stale_verdict_when_db_is_down(clock, monkeypatch):
+    monkeypatch.setattr(bot, "access_cache", AccessCache(ttl=10, negative_ttl=1, max_size=10))
+    monkeypatch.setattr(bot, "db_run", _db_down)
+    bot.access_cache.put(42, bot.BOT_NAME, True)
+    clock.now += 60
+    assert asyncio.run(bot.is_allowed(42)) is True
+
+
+def test_is_allowed_without_any_verdict_raises_when_db_is_down(monkeypatch):
+    monkeypatch.setattr(bot, "access_cache", AccessCache(ttl=10, negative_ttl=1, max_size=10))
+    monkeypatch.setattr(bot, "db_run", _db_down)
+    with pytest.raises(psycopg.OperationalError):
+        asyncio.run(bot.is_allowed(43))
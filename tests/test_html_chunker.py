@@ -0,0 +1,72 @@
+import math
+import re
+
+from html_chunker import LIMIT, HtmlChunker, split_html, to_plain, utf16_len
+
+TAG_RE = re.compile(r"<(/?)([a-z-]+)[^>]*>")
+
+
+def balanced(chunk: str) -> bool:
+    stack = []
+    for m in TAG_RE.finditer(chunk):
+        if m.group(1):
+            if not stack or stack.pop() != m.group(2):
+                return False
+        else:
+            stack.append(m.group(2))
+    return not stack
+
+
+def segments(count: int, paragraphs: int, words: int) -> str:
+    out = []
+    for n in range(1, count + 1):
+        body = "\n\n".join(
+            f"<u>Пункт {p}:</u> " + " ".join(["слово"] * words) + "." for p in range(paragraphs)
+        )
+        out.append(f"<b>Сегмент {n}: название</b>\n{body}")
+    return "\n\n".join(out)
+
+
+def test_chunks_fit_the_limit_and_keep_tags_balanced():
+    text = "<b>жирный " + "и <i>курсив " * 800 + "</i></b> хвост " + "текст. " * 600
+    chunks = split_html(text)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert balanced(chunk), chunk[-80:]
+        assert utf16_len(to_plain(chunk)) <= LIMIT
+    assert "".join(to_plain(c) for c in chunks).split() == to_plain(text).split()
+
+
+def test_no_extra_messages_for_segment_boundaries():
+    # 5 сегментов по ~3 тыс. символов: поместится в 4 сообщения, а не по одному на сегмент
+    text = segments(5, paragraphs=10, words=50)
+    total = utf16_len(to_plain(text))
+    assert 4 * LIMIT > total > 3 * LIMIT
+    chunks = split_html(text)
+    assert len(chunks) == math.ceil(total / LIMIT)
+    assert all(balanced(c) for c in chunks)
+
+
+def test_segment_boundary_wins_when_the_chunk_is_nearly_full():
+    # первый сегмент заполняет сообщение на ~92% — режем ровно по нему, а не по абзацу второго
+    text = segments(2, paragraphs=11, words=55)
+    first, second = split_html(text)
+    assert utf16_len(to_plain(first)) >= 0.9 * LIMIT
+    assert "Сегмент 2" not in first
+    assert second.lstrip().startswith("<b>Сегмент 2:")
+
+
+def test_short_text_is_one_message_and_is_escaped():
+    assert split_html("a < b & <b>c</b> <script>x</script>") == [
+        "a &lt; b &amp; <b>c</b> &lt;script&gt;x&lt;/script&gt;"
+    ]
+
+
+def test_streaming_feed_matches_split():
+    text = segments(3, paragraphs=8, words=60)
+    chunker = HtmlChunker()
+    streamed = []
+    for i in range(0, len(text), 37):
+        streamed.extend(chunker.feed(text[i:i + 37]))
+    streamed.extend(chunker.close())
+    assert streamed == split_html(text)
@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+import config
+from session import Session, Stage
+
+
+def interview_update(cid: int, text: str, message_id: int = 1):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=cid),
+                           message=SimpleNamespace(text=text, message_id=message_id))
+
+
+def test_slow_comment_follows_the_next_question(monkeypatch):
+    monkeypatch.setattr(config, "COMMENT_GRACE", 0.01)
+    monkeypatch.setattr(config, "INTERVIEW_COMMENT_MODE", "eager")
+    sent, pending = [], []
+
+    async def slow_comment(text):
+        await asyncio.sleep(0.05)
+        return f"комментарий: {text}"
+
+    async def send_message(chat_id, text, reply_to_message_id=None, **kw):
+        sent.append((text, reply_to_message_id))
+
+    def create_task(coro, update=None):
+        task = asyncio.ensure_future(coro)
+        pending.append(task)
+        return task
+
+    monkeypatch.setattr(bot, "coach_comment", slow_comment)
+    ctx = SimpleNamespace(bot=SimpleNamespace(send_message=send_message),
+                          application=SimpleNamespace(create_task=create_task))
+
+    async def run():
+        bot.sessions.set(12, Session(Stage.INTERVIEW))
+        try:
+            await bot.message_handler(interview_update(12, "мой ответ", message_id=5), ctx)
+            assert sent == [(bot.INTERVIEW_Q[1], None)]      # вопрос не ждёт комментария
+            await asyncio.gather(*pending)
+            assert sent[1] == ("комментарий: мой ответ", 5)  # комментарий — ответом на реплику
+            assert 12 not in bot._pending_comments
+        finally:
+            bot.sessions.delete(12)
+
+    asyncio.run(run())
+
+
+def test_comment_is_dropped_when_the_next_question_is_not_delivered(monkeypatch):
+    monkeypatch.setattr(config, "COMMENT_GRACE", 0.01)
+    monkeypatch.setattr(config, "INTERVIEW_COMMENT_MODE", "eager")
+    monkeypatch.setattr(config, "INTERVIEW_INCREMENTAL", False)
+    cancelled = []
+
+    async def slow_comment(text):
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(text)
+            raise
+
+    async def send_message(**kw):
+        raise ConnectionError("telegram down")
+
+    monkeypatch.setattr(bot, "coach_comment", slow_comment)
+    ctx = SimpleNamespace(bot=SimpleNamespace(send_message=send_message), application=None)
+
+    async def run():
+        bot.sessions.set(11, Session(Stage.INTERVIEW))
+        try:
+            with pytest.raises(ConnectionError):
+                await bot.message_handler(interview_update(11, "мой ответ"), ctx)
+            await asyncio.sleep(0)
+            # проверяем до конца asyncio.run: при закрытии цикла он сам отменил бы всё оставшееся
+            assert cancelled == ["мой ответ"]
+            assert 11 not in bot._pending_comments
+        finally:
+            bot.sessions.delete(11)
+
+    asyncio.run(run())
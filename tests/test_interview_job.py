@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+import bot
+from jobs import Job
+
+
+@pytest.fixture
+def chat_log(monkeypatch):
+    log = []
+
+    async def chat(messages, *, purpose, **kw):
+        log.append(("start", purpose))
+        await asyncio.sleep(0.05)
+        log.append(("end", purpose))
+        return purpose
+
+    async def generate_to_chat(bot_, cid, messages, *, purpose, header="", **kw):
+        text = await chat(messages, purpose=purpose)
+        log.append(("sent", purpose))
+        return text
+
+    async def send_long_message(bot_, cid, text):
+        log.append(("sent", text.splitlines()[0]))
+
+    monkeypatch.setattr(bot.llm, "chat", chat)
+    monkeypatch.setattr(bot, "generate_to_chat", generate_to_chat)
+    monkeypatch.setattr(bot, "send_long_message", send_long_message)
+    return log
+
+
+async def checkpoint(result):
+    pass
+
+
+def test_positioning_runs_alongside_the_final_block(chat_log):
+    parts = {str(b): f"часть {b}" for b in range(len(bot.interview_blocks()) - 1)}
+    job = Job(1, 5, "interview", {"answers": ["ответ"] * len(bot.INTERVIEW_Q), "parts": parts})
+    result = asyncio.run(bot.run_interview_job(None, job, checkpoint))
+    assert result["positioning"] == "positioning"
+    # позиционирование стартовало до конца последнего блока, а в чат ушло после распаковки
+    assert chat_log.index(("start", "positioning")) < chat_log.index(("end", "unpack"))
+    assert chat_log.index(("sent", "unpack")) < chat_log.index(("sent", bot.POSITIONING_HEADER.strip()))
+
+
+def test_only_missing_parts_are_generated_before_the_last_block(chat_log):
+    job = Job(1, 5, "interview", {"answers": ["ответ"] * len(bot.INTERVIEW_Q), "parts": {"0": "часть 0"}})
+    result = asyncio.run(bot.run_interview_job(None, job, checkpoint))
+    missing = ["unpack_part"] * (len(bot.interview_blocks()) - 2)
+    assert [purpose for event, purpose in chat_log if event == "start"] == missing + ["unpack", "positioning"]
+    assert result["unpacking"].startswith("часть 0\n\nunpack_part")
+    assert result["unpacking"].endswith("unpack")
+
+
+def test_without_parts_positioning_follows_the_unpacking(chat_log):
+    job = Job(1, 5, "interview", {"answers": ["ответ"] * len(bot.INTERVIEW_Q)})
+    asyncio.run(bot.run_interview_job(None, job, checkpoint))
+    assert chat_log.index(("end", "unpack")) < chat_log.index(("start", "positioning"))
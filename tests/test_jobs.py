@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+import config
+import jobs
+from jobs import Job, JobWorker
+
+
+class FakeDB:
+    """db_run: запоминает запросы, отвечает заданными строками (по умолчанию — «строка обновлена»);
+    raises — столько первых вызовов падают."""
+
+    def __init__(self, rows=None, raises=0, default=None):
+        self.calls = []
+        self.rows = list(rows or [])
+        self.raises = raises
+        self.default = {"id": 7} if default is None else default
+
+    async def __call__(self, sql, args=(), fetch=None):
+        self.calls.append((" ".join(sql.split()), args))
+        if self.raises:
+            self.raises -= 1
+            raise OSError("db down")
+        if self.rows:
+            return self.rows.pop(0)
+        return self.default if fetch else None
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDB()
+    monkeypatch.setattr(jobs, "db_run", fake)
+    return fake
+
+
+def job(attempts=1, max_attempts=3):
+    return Job(7, 100, "test", {}, status="running", attempts=attempts, max_attempts=max_attempts)
+
+
+def test_failed_attempt_is_requeued_with_backoff(db):
+    outcome = asyncio.run(JobWorker(None, concurrency=1)._fail(job(attempts=1), RuntimeError("boom")))
+    assert outcome == "retry"
+    sql, args = db.calls[0]
+    assert "status = 'queued'" in sql
+    assert args[1] == config.JOBS_RETRY_BASE
+
+
+def test_last_attempt_fails_and_notifies(db):
+    outcome = asyncio.run(JobWorker(None, concurrency=1)._fail(job(attempts=3), RuntimeError("boom")))
+    assert outcome == "failed"
+    sql, args = db.calls[0]
+    assert "status = 'failed'" in sql and "pg_notify" in sql
+    assert args[-1] == jobs.DONE_CHANNEL
+
+
+def test_reaper_fails_exhausted_jobs_instead_of_requeueing(db):
+    db.rows = [{"requeued": 1, "failed": 2}]
+    assert asyncio.run(JobWorker(None, concurrency=1).reap()) == (1, 2)
+    sql, _ = db.calls[0]
+    assert "CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END" in sql
+    assert db.calls[1] == ("SELECT pg_notify(%s, '')", (jobs.DONE_CHANNEL,))
+
+
+def test_reaper_without_exhausted_jobs_does_not_notify(db):
+    db.rows = [{"requeued": 1, "failed": 0}]
+    asyncio.run(JobWorker(None, concurrency=1).reap())
+    assert len(db.calls) == 1
+
+
+def test_heartbeat_survives_failed_updates(db, monkeypatch):
+    monkeypatch.setattr(config, "JOBS_LEASE", 0.03)
+    db.raises = 2
+
+    async def run():
+        beat = asyncio.create_task(JobWorker(None, concurrency=1)._heartbeat(job()))
+        await asyncio.sleep(0.1)
+        assert not beat.done()
+        beat.cancel()
+
+    asyncio.run(run())
+    assert len(db.calls) >= 4  # два упавших продления и дальше — успешные
+
+
+def test_cancelled_execute_stops_heartbeat(db, monkeypatch):
+    monkeypatch.setattr(config, "JOBS_LEASE", 0.03)
+
+    async def run_forever(bot, job, checkpoint):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setitem(jobs._kinds, "test", jobs.JobKind(run_forever, None))
+
+    async def run():
+        task = asyncio.create_task(JobWorker(None, concurrency=1)._execute(job()))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        beats = len(db.calls)
+        await asyncio.sleep(0.05)
+        return beats
+
+    beats = asyncio.run(run())
+    assert len(db.calls) == beats  # после отмены продлений больше нет
+
+
+def test_inline_submit_reports_failure_to_on_done(monkeypatch):
+    monkeypatch.setattr(config, "JOBS_MODE", "inline")
+    done = []
+
+    async def run(bot, job, checkpoint):
+        await checkpoint({"step": 1})
+        raise RuntimeError("llm down")
+
+    async def on_done(bot, job):
+        done.append((job.status, job.result, job.last_error))
+
+    monkeypatch.setitem(jobs._kinds, "test", jobs.JobKind(run, on_done))
+    asyncio.run(jobs.submit("test", 1, {}, None))
+    assert done == [("failed", {"step": 1}, "llm down")]
+
+
+def test_writes_require_the_lease(db):
+    worker = JobWorker(None, concurrency=1)
+    asyncio.run(worker._checkpoint(job(), {"step": 1}))
+    asyncio.run(worker._finish(job(), {}))
+    asyncio.run(worker._fail(job(attempts=1), RuntimeError("boom")))
+    asyncio.run(worker._fail(job(attempts=3), RuntimeError("boom")))
+    for sql, args in db.calls:
+        assert "AND locked_by = %s AND status = 'running'" in sql
+        assert worker.name in args
+
+
+def test_stale_worker_stops_writing(db):
+    db.rows = [None, None, None]  # задачу уже ведёт другой воркер: ни одна строка не обновлена
+    worker = JobWorker(None, concurrency=1)
+    with pytest.raises(jobs.LeaseLost):
+        asyncio.run(worker._checkpoint(job(), {"step": 1}))
+    assert asyncio.run(worker._fail(job(attempts=1), RuntimeError("boom"))) == "lease_lost"
+    assert asyncio.run(worker._fail(job(attempts=3), RuntimeError("boom"))) == "lease_lost"
+
+
+def test_lost_lease_aborts_the_run_without_finishing(db, monkeypatch):
+    monkeypatch.setattr(config, "JOBS_LEASE", 0.03)
+    db.rows = [None]  # первое же продление: аренду забрали
+    cancelled = []
+
+    async def run_forever(bot, job, checkpoint):
+        try:
+            await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            cancelled.append(job.id)
+            raise
+
+    monkeypatch.setitem(jobs._kinds, "test", jobs.JobKind(run_forever, None))
+    asyncio.run(asyncio.wait_for(JobWorker(None, concurrency=1)._execute(job()), timeout=1))
+    assert cancelled == [7]
+    assert len(db.calls) == 1  # только heartbeat: ни _finish, ни _fail
@@ -0,0 +1,65 @@
+import asyncio
+
+import openai
+import pytest
+
+import llm
+from llm import LatencyPolicy
+from resilience import RetryBudget
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    monkeypatch.setitem(llm.POLICIES, "test", LatencyPolicy(deadline=0.5, hedge_min=0.05, fallback_model="fast"))
+    monkeypatch.setattr(llm, "_retries", RetryBudget("test", ratio=0.1, min_tokens=5))
+    monkeypatch.setattr(llm, "_latency", {})
+    return []
+
+
+def test_slow_primary_is_hedged(calls, monkeypatch):
+    async def chat(messages, *, purpose, model=None, timeout=None, **params):
+        calls.append(model)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return f"ответ {len(calls)}"
+
+    monkeypatch.setattr(llm, "chat", chat)
+    assert asyncio.run(llm.chat_tiered([], purpose="test")) == "ответ 2"
+    assert calls == [None, None]
+
+
+def test_nothing_in_time_falls_back_to_canned(calls, monkeypatch):
+    async def chat(messages, *, purpose, model=None, timeout=None, **params):
+        calls.append(model)
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(llm, "chat", chat)
+    assert asyncio.run(llm.chat_tiered([], purpose="test", canned=("ок",))) == "ок"
+    assert calls == [None, None, "fast"]
+
+
+def fake_chat(calls, error):
+    async def chat(messages, *, purpose, model=None, timeout=None, **params):
+        calls.append(model)
+        await asyncio.sleep(0.01)
+        raise error
+    return chat
+
+
+def test_request_error_is_not_hedged(calls, monkeypatch):
+    monkeypatch.setattr(llm, "chat", fake_chat(calls, openai.error.InvalidRequestError("context length", None)))
+    with pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(llm.chat_tiered([], purpose="test"))
+    assert calls == [None]
+
+
+def test_request_error_goes_straight_to_canned(calls, monkeypatch):
+    monkeypatch.setattr(llm, "chat", fake_chat(calls, openai.error.AuthenticationError("bad key")))
+    assert asyncio.run(llm.chat_tiered([], purpose="test", canned=("ок",))) == "ок"
+    assert calls == [None]
+
+
+def test_outage_is_hedged_then_falls_back(calls, monkeypatch):
+    monkeypatch.setattr(llm, "chat", fake_chat(calls, openai.error.ServiceUnavailableError("503")))
+    assert asyncio.run(llm.chat_tiered([], purpose="test", canned=("ок",))) == "ок"
+    assert calls == [None, None, "fast"]
@@ -0,0 +1,19 @@
+import ast
+from pathlib import Path
+
+import migrations
+
+
+def test_versions_are_consecutive_and_sql_is_literal():
+    assert [v for v, _, _ in migrations.MIGRATIONS] == list(range(1, migrations.LATEST + 1))
+    for _, description, statements in migrations.MIGRATIONS:
+        assert description and statements
+        assert all(isinstance(sql, str) and sql.strip() for sql in statements)
+
+
+def test_migrations_do_not_depend_on_live_modules():
+    # SQL выпущенных миграций не должен меняться вместе с кодом модулей
+    tree = ast.parse(Path(migrations.__file__).read_text())
+    imported = {alias.name for node in ast.walk(tree) if isinstance(node, ast.Import) for alias in node.names}
+    imported |= {node.module for node in ast.walk(tree) if isinstance(node, ast.ImportFrom) and node.level == 0}
+    assert not imported & {"jobs", "access_cache", "artifacts", "gen_cache", "session_store", "bot"}
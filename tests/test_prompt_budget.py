@@ -0,0 +1,46 @@
+import asyncio
+
+from prompt_budget import _trim, add_product_digest, build_interview_digest, context_for_prompt, count_tokens, render
+from session import Session
+
+
+def test_digest_is_built_once_and_grows_by_product():
+    sess = Session()
+    sess.answers = ["десять  лет\nв дизайне", " ", "честность"]
+    build_interview_digest(sess, ["Опыт", "Пусто", "Ценности"])
+    add_product_digest(sess, ["курс", "новички"], ["Что", "Кому"])
+    assert render(sess.digest) == (
+        "Интервью:\nОпыт: десять лет в дизайне\nЦенности: честность\n\n"
+        "Продукты:\nПродукт 1 — Что: курс; Кому: новички"
+    )
+    assert render(sess.digest, with_products=False).endswith("Ценности: честность")
+    # в пределах бюджета контекст — тот же дайджест, без сжатия
+    assert asyncio.run(context_for_prompt(sess, 1000)) == render(sess.digest)
+
+
+def test_long_lines_are_shortened_first():
+    text = "Интервью:\nОпыт: " + "очень длинный ответ " * 200 + "\nЦенности: коротко"
+    trimmed = _trim(text, 200)
+    assert count_tokens(trimmed) <= 200
+    assert trimmed.startswith("Интервью:\nОпыт: очень длинный ответ")
+    assert trimmed.endswith("Ценности: коротко")
+
+
+def test_many_short_lines_still_fit_the_budget():
+    interview = "\n".join(f"Вопрос {i}: короткий ответ номер {i}" for i in range(200))
+    products = "\n".join(f"Продукт {i} — описание" for i in range(1, 30))
+    text = f"Интервью:\n{interview}\n\nПродукты:\n{products}"
+    assert count_tokens(text) > 300
+    trimmed = _trim(text, 300)
+    assert count_tokens(trimmed) <= 300
+    # выбрасываются строки с конца, начало интервью остаётся
+    assert trimmed.startswith("Интервью:\nВопрос 0: короткий ответ номер 0\nВопрос 1:")
+
+
+def test_text_within_budget_is_unchanged():
+    text = "Интервью:\nОпыт: десять лет"
+    assert _trim(text, 1000) == text
+
+
+def test_tiny_budget_never_overflows():
+    assert count_tokens(_trim("Интервью:\n" + "слово " * 50, 3)) <= 3
@@ -0,0 +1,86 @@
+import pytest
+
+import resilience
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, RetryBudget
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(resilience.random, "uniform", lambda a, b: 1.0)
+
+
+def make_breaker():
+    return CircuitBreaker("test", failures=3, open_for=10, open_max=30)
+
+
+def test_opens_after_consecutive_failures(clock):
+    b = make_breaker()
+    for _ in range(2):
+        b.before_call()
+        b.record_failure()
+    b.before_call()
+    b.record_success()                 # успех сбрасывает счётчик
+    for _ in range(2):
+        b.before_call()
+        b.record_failure()
+    assert b.state == CLOSED
+    b.before_call()
+    b.record_failure()
+    assert b.state == OPEN
+    with pytest.raises(CircuitOpen):
+        b.before_call()
+    with pytest.raises(CircuitOpen):
+        b.check()
+
+
+def test_half_open_lets_one_probe_through(clock):
+    b = make_breaker()
+    for _ in range(3):
+        b.record_failure()
+    clock.now += 10
+    b.before_call()                    # проба
+    assert b.state == HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        b.before_call()                # вторую не пускаем, пока идёт проба
+    b.record_success()
+    assert b.state == CLOSED
+    b.before_call()
+
+
+def test_failed_probe_reopens_for_longer(clock):
+    b = make_breaker()
+    for _ in range(3):
+        b.record_failure()
+    clock.now += 10
+    b.before_call()
+    b.record_failure()
+    assert b.state == OPEN
+    clock.now += 10
+    assert b.rejecting()               # второй раз — 20 с
+    clock.now += 10
+    b.before_call()
+    b.record_ignored()                 # отмена — проба не считается
+    b.before_call()
+    assert b.state == HALF_OPEN
+
+
+def test_listeners_see_transitions(clock, monkeypatch):
+    seen = []
+    monkeypatch.setattr(resilience, "listeners", [lambda name, old, new: seen.append((old, new))])
+    b = make_breaker()
+    for _ in range(3):
+        b.record_failure()
+    clock.now += 10
+    b.before_call()
+    b.record_success()
+    assert seen == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+
+
+def test_retry_budget_is_a_share_of_calls():
+    budget = RetryBudget("test", ratio=0.5, min_tokens=1)
+    assert budget.try_retry()
+    assert not budget.try_retry()
+    budget.record_call()
+    budget.record_call()
+    assert budget.try_retry()
+    assert not budget.try_retry()
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+import resilience
+import segment_fanout
+from segment_fanout import CRITERIA, SegmentError, fan_out
+
+
+def segment(number: int) -> str:
+    body = "\n".join(f"<u>{label}:</u> текст" for label in CRITERIA)
+    return f"<b>Сегмент {number}: название</b>\n{body}"
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(segment_fanout.resilience, "backoff", lambda attempt: 0)
+    resilience._budgets.clear()
+
+
+def run_fan_out(write, count=3, **kw):
+    emitted = []
+
+    async def emit(i, text):
+        emitted.append(i)
+
+    params = dict(first=1, concurrency=3, attempts=3)
+    params.update(kw)
+    texts = asyncio.run(fan_out(count, write, emit, **params))
+    return texts, emitted
+
+
+def test_segments_are_emitted_in_order_whatever_finishes_first():
+    finished = []
+
+    async def write(i, retry):
+        await asyncio.sleep(0.03 * (3 - i))   # последний сегмент готов первым
+        finished.append(i)
+        return segment(1 + i)
+
+    texts, emitted = run_fan_out(write)
+    assert finished == [2, 1, 0]
+    assert emitted == [0, 1, 2]
+    assert texts == [segment(1), segment(2), segment(3)]
+
+
+def test_invalid_and_failed_segments_are_retried():
+    calls = []
+
+    async def write(i, retry):
+        calls.append((i, retry))
+        if i == 0 and not retry:
+            return "не по шаблону"
+        if i == 1 and not retry:
+            raise RuntimeError("timeout")
+        return segment(1 + i)
+
+    texts, emitted = run_fan_out(write)
+    assert emitted == [0, 1, 2]
+    assert sorted(calls) == [(0, False), (0, True), (1, False), (1, True), (2, False)]
+
+
+def test_gives_up_after_attempts():
+    calls = []
+
+    async def write(i, retry):
+        calls.append(i)
+        return "не по шаблону"
+
+    with pytest.raises(SegmentError):
+        run_fan_out(write, count=1, attempts=2)
+    assert calls == [0, 0]
+
+
+def test_zero_attempts_still_generates_once():
+    async def write(i, retry):
+        return segment(1 + i)
+
+    texts, _ = run_fan_out(write, count=2, attempts=0)
+    assert texts == [segment(1), segment(2)]
+
+
+def test_ready_segments_are_not_regenerated():
+    calls = []
+
+    async def write(i, retry):
+        calls.append(i)
+        return segment(1 + i)
+
+    texts, emitted = run_fan_out(write, ready={0: segment(1)})
+    assert calls == [1, 2] and emitted == [1, 2]
+    assert texts[0] == segment(1)
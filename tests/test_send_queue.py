@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+from send_queue import Priority, SendScheduler, TokenBucket
+
+
+def enqueue(sched, sent, name, chat_id, priority=Priority.INTERACTIVE):
+    async def send():
+        sent.append(name)
+
+    return asyncio.ensure_future(
+        sched.process_request(send, (), {}, "sendMessage", {"chat_id": chat_id}, priority))
+
+
+def test_one_request_in_flight_per_chat_in_order():
+    async def run():
+        sched = SendScheduler(global_rate=100, chat_rate=100, chat_burst=10)
+        sent = []
+        futures = [enqueue(sched, sent, name, chat_id)
+                   for name, chat_id in (("a1", 1), ("a2", 1), ("a3", 1), ("b1", 2))]
+        await asyncio.sleep(0)
+        sched._dispatch_ready()                  # по одному запросу из каждого чата
+        await asyncio.sleep(0)
+        assert sent == ["a1", "b1"]
+        while not all(f.done() for f in futures):
+            sched._dispatch_ready()
+            await asyncio.sleep(0)
+        assert sent == ["a1", "b1", "a2", "a3"]
+        assert sched.stats()["sent"] == 4
+
+    asyncio.run(run())
+
+
+def test_interactive_request_overtakes_bulk():
+    async def run():
+        sched = SendScheduler(global_rate=100, chat_rate=100, chat_burst=10)
+        sched.global_bucket = TokenBucket(0.001, 1)   # один свободный токен на весь бот
+        sent = []
+        enqueue(sched, sent, "длинный текст", 1, Priority.BULK)
+        enqueue(sched, sent, "вопрос", 2, Priority.INTERACTIVE)
+        await asyncio.sleep(0)
+        sched._dispatch_ready()
+        await asyncio.sleep(0)
+        assert sent == ["вопрос"]
+        assert sched.stats()["queue_depth_bulk"] == 1
+
+    asyncio.run(run())
+
+
+def test_retry_after_pauses_only_its_chat():
+    async def run():
+        sched = SendScheduler(global_rate=100, chat_rate=100, chat_burst=10)
+        await sched.initialize()
+        sent = []
+        calls = {"a": 0}
+
+        async def send_a():
+            calls["a"] += 1
+            if calls["a"] == 1:
+                raise RetryAfter(1)
+            sent.append(("a", time.monotonic()))
+
+        async def send_b():
+            sent.append(("b", time.monotonic()))
+
+        try:
+            a = asyncio.ensure_future(sched.process_request(send_a, (), {}, "sendMessage", {"chat_id": 1},
+                                                            Priority.INTERACTIVE))
+            await asyncio.sleep(0.05)
+            started = time.monotonic()
+            await asyncio.wait_for(
+                sched.process_request(send_b, (), {}, "sendMessage", {"chat_id": 2}, Priority.INTERACTIVE),
+                timeout=0.5)
+            assert time.monotonic() - started < 0.5     # чат 2 не ждёт паузу чата 1
+            assert not a.done()
+            await asyncio.wait_for(a, timeout=2)
+            assert [who for who, _ in sent] == ["b", "a"]
+            assert sched.stats()["retry_after"] == 1
+        finally:
+            await sched.shutdown()
+
+    asyncio.run(run())
+
+
+def test_shutdown_right_after_a_send_returns():
+    async def run():
+        sched = SendScheduler(global_rate=100, chat_rate=100, chat_burst=10)
+        await sched.initialize()
+        sent = []
+
+        async def send():
+            sent.append("последнее")
+
+        await sched.process_request(send, (), {}, "sendMessage", {"chat_id": 1}, Priority.INTERACTIVE)
+        await asyncio.wait_for(sched.shutdown(), timeout=1)   # цикл только что разбужен отправкой
+        assert sent == ["последнее"]
+
+    asyncio.run(run())
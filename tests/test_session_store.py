@@ -0,0 +1,130 @@
+import asyncio
+import json
+
+from session import Session, Stage
+from session_store import SessionBackend, SessionStore
+
+
+class MemoryBackend(SessionBackend):
+    def __init__(self, rows=None):
+        self.rows = dict(rows or {})
+        self.saved = []
+
+    async def load(self, chat_id):
+        data = self.rows.get(chat_id)
+        return json.loads(data) if data is not None else None
+
+    async def save_many(self, items):
+        self.saved.append(dict(items))
+        for cid, data in items.items():
+            if data is None:
+                self.rows.pop(cid, None)
+            else:
+                self.rows[cid] = data
+
+
+def stored(stage=Stage.INTERVIEW):
+    return json.dumps(Session(stage).to_dict())
+
+
+def test_get_marks_session_dirty_and_flush_skips_unchanged():
+    async def run():
+        store = SessionStore(MemoryBackend({1: stored()}))
+        sess = await store.get(1)
+        assert 1 in store._dirty
+        await store.flush()
+        assert store.stats["skipped_unchanged"] == 1 and store.backend.saved == []
+
+        sess = await store.get(1)
+        sess.answers.append("ответ")
+        await store.flush()
+        assert store.backend.saved and 1 in store.backend.saved[0]
+
+    asyncio.run(run())
+
+
+def test_concurrent_loads_share_one_query_and_absent_is_remembered():
+    async def run():
+        store = SessionStore(MemoryBackend({1: stored()}))
+        first, second = await asyncio.gather(store.get(1), store.get(1))
+        assert first is second and store.stats["loads"] == 1
+        assert first.stage is Stage.INTERVIEW
+        assert await store.get(2) is None
+        assert await store.get(2) is None
+        assert store.stats["loads"] == 2
+
+    asyncio.run(run())
+
+
+def test_just_loaded_session_is_not_evicted():
+    async def run():
+        # лимит в одну сессию, а загружаемая — вторая: выгружается старая, не новая
+        store = SessionStore(MemoryBackend({1: stored(), 2: stored()}), max_resident=1)
+        await store.get(1)
+        await store.flush()
+        sess = await store.get(2)
+        assert sess is not None and store.peek(2) is sess
+        assert store.peek(1) is None and store.stats["evicted_full"] == 1
+
+    asyncio.run(run())
+
+
+def test_pinned_session_survives_eviction_and_unpin_marks_dirty():
+    async def run():
+        store = SessionStore(MemoryBackend({1: stored()}), idle_ttl=0.01)
+        store.pin(1)
+        sess = await store.get(1)
+        await store.flush()                  # записали то, что было на момент get()
+        sess.answers.append("после await")   # хендлер продолжил менять сессию
+        await asyncio.sleep(0.02)
+        store._evict()
+        assert store.peek(1) is sess         # закреплена — не выгружаем, хоть и простаивает
+
+        store.unpin(1)
+        assert 1 in store._dirty
+        await store.flush()
+        assert json.loads(store.backend.rows[1])["answers"] == ["после await"]
+
+        await asyncio.sleep(0.02)
+        store._evict()
+        assert store.peek(1) is None and store.stats["evicted_idle"] == 1
+
+    asyncio.run(run())
+
+
+def test_dirty_session_is_not_evicted_until_flushed():
+    async def run():
+        store = SessionStore(MemoryBackend(), max_resident=1)
+        store.set(1, Session())
+        store.set(2, Session())
+        assert list(store._resident) == [1, 2]
+        await store.flush()
+        assert list(store._resident) == [2]
+
+    asyncio.run(run())
+
+
+def test_idle_session_is_evicted_after_flush(clock):
+    async def run():
+        store = SessionStore(MemoryBackend(), idle_ttl=60)
+        store.set(1, Session(Stage.INTERVIEW))
+        clock.now += 61
+        store._evict()
+        assert 1 in store._resident           # не записана — не выгружаем
+        await store.flush()
+        assert 1 not in store._resident and store.stats["evicted_idle"] == 1
+        assert json.loads(store.backend.rows[1])["stage"] == "interview"
+
+    asyncio.run(run())
+
+
+def test_stop_with_a_pending_batch_wakeup_flushes_and_returns():
+    async def run():
+        store = SessionStore(MemoryBackend(), flush_batch=1)
+        store.start()
+        await asyncio.sleep(0)
+        store.set(1, Session())              # пакет набран — фоновая запись уже разбужена
+        await asyncio.wait_for(store.stop(), timeout=1)
+        assert 1 in store.backend.rows
+
+    asyncio.run(run())
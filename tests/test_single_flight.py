@@ -0,0 +1,133 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from chat_dispatch import ChatDispatcher
+from session import Session
+from single_flight import SingleFlight
+
+
+_update_ids = iter(range(1, 10**6))
+
+
+def tap(cid: int, data: str):
+    answered = []
+
+    async def answer(text=None):
+        answered.append(text)
+
+    query = SimpleNamespace(data=data, answer=answer)
+    update = SimpleNamespace(update_id=next(_update_ids), callback_query=query, effective_chat=SimpleNamespace(id=cid))
+    return update, answered
+
+
+@pytest.fixture(autouse=True)
+def fresh_flights(monkeypatch):
+    monkeypatch.setattr(bot, "flights", SingleFlight(ttl=60))
+    monkeypatch.setattr(bot, "_tap_flights", {})
+
+
+class App:
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, coro, update=None):
+        self.tasks.append(coro)
+        coro.close()
+
+
+def test_join_and_done():
+    flights = SingleFlight(ttl=60)
+    assert not flights.join(1, "bio", "a")
+    assert flights.join(1, "bio", "a")
+    assert not flights.join(1, "bio", "b")     # входы изменились — новый полёт
+    flights.detach(1, "bio", "b")
+    flights.done(1, "bio", "b", handler=True)  # ушёл в очередь задач — хендлер не заканчивает
+    assert flights.active() == 1
+    flights.done(1, "bio", "b")
+    assert flights.active() == 0
+
+
+def test_repeated_tap_is_answered_without_queueing():
+    app = App()
+    bot.sessions._resident[6] = Session()
+    try:
+        assert not bot.dedupe_tap(app, tap(6, "jtbd")[0])          # первый тап — в очередь чата
+        assert bot.dedupe_tap(app, tap(6, "finish_products")[0])   # та же генерация другой кнопкой
+        assert not bot.dedupe_tap(app, tap(6, "bio")[0])           # другое действие — свой полёт
+        assert not bot.dedupe_tap(app, tap(6, "noop")[0])          # недорогие кнопки не трогаем
+        assert len(app.tasks) == 1                                 # «уже готовлю» — только дублю
+    finally:
+        del bot.sessions._resident[6]
+
+
+def test_finished_old_flight_does_not_end_the_newer_one():
+    flights = SingleFlight(ttl=60)
+    assert not flights.join(1, "jtbd", "a")    # тап A
+    assert not flights.join(1, "jtbd", "b")    # тап B после изменения данных — свой полёт
+    flights.done(1, "jtbd", "a", handler=True)  # хендлер A закончил
+    assert flights.join(1, "jtbd", "b")        # повтор B — дубль идущей генерации
+    assert flights.active() == 1
+
+
+def test_handlers_end_only_their_own_flight():
+    app = App()
+    bot.sessions._resident[9] = sess = Session()
+    try:
+        tap_a, _ = tap(9, "bio")
+        assert not bot.dedupe_tap(app, tap_a)
+        sess.answers.append("новый ответ")
+        tap_b, _ = tap(9, "bio")
+        assert not bot.dedupe_tap(app, tap_b)
+        bot.release_dropped_tap(9, tap_a)      # полёт A закончен (так же, как в finally хендлера)
+        assert bot.dedupe_tap(app, tap(9, "bio")[0])
+        bot.release_dropped_tap(9, tap_b)
+        assert bot.flights.active() == 0 and not bot._tap_flights
+    finally:
+        del bot.sessions._resident[9]
+
+
+def test_cold_session_tap_registers_the_flight():
+    app = App()
+    first, _ = tap(5, "bio")
+    second, _ = tap(5, "bio")
+    assert bot.sessions.peek(5) is None
+    assert not bot.dedupe_tap(app, first)      # первый тап идёт в очередь чата
+    assert bot.dedupe_tap(app, second)         # второй — дубль, хотя сессия ещё холодная
+    assert len(app.tasks) == 1
+
+    # сессия поднялась: тап с известными входами тоже совпадает с «холодным» полётом
+    bot.sessions._resident[5] = Session()
+    try:
+        third, _ = tap(5, "bio")
+        assert bot.dedupe_tap(app, third)
+    finally:
+        del bot.sessions._resident[5]
+
+
+def test_dropped_tap_releases_its_flight():
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def process(update):
+            await gate.wait()
+
+        dispatcher = ChatDispatcher(process, max_pending=1)
+        dispatcher.on_drop.append(bot.release_dropped_tap)
+        spawned = []
+        spawn = lambda coro: spawned.append(asyncio.ensure_future(coro))
+        updates = [tap(7, data)[0] for data in ("noop", "noop", "jtbd")]
+        assert dispatcher.submit(7, updates[0], spawn)
+        await asyncio.sleep(0)                 # первый апдейт в работе,
+        assert dispatcher.submit(7, updates[1], spawn)   # второй ждёт в очереди
+        assert not bot.dedupe_tap(App(), updates[2])
+        assert bot.flights.active() == 1
+        assert not dispatcher.submit(7, updates[2], spawn)
+        assert bot.flights.active() == 0       # тап отброшен — следующий запустит генерацию
+        gate.set()
+        await asyncio.gather(*spawned)
+
+    asyncio.run(run())
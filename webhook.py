@@ -0,0 +1,204 @@
+"""Webhook-режим: приём апдейтов по HTTP и раздача их N процессам-воркерам.
+
+Фронт (aiohttp) принимает POST от Telegram и кладёт апдейт в очередь воркера
+chat_id % N — так все апдейты одного чата всегда обрабатывает один процесс
+и его сессия в памяти. /healthz показывает живость воркеров; по SIGTERM фронт
+перестаёт принимать апдейты, а воркеры дорабатывают свои очереди и выходят.
+"""
+import asyncio
+import logging
+import multiprocessing as mp
+import queue as queue_mod
+import signal
+
+from aiohttp import web
+from telegram import Bot, Update
+
+import config
+import jobs
+import metrics
+
+log = logging.getLogger(__name__)
+
+_LOG_FORMAT = "%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s"
+
+
+def chat_id_of(data: dict) -> int | None:
+    """chat_id из сырого апдейта (без разбора в объекты telegram)."""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in data:
+            return data[key]["chat"]["id"]
+    if "callback_query" in data:
+        cq = data["callback_query"]
+        if cq.get("message"):
+            return cq["message"]["chat"]["id"]
+        return cq["from"]["id"]
+    for key in ("my_chat_member", "chat_member", "chat_join_request"):
+        if key in data:
+            return data[key]["chat"]["id"]
+    for value in data.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+# ---------- Воркер ----------
+def _worker_main(factory, index: int, count: int, updates: mp.Queue):
+    # сигналы останова приходят только от фронта (через None в очереди)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO)
+    asyncio.run(_worker(factory, index, count, updates))
+
+
+async def _worker(factory, index: int, count: int, updates: mp.Queue):
+    metrics.port_offset = index + 1
+    jobs.shard = (index, count)  # результаты фоновых генераций — только своих чатов
+    app = factory()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    log.info("worker %s: готов", index)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        # stop() выбрасывает необработанное — сперва дорабатываем очередь
+        await app.update_queue.join()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        log.info("worker %s: остановлен", index)
+
+
+# ---------- Фронт ----------
+class WebhookFront:
+    def __init__(self, factory, workers: int):
+        self.factory = factory
+        self.ctx = mp.get_context("spawn")
+        self.queues = [self.ctx.Queue(maxsize=config.WEB_WORKER_QUEUE) for _ in range(workers)]
+        self.procs: list = [None] * workers
+        self.draining = False
+        self.stats = {"received": 0, "rejected_full": 0, "restarts": 0}
+        # у фронта свои метрики; метрики хендлеров — на портах воркеров
+        self.metrics = [
+            metrics.Gauge("webhook_front", "Фронт webhook: принято, отклонено, перезапуски воркеров", ("key",),
+                          collect=lambda: self.stats, register=False),
+            metrics.Gauge("webhook_worker_up", "Воркер жив", ("worker",), register=False,
+                          collect=lambda: {str(i): int(p is not None and p.is_alive()) for i, p in enumerate(self.procs)}),
+            metrics.Gauge("webhook_worker_queue", "Апдейтов в очереди воркера", ("worker",), register=False,
+                          collect=lambda: {str(i): _qsize(q) for i, q in enumerate(self.queues)}),
+        ]
+
+    def _spawn(self, index: int):
+        proc = self.ctx.Process(
+            target=_worker_main, args=(self.factory, index, len(self.queues), self.queues[index]),
+            name=f"worker-{index}",
+        )
+        proc.start()
+        self.procs[index] = proc
+
+    async def _supervise(self):
+        # упавший воркер перезапускаем на той же очереди — апдейты его чатов не теряются
+        while not self.draining:
+            await asyncio.sleep(2)
+            for i, proc in enumerate(self.procs):
+                if not proc.is_alive() and not self.draining:
+                    log.error("worker %s завершился с кодом %s, перезапуск", i, proc.exitcode)
+                    self.stats["restarts"] += 1
+                    self._spawn(i)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if config.WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.WEBHOOK_SECRET:
+            return web.Response(status=403)
+        if self.draining:
+            # Telegram повторит доставку после рестарта
+            return web.Response(status=503)
+        data = await request.json()
+        cid = chat_id_of(data)
+        index = cid % len(self.queues) if cid is not None else 0
+        try:
+            self.queues[index].put_nowait(data)
+        except queue_mod.Full:
+            self.stats["rejected_full"] += 1
+            return web.Response(status=503)
+        self.stats["received"] += 1
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        alive = [p is not None and p.is_alive() for p in self.procs]
+        ok = all(alive) and not self.draining
+        return web.json_response(
+            {"ok": ok, "draining": self.draining, "workers_alive": sum(alive), "workers": len(alive), **self.stats},
+            status=200 if ok else 503,
+        )
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=metrics.render(self.metrics).encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/" + config.WEBHOOK_PATH.strip("/"), self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/metrics", self.handle_metrics)
+        return app
+
+    async def serve(self):
+        for i in range(len(self.queues)):
+            self._spawn(i)
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, config.WEBHOOK_LISTEN, config.WEBHOOK_PORT)
+        await site.start()
+        log.info("webhook: слушаем %s:%s, воркеров: %s", config.WEBHOOK_LISTEN, config.WEBHOOK_PORT, len(self.procs))
+
+        if config.WEBHOOK_URL:
+            async with Bot(config.BOT_TOKEN) as bot:
+                await bot.set_webhook(
+                    url=config.WEBHOOK_URL.rstrip("/") + "/" + config.WEBHOOK_PATH.strip("/"),
+                    secret_token=config.WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        supervisor = asyncio.create_task(self._supervise())
+        await stop.wait()
+
+        log.info("webhook: останов, дорабатываем очереди воркеров")
+        self.draining = True
+        supervisor.cancel()
+        for q in self.queues:
+            q.put(None)
+        await loop.run_in_executor(None, self._join_workers)
+        await runner.cleanup()
+
+    def _join_workers(self):
+        for proc in self.procs:
+            proc.join(config.WEB_DRAIN_TIMEOUT)
+            if proc.is_alive():
+                log.warning("%s не успел доработать за %.0f с, завершаем", proc.name, config.WEB_DRAIN_TIMEOUT)
+                proc.terminate()
+
+
+def _qsize(q) -> int:
+    try:
+        return q.qsize()
+    except NotImplementedError:  # macOS
+        return -1
+
+
+def run_webhook(factory, workers: int | None = None):
+    """factory — функция без аргументов, собирающая Application (вызывается в каждом воркере)."""
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO)
+    asyncio.run(WebhookFront(factory, workers or config.WEB_WORKERS).serve())